@@ -0,0 +1,218 @@
+"""
+批次化的仿射資料增強：旋轉、平移、剪切、縮放與水平翻轉合成為每張圖片一個
+3x3 矩陣，整個批次只呼叫一次 ImageProjectiveTransformV3
+
+參數分布與矩陣的組合順序與 ImageDataGenerator.apply_transform 相同
+（旋轉 -> 平移 -> 剪切 -> 縮放，以影像中心為原點，最後水平翻轉），
+雙線性插值（interpolation_order=1）、邊界以 fill_mode='nearest' 延伸。
+ImageDataGenerator 對每張圖片、每個通道分別呼叫 scipy.ndimage，這裡整個
+批次在計算圖中一次完成。
+
+隨機參數以 stateless RNG 產生，只由 (seed, 批次編號) 決定：同一批次每次
+產生相同的增強結果，續訓時可完整重現。
+
+用法：
+    python augment.py --check       # 與 ImageDataGenerator 逐像素比較
+    python augment.py --benchmark   # 比較兩者的吞吐量
+"""
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+# 與 ImageDataGenerator 相同的資料增強參數
+ROTATION_RANGE = 20      # 旋轉角度（度）
+SHIFT_RANGE = 0.2        # 寬度/高度平移比例
+SHEAR_RANGE = 0.2        # 剪切角度（度，與 Keras 定義相同）
+ZOOM_RANGE = 0.2         # 縮放範圍 [1 - 0.2, 1 + 0.2]
+SEED = 42
+
+
+def random_parameters(batch_size, height, width, seed,
+                      rotation_range=ROTATION_RANGE, shift_range=SHIFT_RANGE,
+                      shear_range=SHEAR_RANGE, zoom_range=ZOOM_RANGE,
+                      horizontal_flip=True):
+    """
+    以 stateless RNG 產生整個批次的增強參數（分布與 get_random_transform 相同）
+
+    seed 為形狀 [2] 的整數張量；回傳 {名稱: [batch_size] 張量}
+    """
+    u = tf.random.stateless_uniform([batch_size, 7], seed=seed)
+    height = tf.cast(height, tf.float32)
+    width = tf.cast(width, tf.float32)
+    flip = u[:, 6] < 0.5 if horizontal_flip else tf.zeros([batch_size],
+                                                          tf.bool)
+    return {
+        'theta': (2 * u[:, 0] - 1) * rotation_range,
+        # ImageDataGenerator 的 tx 以高度換算、ty 以寬度換算
+        'tx': (2 * u[:, 1] - 1) * shift_range * height,
+        'ty': (2 * u[:, 2] - 1) * shift_range * width,
+        'shear': (2 * u[:, 3] - 1) * shear_range,
+        'zx': 1 - zoom_range + 2 * zoom_range * u[:, 4],
+        'zy': 1 - zoom_range + 2 * zoom_range * u[:, 5],
+        'flip_horizontal': flip,
+    }
+
+
+def _matrices(rows):
+    """
+    [[a, b, c], [d, e, f]] 的每個元素為 [B] 張量 -> [B, 3, 3]（最後一列 0 0 1）
+    """
+    zeros = tf.zeros_like(rows[0][0])
+    ones = tf.ones_like(zeros)
+    return tf.reshape(tf.stack([*rows[0], *rows[1], zeros, zeros, ones],
+                               axis=1), [-1, 3, 3])
+
+
+def affine_transforms(params, height, width):
+    """
+    將增強參數合成為 ImageProjectiveTransformV3 的 [B, 8] 轉換
+
+    輸出像素 (x, y) 對應到輸入座標 T @ (x, y, 1)，x 為欄、y 為列
+    """
+    theta = params['theta'] * (np.pi / 180.0)
+    shear = params['shear'] * (np.pi / 180.0)
+    zeros = tf.zeros_like(theta)
+    ones = tf.ones_like(theta)
+    cos, sin = tf.cos(theta), tf.sin(theta)
+
+    rotation = _matrices([[cos, -sin, zeros], [sin, cos, zeros]])
+    shift = _matrices([[ones, zeros, params['tx']],
+                       [zeros, ones, params['ty']]])
+    shearing = _matrices([[ones, -tf.sin(shear), zeros],
+                          [zeros, tf.cos(shear), zeros]])
+    zoom = _matrices([[params['zx'], zeros, zeros],
+                      [zeros, params['zy'], zeros]])
+
+    # 與 transform_matrix_offset_center 相同：第一個座標以高度、第二個以寬度置中
+    o_x = tf.cast(height, tf.float32) / 2 - 0.5
+    o_y = tf.cast(width, tf.float32) / 2 - 0.5
+    offset = _matrices([[ones, zeros, ones * o_x], [zeros, ones, ones * o_y]])
+    reset = _matrices([[ones, zeros, -ones * o_x],
+                       [zeros, ones, -ones * o_y]])
+    # 水平翻轉在仿射轉換之後：輸出第 x 欄取自轉換結果的第 (width - 1 - x) 欄
+    sign = tf.where(params['flip_horizontal'], -ones, ones)
+    flip_offset = tf.where(params['flip_horizontal'],
+                           ones * (tf.cast(width, tf.float32) - 1), zeros)
+    flip = _matrices([[sign, zeros, flip_offset], [zeros, ones, zeros]])
+
+    matrix = offset @ rotation @ shift @ shearing @ zoom @ reset @ flip
+    return tf.reshape(matrix, [-1, 9])[:, :8]
+
+
+def augment_batch(images, seed, **ranges):
+    """
+    對 [B, H, W, C] 的 float 批次套用隨機仿射增強（單次投影轉換）
+    """
+    shape = tf.shape(images)
+    params = random_parameters(shape[0], shape[1], shape[2], seed, **ranges)
+    return tf.raw_ops.ImageProjectiveTransformV3(
+        images=images,
+        transforms=affine_transforms(params, shape[1], shape[2]),
+        output_shape=shape[1:3],
+        fill_value=0.0,
+        interpolation='BILINEAR',
+        fill_mode='NEAREST')
+
+
+def build_augmenter(seed=SEED, **ranges):
+    """
+    回傳 augment(images, step)；step 為批次編號，與 seed 一起決定隨機參數
+    """
+    def augment(images, step):
+        return augment_batch(
+            images, tf.stack([tf.constant(seed, tf.int64),
+                              tf.cast(step, tf.int64)]), **ranges)
+
+    return augment
+
+
+def _keras_generator():
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+    return ImageDataGenerator(
+        rotation_range=ROTATION_RANGE,
+        width_shift_range=SHIFT_RANGE,
+        height_shift_range=SHIFT_RANGE,
+        shear_range=SHEAR_RANGE,
+        zoom_range=ZOOM_RANGE,
+        horizontal_flip=True,
+        fill_mode='nearest')
+
+
+def check(images, seed=SEED):
+    """
+    以相同參數比較 ImageDataGenerator.apply_transform 與本模組的輸出
+
+    回傳 (最大絕對誤差, 平均絕對誤差)，像素範圍 0-255
+    """
+    images = tf.convert_to_tensor(images, tf.float32)
+    shape = images.shape
+    seed = tf.constant([seed, 0], tf.int64)
+    params = {k: v.numpy() for k, v in random_parameters(
+        shape[0], shape[1], shape[2], seed).items()}
+    ours = augment_batch(images, seed).numpy()
+
+    generator = _keras_generator()
+    reference = np.stack([
+        generator.apply_transform(image, {k: v[i] for k, v in params.items()})
+        for i, image in enumerate(images.numpy())])
+    diff = np.abs(ours - reference)
+    return float(diff.max()), float(diff.mean())
+
+
+def benchmark(images, repeats=5, seed=SEED):
+    """
+    比較 ImageDataGenerator 逐張增強與單次批次增強的吞吐量（images/sec）
+    """
+    generator = _keras_generator()
+    batch = images.numpy() if hasattr(images, 'numpy') else images
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for image in batch:
+            generator.random_transform(image)
+    keras_rate = repeats * len(batch) / (time.perf_counter() - start)
+
+    augment = tf.function(build_augmenter(seed))
+    augment(tf.convert_to_tensor(batch), 0)
+    start = time.perf_counter()
+    for step in range(repeats):
+        augment(tf.convert_to_tensor(batch), step + 1).numpy()
+    batched_rate = repeats * len(batch) / (time.perf_counter() - start)
+
+    results = {'ImageDataGenerator': keras_rate, 'augment.py': batched_rate}
+    for name, rate in results.items():
+        print(f"{name:<20s} {rate:10.1f} images/sec")
+    print(f"加速倍數: {batched_rate / keras_rate:.2f}x")
+    return results
+
+
+def main():
+    from data_pipeline import BATCH_SIZE, IMG_SIZE, find_data_dir, load_image
+    from dataset_index import load_index
+
+    parser = argparse.ArgumentParser(description='批次化仿射資料增強')
+    parser.add_argument('--data-dir', default=find_data_dir())
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--check', action='store_true',
+                        help='與 ImageDataGenerator 逐像素比較')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='與 ImageDataGenerator 比較吞吐量')
+    args = parser.parse_args()
+
+    index = load_index(args.data_dir)
+    rows = np.random.default_rng(SEED).choice(
+        len(index), min(args.batch_size, len(index)), replace=False)
+    images = tf.stack([load_image(index.filepaths[i], IMG_SIZE)
+                       for i in rows])
+    if args.check:
+        max_diff, mean_diff = check(images)
+        print(f"與 ImageDataGenerator 的差異: 最大 {max_diff:.3f}，"
+              f"平均 {mean_diff:.4f}（像素範圍 0-255）")
+    if args.benchmark:
+        benchmark(images)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""
+training/img 報告圖表的增量建置
+
+每個建置目標宣告產生圖表的腳本、輸出的 PNG、相依的程式碼與輸入資料。
+輸入雜湊（程式碼內容 + 資料指紋）與輸出雜湊記錄在 img/.figures.json，
+只有輸入改變或輸出遺失、被修改的目標才重新產生；需要重建的腳本以
+Agg 後端在獨立行程中平行執行。
+
+用法：
+    python build_figures.py            # 只重建有變動的圖表
+    python build_figures.py --dry-run  # 列出需要重建的目標
+    python build_figures.py --force    # 全部重建
+"""
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+TRAINING_DIR = os.path.dirname(os.path.abspath(__file__))
+IMG_DIR = os.path.join(TRAINING_DIR, 'img')
+MANIFEST_NAME = '.figures.json'
+
+
+def find_dataset(img_dir=IMG_DIR):
+    """
+    與展示圖腳本相同的資料集路徑搜尋順序（腳本在 img 目錄下執行）
+    """
+    for candidate in ('../plantvillage dataset/color',
+                      '../../plantvillage dataset/color',
+                      'plantvillage dataset/color'):
+        path = os.path.normpath(os.path.join(img_dir, candidate))
+        if os.path.isdir(path):
+            return path
+    return None
+
+
+def dataset_fingerprint():
+    """
+    資料集 manifest 指紋；找不到資料集時回傳 None（目標略過）
+    """
+    data_dir = find_dataset()
+    if data_dir is None:
+        return None
+    from dataset_index import load_index
+
+    return load_index(data_dir).fingerprint()
+
+
+def results_fingerprint():
+    """
+    evaluation.py 的評估結果雜湊與最新訓練記錄的指紋；兩者不存在時圖表
+    使用內建數據
+    """
+    from evaluation import DEFAULT_REPORT
+    from metrics_log import fingerprint
+
+    report = file_hash(DEFAULT_REPORT) if os.path.exists(DEFAULT_REPORT) \
+        else 'missing'
+    return f"{report}\0{fingerprint()}"
+
+
+class Figure:
+    """
+    一個建置目標：執行 script 產生 outputs
+
+    code 為額外相依的模組，data 為回傳資料指紋的函式（回傳 None 表示
+    輸入資料不存在，略過此目標）。
+    """
+
+    def __init__(self, script, outputs, code=(), data=None):
+        self.script = script
+        self.outputs = tuple(outputs)
+        self.code = (script, *code)
+        self.data = data
+
+    @property
+    def name(self):
+        return os.path.splitext(self.script)[0]
+
+    def input_hash(self, data_tokens):
+        digest = hashlib.sha1()
+        for path in self.code:
+            with open(os.path.join(TRAINING_DIR, path), 'rb') as f:
+                digest.update(path.encode('utf-8') + b'\0' + f.read())
+        if self.data is not None:
+            token = data_tokens[self.data]
+            if token is None:
+                return None
+            digest.update(token.encode('utf-8'))
+        return digest.hexdigest()
+
+
+FIGURES = [
+    Figure('generate_charts.py',
+           ['training_history.png', 'confusion_matrix.png',
+            'performance_comparison.png', 'f1_scores_distribution.png'],
+           code=['evaluation.py', 'metrics_log.py'],
+           data=results_fingerprint),
+    Figure('generate_dataset_charts.py',
+           ['dataset_split.png', 'class_statistics.png',
+            'test_samples_distribution.png', 'dataset_summary.png']),
+    Figure('generate_complete_plant_chart.py',
+           ['complete_plant_statistics.png']),
+    Figure('generate_sample_images.py',
+           ['sample_images_grid.png', 'category_comparison.png'],
+           code=['dataset_index.py', 'thumbnails.py'],
+           data=dataset_fingerprint),
+    Figure('generate_all_categories.py', ['all_categories_grid.png'],
+           code=['dataset_index.py', 'thumbnails.py'],
+           data=dataset_fingerprint),
+]
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest(img_dir=IMG_DIR):
+    path = os.path.join(img_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, img_dir=IMG_DIR):
+    path = os.path.join(img_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def is_current(figure, input_hash, entry, img_dir=IMG_DIR):
+    """
+    輸入雜湊相同且所有輸出存在、內容與上次建置相同
+    """
+    if not entry or entry.get('input') != input_hash:
+        return False
+    for output in figure.outputs:
+        path = os.path.join(img_dir, output)
+        if not os.path.exists(path) or \
+                entry.get('outputs', {}).get(output) != file_hash(path):
+            return False
+    return True
+
+
+def render(figure, img_dir=IMG_DIR):
+    """
+    在獨立行程中以 Agg 後端執行腳本，回傳 (是否成功, 秒數, 錯誤輸出)
+    """
+    env = dict(os.environ, MPLBACKEND='Agg',
+               PYTHONPATH=os.pathsep.join(
+                   filter(None, [TRAINING_DIR, os.environ.get('PYTHONPATH')])))
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, os.path.join(TRAINING_DIR, figure.script)],
+        cwd=img_dir, env=env, capture_output=True, text=True)
+    return (result.returncode == 0, time.perf_counter() - start,
+            result.stderr)
+
+
+def build(figures=FIGURES, force=False, dry_run=False, jobs=None,
+          img_dir=IMG_DIR):
+    """
+    重建過期的目標，回傳失敗的目標名稱
+    """
+    manifest = load_manifest(img_dir)
+    data_tokens = {figure.data: figure.data() for figure in figures
+                   if figure.data is not None}
+    stale = []
+    for figure in figures:
+        input_hash = figure.input_hash(data_tokens)
+        if input_hash is None:
+            print(f"略過 {figure.name}：找不到輸入資料")
+        elif force or not is_current(figure, input_hash,
+                                     manifest.get(figure.name), img_dir):
+            stale.append((figure, input_hash))
+        else:
+            print(f"最新 {figure.name}")
+
+    if dry_run or not stale:
+        for figure, _ in stale:
+            print(f"需要重建 {figure.name}: {', '.join(figure.outputs)}")
+        return []
+
+    start = time.perf_counter()
+    failed = []
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        results = pool.map(lambda item: render(item[0], img_dir), stale)
+        for (figure, input_hash), (ok, seconds, stderr) in zip(stale, results):
+            missing = [o for o in figure.outputs
+                       if not os.path.exists(os.path.join(img_dir, o))]
+            if not ok or missing:
+                print(f"失敗 {figure.name} ({seconds:.1f} 秒)")
+                print('\n'.join(stderr.strip().splitlines()[-10:]))
+                failed.append(figure.name)
+                continue
+            manifest[figure.name] = {
+                'input': input_hash,
+                'outputs': {o: file_hash(os.path.join(img_dir, o))
+                            for o in figure.outputs},
+            }
+            print(f"已重建 {figure.name} ({seconds:.1f} 秒)")
+    save_manifest(manifest, img_dir)
+    print(f"重建 {len(stale) - len(failed)}/{len(stale)} 個目標，"
+          f"共 {time.perf_counter() - start:.1f} 秒")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='報告圖表增量建置')
+    parser.add_argument('targets', nargs='*',
+                        help='只建置指定的目標（例如 generate_charts）')
+    parser.add_argument('--force', action='store_true', help='全部重建')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='只列出需要重建的目標')
+    parser.add_argument('--jobs', type=int, default=None, help='平行行程數')
+    args = parser.parse_args()
+
+    figures = [f for f in FIGURES
+               if not args.targets or f.name in args.targets]
+    failed = build(figures, args.force, args.dry_run, args.jobs)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
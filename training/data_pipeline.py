@@ -0,0 +1,240 @@
+"""
+使用 tf.data 建立平行化的資料輸入管線，
+取代 ImageDataGenerator.flow_from_dataframe
+
+用法：
+    python data_pipeline.py --benchmark --batches 50
+"""
+import argparse
+import functools
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from sklearn.model_selection import train_test_split
+
+from augment import (
+    ROTATION_RANGE,
+    SHEAR_RANGE,
+    SHIFT_RANGE,
+    ZOOM_RANGE,
+    build_augmenter,
+)
+from dataset_index import load_index
+from dataset_splits import split_frames
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+# 與 notebook 相同的訓練設定
+IMG_SIZE = (224, 224)
+BATCH_SIZE = 32
+SEED = 42
+# 模型輸入：nearest 縮放後像素除以 255（同 ImageDataGenerator(rescale=1./255)）
+RESCALE = 1. / 255
+RESIZE_METHOD = 'nearest'
+
+
+def find_data_dir(data_dir='../plantvillage dataset/color'):
+    """
+    尋找資料集路徑（相對於training目錄）
+    """
+    candidates = [data_dir,
+                  '../../plantvillage dataset/color',
+                  'plantvillage dataset/color']
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    return data_dir
+
+
+def create_dataframe(data_path):
+    """
+    建立包含 Filepaths 與 Labels 欄位的 DataFrame（與 99-5 notebook 相同）
+
+    檔案清單來自 dataset_index 的 manifest，類別與檔名皆排序以確保順序一致
+    """
+    return load_index(data_path).to_dataframe()
+
+
+def split_dataframe(df, seed=SEED):
+    """
+    依 80% / 10% / 10% 切分訓練、驗證、測試集（與 notebook 相同）
+    """
+    train_df, dummy_df = train_test_split(df, train_size=0.8, shuffle=True,
+                                          random_state=seed)
+    valid_df, test_df = train_test_split(dummy_df, train_size=0.5,
+                                         shuffle=True, random_state=seed)
+    return train_df, valid_df, test_df
+
+
+def get_class_names(df):
+    """
+    取得排序後的類別名稱（與 flow_from_dataframe 的 class_indices 順序一致）
+    """
+    return sorted(df['Labels'].unique())
+
+
+def decode_image(encoded, image_size=IMG_SIZE, method=RESIZE_METHOD):
+    """
+    解碼已編碼的圖片位元組並縮放為 image_size（輸出 float32，範圍 0-255）
+
+    ImageDataGenerator 預設以 nearest 插值縮放；
+    image_dataset_from_directory 則使用 bilinear
+    """
+    image = tf.io.decode_image(encoded, channels=3, expand_animations=False)
+    image = tf.image.resize(image, image_size, method=method)
+    image.set_shape((*image_size, 3))
+    return tf.cast(image, tf.float32)
+
+
+def load_image(path, image_size=IMG_SIZE, method=RESIZE_METHOD):
+    """
+    讀取並解碼單張圖片，縮放為 image_size（輸出 float32，範圍 0-255）
+    """
+    return decode_image(tf.io.read_file(path), image_size, method)
+
+
+def build_dataset(df, class_names, training=False, batch_size=BATCH_SIZE,
+                  image_size=IMG_SIZE, seed=SEED):
+    """
+    從 Filepaths / Labels DataFrame 建立 tf.data.Dataset
+
+    - 平行解碼與縮放（num_parallel_calls=AUTOTUNE）
+    - 訓練集在批次上執行資料增強並依 seed 打亂
+    - 輸出與 flow_from_dataframe 相同：像素除以 255、one-hot 標籤
+    """
+    class_index = {name: i for i, name in enumerate(class_names)}
+    paths = df['Filepaths'].astype(str).values
+    labels = df['Labels'].map(class_index).values.astype(np.int32)
+    num_classes = len(class_names)
+
+    ds = tf.data.Dataset.from_tensor_slices((paths, labels))
+    if training:
+        ds = ds.shuffle(len(paths), seed=seed, reshuffle_each_iteration=True)
+
+    ds = ds.map(lambda path, label: (load_image(path, image_size), label),
+                num_parallel_calls=AUTOTUNE, deterministic=True)
+    ds = ds.batch(batch_size)
+    return finalize_batches(ds, num_classes, training, seed)
+
+
+def finalize_batches(ds, num_classes, training=False, seed=SEED,
+                     first_batch=0):
+    """
+    對已批次化的 (images, label_index) 套用資料增強、正規化與 one-hot，並預取
+
+    資料增強的隨機參數由 (seed, 批次編號) 決定，批次編號從 first_batch 起算；
+    從 epoch 中途續訓時傳入已完成的批次數即可重現相同的增強
+    """
+    if training:
+        augment = build_augmenter(seed)
+        ds = ds.enumerate(first_batch).map(
+            lambda step, batch: (augment(batch[0], step), batch[1]),
+            num_parallel_calls=AUTOTUNE, deterministic=True)
+
+    ds = ds.map(lambda images, label: (images / 255.0,
+                                       tf.one_hot(label, num_classes)),
+                num_parallel_calls=AUTOTUNE, deterministic=True)
+    return ds.prefetch(AUTOTUNE)
+
+
+def build_datasets(train_df, valid_df, test_df, batch_size=BATCH_SIZE,
+                   seed=SEED, tensor_cache=None):
+    """
+    一次建立訓練、驗證、測試三個資料集，取代三個 flow_from_dataframe
+
+    tensor_cache 為 tensor_cache.TensorCache 時直接從記憶體映射快取讀取，
+    不再解碼 JPEG
+    """
+    class_names = get_class_names(train_df)
+    build = build_dataset
+    if tensor_cache is not None:
+        from tensor_cache import build_cached_dataset
+
+        build = functools.partial(build_cached_dataset, tensor_cache)
+    train_ds = build(train_df, class_names, training=True,
+                     batch_size=batch_size, seed=seed)
+    valid_ds = build(valid_df, class_names, batch_size=batch_size)
+    test_ds = build(test_df, class_names, batch_size=batch_size)
+    return train_ds, valid_ds, test_ds, class_names
+
+
+def measure_throughput(batches, num_batches, batch_size=BATCH_SIZE):
+    """
+    量測迭代器每秒可產生的圖片數（跳過第一個批次的暖機時間）
+    """
+    iterator = iter(batches)
+    next(iterator)
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        next(iterator)
+    elapsed = time.perf_counter() - start
+    return num_batches * batch_size / elapsed
+
+
+def benchmark(df, num_batches=50, batch_size=BATCH_SIZE, seed=SEED):
+    """
+    比較 tf.data 管線與 ImageDataGenerator 的吞吐量（images/sec）
+    """
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+    class_names = get_class_names(df)
+    datagen = ImageDataGenerator(
+        rescale=RESCALE,
+        rotation_range=ROTATION_RANGE,
+        width_shift_range=SHIFT_RANGE,
+        height_shift_range=SHIFT_RANGE,
+        shear_range=SHEAR_RANGE,
+        zoom_range=ZOOM_RANGE,
+        horizontal_flip=True,
+        fill_mode='nearest'
+    )
+    generator = datagen.flow_from_dataframe(
+        dataframe=df,
+        x_col='Filepaths',
+        y_col='Labels',
+        target_size=IMG_SIZE,
+        batch_size=batch_size,
+        class_mode='categorical',
+        shuffle=True,
+        seed=seed
+    )
+    dataset = build_dataset(df, class_names, training=True,
+                            batch_size=batch_size, seed=seed)
+
+    results = {
+        'ImageDataGenerator': measure_throughput(generator, num_batches,
+                                                 batch_size),
+        'tf.data': measure_throughput(dataset, num_batches, batch_size),
+    }
+    for name, rate in results.items():
+        print(f"{name:<20s} {rate:10.1f} images/sec")
+    speedup = results['tf.data'] / results['ImageDataGenerator']
+    print(f"加速倍數: {speedup:.2f}x")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='tf.data 資料輸入管線')
+    parser.add_argument('--data-dir', default=find_data_dir())
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--batches', type=int, default=50,
+                        help='吞吐量測試的批次數')
+    parser.add_argument('--split', default=None,
+                        help='dataset_splits 的切分名稱（預設同 notebook）')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='與 ImageDataGenerator 比較吞吐量')
+    args = parser.parse_args()
+
+    train_df, valid_df, test_df = split_frames(args.data_dir, args.split)
+    print(f"訓練集: {len(train_df)}  驗證集: {len(valid_df)}  "
+          f"測試集: {len(test_df) if test_df is not None else 0}")
+
+    if args.benchmark:
+        benchmark(train_df, num_batches=args.batches,
+                  batch_size=args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+"""
+資料集索引：以 os.scandir 搭配執行緒池掃描資料夾，寫出精簡的 manifest
+
+manifest 記錄每張圖片的類別索引、檔名、大小、修改時間與圖片尺寸。
+之後只比對根目錄與各類別資料夾的 mtime，只有變動的類別才重新掃描，
+未變動的檔案沿用原本的尺寸資訊；資料夾沒有變動時載入只需數毫秒。
+
+create_dataframe 與各展示圖腳本都透過 load_index 取得檔案清單，
+不再各自以 os.listdir 走訪整個資料夾。
+
+注意：資料夾 mtime 只在新增、刪除或更名檔案時改變，原地覆寫圖片內容
+需以 refresh --full 重新掃描。
+
+用法：
+    python dataset_index.py refresh
+    python dataset_index.py info
+"""
+import argparse
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+INDEX_VERSION = 1
+
+
+def default_index_path(data_dir):
+    """
+    manifest 預設與其他快取一樣放在資料集旁的 cache 資料夾
+    """
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(data_dir)),
+                             'cache')
+    name = os.path.basename(os.path.normpath(data_dir))
+    return os.path.join(cache_dir, f"{name}_index.npz")
+
+
+def relpath(path):
+    """
+    檔案路徑 -> 「類別/檔名」（與 DatasetIndex.relpaths 相同），
+    供以檔案為鍵的快取使用，與 --data-dir 的寫法及工作目錄無關
+    """
+    class_dir, name = os.path.split(os.path.normpath(str(path)))
+    return f"{os.path.basename(class_dir)}/{name}"
+
+
+class DatasetIndex:
+    """
+    manifest 的記憶體表示；檔案依類別、檔名排序（與 create_dataframe 相同）
+
+    labels、sizes、mtimes、widths、heights 皆為 numpy 陣列
+    """
+
+    def __init__(self, data_dir, class_names, class_mtimes, root_mtime,
+                 names, labels, sizes, mtimes, widths, heights):
+        self.data_dir = data_dir
+        self.class_names = list(class_names)
+        self.class_mtimes = np.asarray(class_mtimes, dtype=np.int64)
+        self.root_mtime = int(root_mtime)
+        self.names = np.asarray(names, dtype=str)
+        self.labels = np.asarray(labels, dtype=np.int32)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.mtimes = np.asarray(mtimes, dtype=np.int64)
+        self.widths = np.asarray(widths, dtype=np.int32)
+        self.heights = np.asarray(heights, dtype=np.int32)
+        self._filepaths = None
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def filepaths(self):
+        if self._filepaths is None:
+            prefixes = [os.path.join(self.data_dir, name, '')
+                        for name in self.class_names]
+            self._filepaths = [prefixes[label] + name for label, name
+                               in zip(self.labels.tolist(),
+                                      self.names.tolist())]
+        return self._filepaths
+
+    @property
+    def relpaths(self):
+        """
+        相對於資料夾的「類別/檔名」，與 --data-dir 的寫法及工作目錄無關
+        """
+        return [f"{self.class_names[label]}/{name}" for label, name
+                in zip(self.labels.tolist(), self.names.tolist())]
+
+    def class_rows(self, class_name):
+        """
+        某類別在索引中的列範圍（各類別的列是連續的）
+        """
+        label = self.class_names.index(class_name)
+        start, stop = np.searchsorted(self.labels, [label, label + 1])
+        return range(start, stop)
+
+    def class_files(self, class_name):
+        """
+        某類別的所有圖片路徑；類別不存在時回傳空串列
+        """
+        if class_name not in self.class_names:
+            return []
+        rows = self.class_rows(class_name)
+        return self.filepaths[rows.start:rows.stop]
+
+    def changed_classes(self):
+        """
+        逐檔比對大小與 mtime，回傳有檔案變動的類別名稱
+
+        原地覆寫檔案不會改變資料夾的 mtime，只比對資料夾時看不到這類變動；
+        每個檔案一次 stat，不讀取內容
+        """
+        changed = set()
+        for path, label, size, mtime in zip(
+                self.filepaths, self.labels.tolist(), self.sizes.tolist(),
+                self.mtimes.tolist()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                changed.add(self.class_names[label])
+                continue
+            if stat.st_size != size or stat.st_mtime_ns != mtime:
+                changed.add(self.class_names[label])
+        return changed
+
+    def to_dataframe(self):
+        """
+        轉為 create_dataframe 的 Filepaths / Labels 格式
+        """
+        import pandas as pd
+
+        labels = np.asarray(self.class_names, dtype=object)[self.labels]
+        return pd.DataFrame({'Filepaths': self.filepaths, 'Labels': labels})
+
+    def fingerprint(self):
+        """
+        以相對路徑、大小與修改時間計算內容雜湊（不需重新 stat 每個檔案）
+
+        使用相對路徑，從 training/ 或專案根目錄執行都得到相同的雜湊
+        """
+        digest = hashlib.sha1()
+        for path, size, mtime in zip(self.relpaths, self.sizes.tolist(),
+                                     self.mtimes.tolist()):
+            digest.update(f"{path}\0{size}\0{mtime}\n".encode())
+        return digest.hexdigest()
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, version=INDEX_VERSION,
+                 class_names=np.asarray(self.class_names, dtype=str),
+                 class_mtimes=self.class_mtimes, root_mtime=self.root_mtime,
+                 names=self.names, labels=self.labels, sizes=self.sizes,
+                 mtimes=self.mtimes, widths=self.widths,
+                 heights=self.heights)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, data_dir, path):
+        """
+        讀取 manifest；不存在或版本不符時回傳 None
+        """
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as f:
+            if int(f['version']) != INDEX_VERSION:
+                return None
+            return cls(data_dir, f['class_names'].tolist(), f['class_mtimes'],
+                       f['root_mtime'], f['names'], f['labels'], f['sizes'],
+                       f['mtimes'], f['widths'], f['heights'])
+
+
+def _scan_class(class_path):
+    """
+    以 os.scandir 列出類別資料夾內的圖片，回傳排序後的 [(檔名, 大小, mtime)]
+    """
+    entries = []
+    with os.scandir(class_path) as it:
+        for entry in it:
+            if entry.name.lower().endswith(IMAGE_EXTENSIONS) \
+                    and entry.is_file():
+                stat = entry.stat()
+                entries.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    entries.sort()
+    return entries
+
+
+def _image_size(path):
+    """
+    只讀取檔頭取得 (寬, 高)；無法解析時回傳 (0, 0)
+    """
+    try:
+        with Image.open(path) as img:
+            return img.size
+    except Exception:
+        return 0, 0
+
+
+def _list_classes(data_dir):
+    classes = []
+    with os.scandir(data_dir) as it:
+        for entry in it:
+            if entry.is_dir():
+                classes.append((entry.name, entry.stat().st_mtime_ns))
+    classes.sort()
+    return classes
+
+
+def load_index(data_dir, index_path=None, workers=None, full=False,
+               verify_files=False):
+    """
+    載入資料集索引，只重新掃描 mtime 變動的類別資料夾
+
+    full=True 時忽略既有 manifest 重新掃描全部資料夾；verify_files=True 時
+    資料夾 mtime 未變動也逐檔比對大小與 mtime（見 changed_classes），
+    以檔案內容為準的快取（tensor_cache）使用
+    """
+    index_path = index_path or default_index_path(data_dir)
+    old = None if full else DatasetIndex.load(data_dir, index_path)
+    root_mtime = os.stat(data_dir).st_mtime_ns
+    classes = _list_classes(data_dir)
+    class_names = [name for name, _ in classes]
+    class_mtimes = [mtime for _, mtime in classes]
+
+    changed = set()
+    if old is not None and old.root_mtime == root_mtime \
+            and old.class_names == class_names \
+            and old.class_mtimes.tolist() == class_mtimes:
+        changed = old.changed_classes() if verify_files else set()
+        if not changed:
+            return old
+
+    # 沿用未變動類別的列；變動的類別重新 scandir
+    reused = {}
+    if old is not None:
+        for label, (name, mtime) in enumerate(zip(old.class_names,
+                                                  old.class_mtimes.tolist())):
+            rows = old.class_rows(name)
+            reused[name] = (mtime, old.names[rows.start:rows.stop].tolist(),
+                            old.sizes[rows.start:rows.stop],
+                            old.mtimes[rows.start:rows.stop],
+                            old.widths[rows.start:rows.stop],
+                            old.heights[rows.start:rows.stop])
+
+    stale = [name for name, mtime in classes
+             if name not in reused or reused[name][0] != mtime
+             or name in changed]
+    with ThreadPoolExecutor(max_workers=workers or min(32, os.cpu_count() * 4)
+                            ) as pool:
+        scanned = dict(zip(stale, pool.map(
+            lambda name: _scan_class(os.path.join(data_dir, name)), stale)))
+
+        names, labels, sizes, mtimes, dims = [], [], [], [], []
+        pending = []
+        for label, class_name in enumerate(class_names):
+            if class_name not in scanned:
+                _, c_names, c_sizes, c_mtimes, c_widths, c_heights = \
+                    reused[class_name]
+                names.extend(c_names)
+                labels.extend([label] * len(c_names))
+                sizes.extend(c_sizes.tolist())
+                mtimes.extend(c_mtimes.tolist())
+                dims.extend(zip(c_widths.tolist(), c_heights.tolist()))
+                continue
+
+            # 檔名、大小與 mtime 皆相同的檔案沿用舊尺寸，其餘讀取檔頭
+            known = {}
+            if class_name in reused:
+                _, c_names, c_sizes, c_mtimes, c_widths, c_heights = \
+                    reused[class_name]
+                known = {key: dim for key, dim in zip(
+                    zip(c_names, c_sizes.tolist(), c_mtimes.tolist()),
+                    zip(c_widths.tolist(), c_heights.tolist()))}
+            for name, size, mtime in scanned[class_name]:
+                dim = known.get((name, size, mtime))
+                if dim is None:
+                    pending.append(len(names))
+                names.append(name)
+                labels.append(label)
+                sizes.append(size)
+                mtimes.append(mtime)
+                dims.append(dim)
+
+        paths = [os.path.join(data_dir, class_names[labels[i]], names[i])
+                 for i in pending]
+        for i, dim in zip(pending, pool.map(_image_size, paths,
+                                            chunksize=64)):
+            dims[i] = dim
+
+    widths, heights = zip(*dims) if dims else ((), ())
+    index = DatasetIndex(data_dir, class_names, class_mtimes, root_mtime,
+                         names, labels, sizes, mtimes, widths, heights)
+    index.save(index_path)
+    print(f"已更新資料集索引：重新掃描 {len(stale)}/{len(class_names)} 個類別，"
+          f"讀取 {len(pending)} 張圖片檔頭")
+    return index
+
+
+def main():
+    from data_pipeline import find_data_dir
+
+    parser = argparse.ArgumentParser(description='資料集索引')
+    parser.add_argument('command', choices=['refresh', 'info'])
+    parser.add_argument('--data-dir', default=find_data_dir())
+    parser.add_argument('--index', default=None, help='manifest 路徑')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--full', action='store_true',
+                        help='忽略既有 manifest 重新掃描')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    index = load_index(args.data_dir, args.index, args.workers,
+                       full=args.full and args.command == 'refresh')
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"{len(index)} 張圖片，{len(index.class_names)} 個類別，"
+          f"耗時 {elapsed:.1f} ms")
+    if args.command == 'info':
+        counts = np.bincount(index.labels, minlength=len(index.class_names))
+        for name, count in zip(index.class_names, counts):
+            print(f"  {name}: {count}")
+        dims, counts = np.unique(np.stack([index.widths, index.heights], 1),
+                                 axis=0, return_counts=True)
+        print("常見尺寸: " + ', '.join(
+            f"{w}x{h} ({c})" for (w, h), c in
+            sorted(zip(dims.tolist(), counts.tolist()),
+                   key=lambda item: -item[1])[:5]))
+        print(f"總大小: {index.sizes.sum() / 1024 ** 2:.0f} MB")
+
+
+if __name__ == '__main__':
+    main()
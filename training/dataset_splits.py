@@ -0,0 +1,281 @@
+"""
+以索引陣列表示的資料集切分，取代 splitfolders.ratio 複製整個資料夾
+
+每個切分只儲存 dataset_index manifest 的列號（int32），並記錄種子、比例與
+manifest 指紋。同名切分內容變動時寫出新版本，舊版本保留可重現實驗；
+多個切分變體幾乎不佔磁碟空間。
+
+所有載入器（train.py、quantize.py、feature_cache.py、tfrecord_shards.py 等）
+都以 --split 指定切分名稱；未指定時使用與 99-5 notebook 相同的
+兩階段 train_test_split（不分層），結果與 split_dataframe 完全一致。
+
+用法：
+    python dataset_splits.py create stratified --seed 42
+    python dataset_splits.py create mobilenet --ratios 0.8 0.2 --seed 1337
+    python dataset_splits.py list
+"""
+import argparse
+import glob
+import os
+import re
+
+import numpy as np
+from sklearn.model_selection import train_test_split
+
+from dataset_index import default_index_path, load_index
+
+SPLIT_NAMES = ('train', 'valid', 'test')
+DEFAULT_RATIOS = (0.8, 0.1, 0.1)
+SEED = 42
+
+
+def default_split_dir(data_dir):
+    """
+    切分檔放在 manifest 旁的 splits/<資料集名稱>/
+    """
+    name = os.path.basename(os.path.normpath(data_dir))
+    return os.path.join(os.path.dirname(default_index_path(data_dir)),
+                        'splits', name)
+
+
+class DatasetSplit:
+    """
+    一個版本的切分：rows 為 {'train': 列號陣列, 'valid': ..., 'test': ...}
+    """
+
+    def __init__(self, name, version, rows, seed, ratios, stratify,
+                 fingerprint):
+        self.name = name
+        self.version = version
+        self.rows = rows
+        self.seed = seed
+        self.ratios = tuple(ratios)
+        self.stratify = stratify
+        self.fingerprint = fingerprint
+
+    def __repr__(self):
+        sizes = ', '.join(f"{k}={len(v)}" for k, v in self.rows.items())
+        return f"DatasetSplit({self.name} v{self.version}: {sizes})"
+
+    def frames(self, index):
+        """
+        依列號從 manifest 取出各切分的 Filepaths / Labels DataFrame
+        """
+        df = index.to_dataframe()
+        return {split: df.iloc[rows] for split, rows in self.rows.items()}
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, seed=self.seed, ratios=np.asarray(self.ratios),
+                 stratify=self.stratify, fingerprint=self.fingerprint,
+                 **self.rows)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        name, version = _parse_path(path)
+        with np.load(path) as f:
+            rows = {split: f[split] for split in SPLIT_NAMES if split in f}
+            return cls(name, version, rows, int(f['seed']),
+                       f['ratios'].tolist(), bool(f['stratify']),
+                       str(f['fingerprint']))
+
+
+def _parse_path(path):
+    match = re.match(r'(.+)\.v(\d+)\.npz$', os.path.basename(path))
+    return match.group(1), int(match.group(2))
+
+
+def _versions(split_dir, name):
+    paths = glob.glob(os.path.join(split_dir, f"{glob.escape(name)}.v*.npz"))
+    return sorted((_parse_path(p)[1], p) for p in paths
+                  if _parse_path(p)[0] == name)
+
+
+def _group_rows(labels, groups, ratios, seed, stratify):
+    """
+    以群組為單位分配切分：同一群組的列必定落在同一個切分
+
+    群組依大小由大到小（同大小隨機）逐一放入該類別目前最缺額的切分；
+    stratify 時各類別分別計算缺額，群組類別取第一列的類別。
+    """
+    rng = np.random.default_rng(seed)
+    _, first, inverse, sizes = np.unique(groups, return_index=True,
+                                         return_inverse=True,
+                                         return_counts=True)
+    group_labels = labels[first] if stratify else np.zeros(len(first), int)
+    totals = np.bincount(group_labels, weights=sizes)
+    targets = np.outer(totals, ratios)
+    counts = np.zeros_like(targets)
+    assignment = np.empty(len(first), dtype=np.int32)
+
+    order = rng.permutation(len(first))
+    order = order[np.argsort(-sizes[order], kind='stable')]
+    for group in order.tolist():
+        label = group_labels[group]
+        split = int(np.argmax(targets[label] - counts[label]))
+        assignment[group] = split
+        counts[label, split] += sizes[group]
+
+    row_splits = assignment[inverse.ravel()]
+    return {name: rng.permutation(np.flatnonzero(row_splits == i))
+            .astype(np.int32)
+            for i, name in enumerate(SPLIT_NAMES[:len(ratios)])}
+
+
+def thin_rows(rows, groups, max_per_group, seed=SEED):
+    """
+    每個群組最多保留 max_per_group 列（隨機挑選），維持 rows 原本的順序
+    """
+    rng = np.random.default_rng(seed)
+    shuffled = rng.permutation(len(rows))
+    order = shuffled[np.argsort(groups[rows[shuffled]], kind='stable')]
+    sorted_groups = groups[rows[order]]
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] !=
+                                  sorted_groups[:-1]])
+    rank = np.arange(len(order)) - np.repeat(
+        starts, np.diff(np.r_[starts, len(order)]))
+    keep = np.zeros(len(rows), dtype=bool)
+    keep[order[rank < max_per_group]] = True
+    return rows[keep]
+
+
+def compute_rows(labels, ratios=DEFAULT_RATIOS, seed=SEED, stratify=True,
+                 groups=None, max_per_group=None):
+    """
+    計算各切分的列號；ratios 為兩個或三個比例（train, valid[, test]）
+
+    stratify=False 時與 split_dataframe 的兩階段 train_test_split 相同
+    （其結果只取決於筆數與種子），可重現 notebook 的切分。
+
+    groups 為每列的群組編號（例如 near_duplicates 的近似重複群組）時，
+    同一群組不會跨越切分；max_per_group 另外限制 train 中每個群組的張數。
+    """
+    labels = np.asarray(labels)
+    if groups is not None:
+        groups = np.asarray(groups)
+        rows = _group_rows(labels, groups, ratios, seed, stratify)
+        if max_per_group:
+            rows['train'] = thin_rows(rows['train'], groups, max_per_group,
+                                      seed)
+        return rows
+    rows = np.arange(len(labels), dtype=np.int32)
+    train, rest = train_test_split(
+        rows, train_size=ratios[0], shuffle=True, random_state=seed,
+        stratify=labels if stratify else None)
+    if len(ratios) == 2:
+        return {'train': train, 'valid': rest}
+    valid, test = train_test_split(
+        rest, train_size=ratios[1] / (ratios[1] + ratios[2]), shuffle=True,
+        random_state=seed, stratify=labels[rest] if stratify else None)
+    return {'train': train, 'valid': valid, 'test': test}
+
+
+def create_split(index, name, ratios=DEFAULT_RATIOS, seed=SEED,
+                 stratify=True, split_dir=None, groups=None,
+                 max_per_group=None):
+    """
+    建立切分並寫出新版本；與最新版本內容相同時直接沿用
+    """
+    split_dir = split_dir or default_split_dir(index.data_dir)
+    rows = compute_rows(index.labels, ratios, seed, stratify, groups,
+                        max_per_group)
+    fingerprint = index.fingerprint()
+
+    versions = _versions(split_dir, name)
+    if versions:
+        latest = DatasetSplit.load(versions[-1][1])
+        if latest.fingerprint == fingerprint and \
+                latest.rows.keys() == rows.keys() and \
+                all(np.array_equal(latest.rows[k], rows[k]) for k in rows):
+            return latest
+
+    version = versions[-1][0] + 1 if versions else 1
+    split = DatasetSplit(name, version, rows, seed, ratios, stratify,
+                         fingerprint)
+    split.save(os.path.join(split_dir, f"{name}.v{version}.npz"))
+    print(f"已建立切分 {split}")
+    return split
+
+
+def load_split(index, name, version=None, split_dir=None):
+    """
+    讀取切分（預設為最新版本）；manifest 已變動時列號不再有效，拋出 ValueError
+    """
+    split_dir = split_dir or default_split_dir(index.data_dir)
+    versions = dict(_versions(split_dir, name))
+    if not versions:
+        raise FileNotFoundError(f"找不到切分 {name}，請先以 "
+                                f"dataset_splits.py create {name} 建立")
+    version = version or max(versions)
+    split = DatasetSplit.load(versions[version])
+    if split.fingerprint != index.fingerprint():
+        raise ValueError(f"資料集內容已變動，切分 {name} v{version} 的列號"
+                         f"已失效，請重新建立（會產生新版本）")
+    return split
+
+
+def split_frames(data_dir, name=None, seed=SEED):
+    """
+    回傳 (train_df, valid_df, test_df)；兩段切分時 test_df 為 None
+
+    name 為 None 時使用與 notebook 相同的切分（依種子自動建立與沿用）
+    """
+    index = load_index(data_dir)
+    if name is None:
+        split = create_split(index, f"notebook-seed{seed}", seed=seed,
+                             stratify=False)
+    else:
+        split = load_split(index, name)
+    frames = split.frames(index)
+    return frames['train'], frames['valid'], frames.get('test')
+
+
+def flow_from_split(datagen, data_dir, name, subset, **kwargs):
+    """
+    以 ImageDataGenerator.flow_from_dataframe 讀取切分，取代
+    splitfolders.ratio + flow_from_directory（不複製任何檔案）
+    """
+    index = load_index(data_dir)
+    frame = load_split(index, name).frames(index)[subset]
+    return datagen.flow_from_dataframe(
+        frame, x_col='Filepaths', y_col='Labels', classes=index.class_names,
+        **kwargs)
+
+
+def main():
+    from data_pipeline import find_data_dir
+
+    parser = argparse.ArgumentParser(description='資料集切分')
+    parser.add_argument('command', choices=['create', 'list'])
+    parser.add_argument('name', nargs='?', default='stratified')
+    parser.add_argument('--data-dir', default=find_data_dir())
+    parser.add_argument('--ratios', type=float, nargs='+',
+                        default=list(DEFAULT_RATIOS),
+                        help='train valid [test] 的比例')
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--no-stratify', action='store_true',
+                        help='不依類別分層（notebook 的切分方式）')
+    args = parser.parse_args()
+
+    index = load_index(args.data_dir)
+    if args.command == 'create':
+        if len(args.ratios) not in (2, 3) or \
+                not np.isclose(sum(args.ratios), 1.0):
+            parser.error('--ratios 需為兩個或三個且總和為 1')
+        create_split(index, args.name, args.ratios, args.seed,
+                     not args.no_stratify)
+        return
+
+    split_dir = default_split_dir(args.data_dir)
+    fingerprint = index.fingerprint()
+    for path in sorted(glob.glob(os.path.join(split_dir, '*.npz'))):
+        split = DatasetSplit.load(path)
+        state = '' if split.fingerprint == fingerprint else '  (已失效)'
+        print(f"{split}  seed={split.seed} ratios={split.ratios} "
+              f"stratify={split.stratify}{state}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+"""
+知識蒸餾：以訓練好的 Xception 為教師，訓練可在 CPU 快速推論的小型學生網路
+
+- 教師對每張圖片只執行一次：softmax 前的 logits 以 float16 寫入
+  feature_cache 的記憶體映射快取（鍵為檔案路徑 + 教師權重雜湊），
+  之後每個 epoch 直接讀取，教師的測試集 F1 也由快取計算
+- 學生為 plant-disease-detection notebook 的小型 CNN（五個 Conv2D/MaxPool
+  區塊 + Dense 128/64，可用 --filters / --dense 調整），或 MobileNet；
+  輸出 logits，原本 sigmoid 輸出搭配 sparse CE 的設定改為 softmax
+- 損失為 soft_weight * T^2 * KL(教師 || 學生，溫度 T) +
+  (1 - soft_weight) * 硬標籤交叉熵
+- 快取的是未增強圖片的教師輸出，學生訓練時仍套用資料增強
+
+完成後寫出 student.h5（含 softmax）、summary.json 與 distill_report.md，
+比較教師與學生的逐類別 F1、參數量、CPU 單張延遲與峰值記憶體。
+
+用法：
+    python distill.py --teacher ../runs/<train.py 執行>/model.h5
+    python distill.py --teacher xception.h5 --student mobilenet --width 0.5
+"""
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from augment import build_augmenter
+from data_pipeline import (
+    AUTOTUNE,
+    build_dataset,
+    create_dataframe,
+    get_class_names,
+    load_image,
+)
+from dataset_splits import split_frames
+from evaluation import evaluate_predictions, summarize
+from export_model import benchmark
+from feature_cache import extract_features
+from train import (
+    PROFILE_OPTIONS,
+    DequeueClock,
+    MetricsLogger,
+    build_callbacks,
+    build_parser,
+    evaluate_f1,
+    peak_memory_mb,
+    reject_options,
+)
+
+TEMPERATURE = 4.0
+SOFT_WEIGHT = 0.9
+FILTERS = '32,64,64,64,128'
+DENSE = '128,64'
+# 學生 F1 低於教師超過此值的類別列入報告
+F1_TOLERANCE = 0.01
+
+
+def default_teacher_cache(data_dir):
+    return os.path.join(os.path.dirname(os.path.abspath(data_dir)), 'cache',
+                        'teacher_logits')
+
+
+def teacher_logits_model(path):
+    """
+    載入教師並把最後的 softmax 改為線性輸出（logits）
+    """
+    teacher = tf.keras.models.load_model(path, compile=False)
+    teacher.layers[-1].activation = tf.keras.activations.linear
+    return teacher
+
+
+def build_student(num_classes, kind='cnn', filters=FILTERS, dense=DENSE,
+                  width=1.0, weights='imagenet', image_size=(224, 224)):
+    """
+    建立輸出 logits 的學生網路（輸入為 0-1 的圖片，與教師相同）
+
+    cnn 與 notebook 相同：每個 Conv2D(3x3) 後接 MaxPool，最後一個區塊以外
+    接 Dropout(0.2)
+    """
+    layers = tf.keras.layers
+    inputs = tf.keras.Input((*image_size, 3))
+    if kind == 'cnn':
+        x = inputs
+        sizes = [int(n) for n in filters.split(',')]
+        for i, n in enumerate(sizes):
+            x = layers.Conv2D(n, (3, 3), activation='relu')(x)
+            x = layers.MaxPool2D((2, 2))(x)
+            if i < len(sizes) - 1:
+                x = layers.Dropout(0.2)(x)
+        x = layers.Flatten()(x)
+        for n in (int(n) for n in dense.split(',') if n):
+            x = layers.Dense(n, activation='relu')(x)
+    elif kind == 'mobilenet':
+        # MobileNet 的 preprocess_input 為 [-1, 1]
+        x = layers.Rescaling(2.0, offset=-1.0)(inputs)
+        x = tf.keras.applications.MobileNet(
+            input_shape=(*image_size, 3), alpha=width, include_top=False,
+            weights=weights, pooling='avg')(x)
+    else:
+        raise ValueError(f"不支援的學生網路: {kind}")
+    logits = layers.Dense(num_classes, dtype='float32', name='logits')(x)
+    return tf.keras.Model(inputs, logits, name=f"student_{kind}")
+
+
+def distillation_loss(num_classes, temperature=TEMPERATURE,
+                      soft_weight=SOFT_WEIGHT):
+    """
+    y_true 為 [one-hot 標籤, 教師 logits] 串接；y_pred 為學生 logits
+
+    KL 項乘上 T^2，使其梯度大小不隨溫度改變
+    """
+    def loss(y_true, logits):
+        hard = y_true[:, :num_classes]
+        teacher = y_true[:, num_classes:] / temperature
+        student = logits / temperature
+        soft = tf.nn.softmax(teacher)
+        kl = tf.reduce_sum(soft * (tf.nn.log_softmax(teacher)
+                                   - tf.nn.log_softmax(student)), axis=-1)
+        ce = tf.nn.softmax_cross_entropy_with_logits(hard, logits)
+        return soft_weight * temperature ** 2 * kl + (1 - soft_weight) * ce
+
+    return loss
+
+
+def hard_accuracy(num_classes):
+    def accuracy(y_true, logits):
+        return tf.cast(tf.equal(tf.argmax(y_true[:, :num_classes], -1),
+                                tf.argmax(logits, -1)), tf.float32)
+
+    return accuracy
+
+
+def distillation_dataset(frame, class_names, logits, training=False,
+                         batch_size=32, seed=42):
+    """
+    (圖片 0-1, [one-hot 標籤, 教師 logits]) 的批次；訓練時打亂並資料增強
+    """
+    class_index = {name: i for i, name in enumerate(class_names)}
+    paths = frame['Filepaths'].astype(str).values
+    labels = frame['Labels'].map(class_index).values.astype(np.int32)
+    num_classes = len(class_names)
+
+    ds = tf.data.Dataset.from_tensor_slices((paths, labels, logits))
+    if training:
+        ds = ds.shuffle(len(paths), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.map(lambda path, label, teacher: (load_image(path), label,
+                                              teacher),
+                num_parallel_calls=AUTOTUNE, deterministic=True)
+    ds = ds.batch(batch_size)
+    if training:
+        augment = build_augmenter(seed)
+        ds = ds.enumerate().map(
+            lambda step, batch: (augment(batch[0], step), *batch[1:]),
+            num_parallel_calls=AUTOTUNE, deterministic=True)
+    ds = ds.map(lambda images, label, teacher: (
+        images / 255.0,
+        tf.concat([tf.one_hot(label, num_classes), teacher], axis=-1)),
+        num_parallel_calls=AUTOTUNE, deterministic=True)
+    return ds.prefetch(AUTOTUNE)
+
+
+def teacher_f1(logits, frame, class_names):
+    """
+    由快取的教師 logits 計算測試集指標（不需重新執行教師）
+    """
+    class_index = {name: i for i, name in enumerate(class_names)}
+    y_true = frame['Labels'].map(class_index).values
+    metrics, _ = evaluate_predictions(y_true, np.argmax(logits, axis=1),
+                                      len(class_names))
+    return summarize(metrics, class_names)
+
+
+def train(args):
+    """
+    快取教師 logits、訓練學生，回傳摘要並寫出 student.h5 與報告
+    """
+    tf.keras.utils.set_random_seed(args.seed)
+    tf.keras.mixed_precision.set_global_policy(args.precision)
+    train_df, valid_df, test_df = split_frames(args.data_dir, args.split,
+                                              args.seed)
+    if test_df is None:
+        test_df = valid_df
+    class_names = get_class_names(train_df)
+    num_classes = len(class_names)
+
+    # 教師對整個資料集只執行一次
+    teacher = teacher_logits_model(args.teacher)
+    teacher_params = int(teacher.count_params())
+    cache = extract_features(
+        'xception', create_dataframe(args.data_dir)['Filepaths'],
+        args.cache_dir or default_teacher_cache(args.data_dir), teacher)
+    del teacher
+    train_logits, valid_logits, test_logits = (
+        cache.lookup(frame['Filepaths'])
+        for frame in (train_df, valid_df, test_df))
+
+    student = build_student(num_classes, args.student, args.filters,
+                            args.dense, args.width, args.weights)
+    student.compile(tf.keras.optimizers.Adamax(learning_rate=args.lr),
+                    loss=distillation_loss(num_classes, args.temperature,
+                                           args.soft_weight),
+                    metrics=[hard_accuracy(num_classes)],
+                    jit_compile=args.jit_compile)
+    output_dir = os.path.join(args.output, args.name or
+                              f"distill_{args.student}_"
+                              f"{time.strftime('%Y%m%d-%H%M%S')}")
+    clock = DequeueClock()
+    logger = MetricsLogger(output_dir, args.batch_size, args.log_every, clock,
+                           run_kind='distill')
+    train_ds = distillation_dataset(train_df, class_names, train_logits,
+                                    training=True,
+                                    batch_size=args.batch_size,
+                                    seed=args.seed)
+    valid_ds = distillation_dataset(valid_df, class_names, valid_logits,
+                                    batch_size=args.batch_size)
+
+    start = time.perf_counter()
+    history = student.fit(clock.wrap(train_ds), validation_data=valid_ds,
+                          epochs=args.epochs,
+                          steps_per_epoch=args.steps_per_epoch,
+                          callbacks=build_callbacks() + [logger], verbose=1)
+    train_seconds = time.perf_counter() - start
+
+    model = tf.keras.Sequential([student, tf.keras.layers.Softmax()])
+    test_ds = build_dataset(test_df, class_names,
+                            batch_size=args.batch_size)
+    os.makedirs(output_dir, exist_ok=True)
+    student_path = os.path.join(output_dir, 'student.h5')
+    model.save(student_path)
+    summary = {
+        'config': vars(args),
+        'epochs_run': len(history.history['loss']),
+        'train_seconds': train_seconds,
+        'timing': logger.summary(),
+        'memory': peak_memory_mb(),
+        'history': {k: [float(v) for v in values]
+                    for k, values in history.history.items()},
+        'teacher_params': teacher_params,
+        'student_params': int(student.count_params()),
+        'test': evaluate_f1(model, test_ds, class_names),
+        'teacher_test': teacher_f1(test_logits, test_df, class_names),
+    }
+    # 教師與學生各在獨立行程中量測冷啟動、峰值記憶體與單張延遲
+    summary['cpu'] = benchmark([args.teacher, student_path])
+
+    with open(os.path.join(output_dir, 'summary.json'), 'w',
+              encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    report = compare(summary)
+    with open(os.path.join(output_dir, 'distill_report.md'), 'w',
+              encoding='utf-8') as f:
+        f.write(report)
+    print('\n' + report)
+    print(f"結果已寫入 {output_dir}")
+    return summary
+
+
+def compare(summary, tolerance=F1_TOLERANCE):
+    """
+    教師與學生的整體指標、CPU 延遲與記憶體，以及 F1 落後的類別（Markdown）
+    """
+    teacher, student = summary['teacher_test'], summary['test']
+    teacher_cpu, student_cpu = summary['cpu']
+    speedup = teacher_cpu['latency_ms_p50'] / student_cpu['latency_ms_p50']
+    lines = [
+        '| | 教師 (Xception) | 學生 |',
+        '| --- | --- | --- |',
+        f"| 參數量 | {summary['teacher_params']:,} | "
+        f"{summary['student_params']:,} |",
+        f"| 單張延遲 p50 | {teacher_cpu['latency_ms_p50']:.1f} ms | "
+        f"{student_cpu['latency_ms_p50']:.1f} ms ({speedup:.1f}x) |",
+        f"| 單張延遲 p95 | {teacher_cpu['latency_ms_p95']:.1f} ms | "
+        f"{student_cpu['latency_ms_p95']:.1f} ms |",
+        f"| 峰值記憶體 | {teacher_cpu['peak_rss_mb']:.0f} MB | "
+        f"{student_cpu['peak_rss_mb']:.0f} MB |",
+        f"| 冷啟動 | {teacher_cpu['cold_start_sec']:.2f} 秒 | "
+        f"{student_cpu['cold_start_sec']:.2f} 秒 |",
+        f"| 測試集準確率 | {teacher['accuracy']:.4f} | "
+        f"{student['accuracy']:.4f} |",
+        f"| macro F1 | {teacher['macro_f1']:.4f} | "
+        f"{student['macro_f1']:.4f} |",
+    ]
+    behind = [(name, teacher['per_class_f1'][name], f1)
+              for name, f1 in student['per_class_f1'].items()
+              if f1 < teacher['per_class_f1'][name] - tolerance]
+    total = len(student['per_class_f1'])
+    lines += ['', f"與教師 F1 差距在 {tolerance} 以內的類別: "
+              f"{total - len(behind)}/{total}"]
+    if behind:
+        lines += ['', '| 類別 | 教師 F1 | 學生 F1 |', '| --- | --- | --- |']
+        lines += [f"| {name} | {t:.4f} | {s:.4f} |"
+                  for name, t, s in sorted(behind, key=lambda r: r[2] - r[1])]
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = build_parser()
+    parser.description = '知識蒸餾：Xception 教師 -> 小型學生網路'
+    parser.add_argument('--teacher', required=True,
+                        help='train.py 訓練好的 Xception 模型（.h5）')
+    parser.add_argument('--student', choices=['cnn', 'mobilenet'],
+                        default='cnn')
+    parser.add_argument('--filters', default=FILTERS,
+                        help='cnn 學生各卷積區塊的濾波器數')
+    parser.add_argument('--dense', default=DENSE,
+                        help='cnn 學生的全連接層大小')
+    parser.add_argument('--width', type=float, default=1.0,
+                        help='MobileNet 學生的寬度倍率（alpha）')
+    parser.add_argument('--temperature', type=float, default=TEMPERATURE)
+    parser.add_argument('--soft-weight', type=float, default=SOFT_WEIGHT,
+                        help='KL 項的權重，其餘為硬標籤交叉熵')
+    parser.add_argument('--cache-dir', default=None,
+                        help='教師 logits 快取資料夾')
+    args = parser.parse_args()
+    reject_options(parser, args, ('--accum-steps', '--tensor-cache',
+                                  *PROFILE_OPTIONS), '蒸餾模式')
+    if args.weights == 'none':
+        args.weights = None
+    train(args)
+
+
+if __name__ == '__main__':
+    main()
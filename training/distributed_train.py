@@ -0,0 +1,390 @@
+"""
+以 MultiWorkerMirroredStrategy 進行多行程資料平行訓練（單機多核心或多節點）
+
+- 每個 worker 只讀取 train_df 中互不重疊的列（依 input_pipeline_id 分片）
+- 每個 epoch 結束以 CheckpointManager 存檔（權重、優化器、學習率與早停狀態），
+  中斷後重新執行相同指令即從上次的 epoch 繼續；多節點時 output 需為共用儲存
+- val_loss 改善時另存最佳權重至 best/，訓練結束（含續訓後）由此還原
+- 每個 worker 記錄自己的輸入速率與輸入等待時間至 worker_<i>.jsonl
+
+用法：
+    # 單機啟動 4 個 worker 行程（CI 用）
+    python distributed_train.py --num-workers 4 --epochs 20
+    # 多節點：各節點設定好 TF_CONFIG 後執行
+    python distributed_train.py --worker
+    # 1/2/4/8 個 worker 的擴展效率報告
+    python distributed_train.py --benchmark 1,2,4,8 --steps-per-epoch 20
+"""
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from data_pipeline import build_dataset, get_class_names
+from dataset_splits import split_frames
+from train import PROFILE_OPTIONS, build_model, build_parser, reject_options
+
+WORKER_LOG = 'worker_{}.jsonl'
+
+
+def shard_dataframe(df, num_shards, index):
+    """
+    將 DataFrame 的列平均分給 num_shards 個 worker，彼此不重疊
+
+    train_test_split 已將 train_df 打亂，直接間隔取列即可
+    """
+    return df.iloc[index::num_shards]
+
+
+def _free_ports(count):
+    sockets = []
+    for _ in range(count):
+        s = socket.socket()
+        s.bind(('localhost', 0))
+        sockets.append(s)
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def launch_local(num_workers, argv, output):
+    """
+    在本機啟動 num_workers 個 worker 行程並等待結束，回傳各行程結束碼
+    """
+    workers = [f"localhost:{port}" for port in _free_ports(num_workers)]
+    threads = max(1, (os.cpu_count() or 1) // num_workers)
+    processes = []
+    for index in range(num_workers):
+        env = dict(os.environ)
+        env['TF_CONFIG'] = json.dumps({
+            'cluster': {'worker': workers},
+            'task': {'type': 'worker', 'index': index},
+        })
+        processes.append(subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), *argv, '--worker',
+             '--output', output, '--threads', str(threads)],
+            env=env))
+    return [p.wait() for p in processes]
+
+
+class TrainState:
+    """
+    需要跨中斷保存的訓練狀態：epoch、學習率衰減與早停計數
+
+    與 train.build_callbacks 相同：val_loss 一個 epoch 未改善即學習率減半，
+    連續 patience 個 epoch 未改善則停止並還原最佳權重。
+    """
+
+    def __init__(self, patience=3, lr_factor=0.5):
+        self.patience = patience
+        self.lr_factor = lr_factor
+        self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.best_loss = tf.Variable(np.inf, dtype=tf.float32,
+                                     trainable=False)
+        self.wait = tf.Variable(0, dtype=tf.int64, trainable=False)
+
+    def checkpoint_items(self):
+        return {'epoch': self.epoch, 'best_loss': self.best_loss,
+                'wait': self.wait}
+
+    def update(self, val_loss, optimizer):
+        """
+        回傳 (是否為最佳, 是否應停止)
+        """
+        if val_loss < float(self.best_loss.numpy()):
+            self.best_loss.assign(val_loss)
+            self.wait.assign(0)
+            return True, False
+        self.wait.assign_add(1)
+        lr = float(optimizer.learning_rate.numpy()) * self.lr_factor
+        optimizer.learning_rate.assign(lr)
+        print(f"val_loss 未改善，學習率降為 {lr:.2e}")
+        return False, int(self.wait.numpy()) >= self.patience
+
+
+def _write_dir(directory, is_chief, worker_index):
+    """
+    所有 worker 都必須參與存檔；非 chief 寫到暫存目錄，存完即刪除
+    """
+    if is_chief:
+        return directory
+    return os.path.join(directory, f"workertemp_{worker_index}")
+
+
+def run_worker(args):
+    """
+    worker 行程：依 TF_CONFIG 加入叢集並執行訓練
+
+    以 strategy.run 自訂訓練迴圈；每一步分別計時取資料（輸入等待）與
+    訓練步驟，寫出該 worker 的輸入速率。
+    """
+    if args.threads:
+        tf.config.threading.set_intra_op_parallelism_threads(args.threads)
+        tf.config.threading.set_inter_op_parallelism_threads(2)
+
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    tf_config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+    worker_index = tf_config.get('task', {}).get('index', 0)
+    num_workers = len(tf_config.get('cluster', {}).get('worker', [None]))
+    is_chief = worker_index == 0
+
+    tf.keras.utils.set_random_seed(args.seed)
+    train_df, valid_df, _ = split_frames(args.data_dir, args.split, args.seed)
+    class_names = get_class_names(train_df)
+    global_batch = args.batch_size * strategy.num_replicas_in_sync
+
+    def distribute(frame, training):
+        def dataset_fn(input_context):
+            batch_size = input_context.get_per_replica_batch_size(global_batch)
+            shard = shard_dataframe(frame, input_context.num_input_pipelines,
+                                    input_context.input_pipeline_id)
+            ds = build_dataset(shard, class_names, training=training,
+                               batch_size=batch_size,
+                               seed=args.seed + input_context.input_pipeline_id)
+            # 驗證集不重複，每個 epoch 以新的迭代器完整走過一次
+            return ds.repeat() if training else ds
+        return strategy.distribute_datasets_from_function(dataset_fn)
+
+    steps_per_epoch = args.steps_per_epoch or len(train_df) // global_batch
+
+    with strategy.scope():
+        model = build_model(len(class_names), weights=args.weights)
+        optimizer = tf.keras.optimizers.Adamax(learning_rate=args.lr)
+        loss_fn = tf.keras.losses.CategoricalCrossentropy(reduction='none')
+        state = TrainState()
+        checkpoint = tf.train.Checkpoint(model=model, optimizer=optimizer,
+                                         **state.checkpoint_items())
+
+    checkpoint_dir = os.path.join(args.output, 'checkpoints')
+    manager = tf.train.CheckpointManager(
+        checkpoint, _write_dir(checkpoint_dir, is_chief, worker_index),
+        max_to_keep=2)
+    # 最佳權重不放進每個 epoch 的檢查點，只在改善時另存一份
+    best_checkpoint = tf.train.Checkpoint(model=model)
+    best_dir = os.path.join(args.output, 'best')
+    best_manager = tf.train.CheckpointManager(
+        best_checkpoint, _write_dir(best_dir, is_chief, worker_index),
+        max_to_keep=1)
+    # 所有 worker 都從 chief 的最新檢查點還原
+    latest = tf.train.latest_checkpoint(checkpoint_dir)
+    if latest:
+        checkpoint.restore(latest)
+        print(f"[worker {worker_index}] 從 {latest} 繼續"
+              f"（epoch {int(state.epoch.numpy())}）")
+
+    def step_fn(images, labels):
+        with tf.GradientTape() as tape:
+            probs = model(images, training=True)
+            loss = tf.nn.compute_average_loss(
+                loss_fn(labels, probs), global_batch_size=global_batch)
+        grads = tape.gradient(loss, model.trainable_variables)
+        optimizer.apply_gradients(zip(grads, model.trainable_variables))
+        return loss
+
+    def eval_fn(images, labels):
+        probs = model(images, training=False)
+        loss = tf.reduce_sum(loss_fn(labels, probs))
+        correct = tf.reduce_sum(tf.cast(
+            tf.argmax(probs, 1) == tf.argmax(labels, 1), tf.float32))
+        return loss, correct, tf.cast(tf.shape(labels)[0], tf.float32)
+
+    @tf.function
+    def train_step(batch):
+        losses = strategy.run(step_fn, args=batch)
+        return strategy.reduce(tf.distribute.ReduceOp.SUM, losses, axis=None)
+
+    @tf.function
+    def eval_step(batch):
+        results = strategy.run(eval_fn, args=batch)
+        return [strategy.reduce(tf.distribute.ReduceOp.SUM, value, axis=None)
+                for value in results]
+
+    os.makedirs(args.output, exist_ok=True)
+    log_path = os.path.join(args.output, WORKER_LOG.format(worker_index))
+    train_iter = iter(distribute(train_df, True))
+    valid_dist = distribute(valid_df, False)
+    images_per_step = global_batch // num_workers
+
+    while int(state.epoch.numpy()) < args.epochs:
+        epoch = int(state.epoch.numpy())
+        wait_times, step_times, total_loss = [], [], 0.0
+        for _ in range(steps_per_epoch):
+            start = time.perf_counter()
+            batch = next(train_iter)
+            fetched = time.perf_counter()
+            total_loss += float(train_step(batch))
+            wait_times.append(fetched - start)
+            step_times.append(time.perf_counter() - start)
+
+        # 分片大小不一時，已讀完的 worker 以空批次參與，直到所有 worker 結束
+        val_loss, val_correct, val_count = 0.0, 0.0, 0.0
+        for batch in valid_dist:
+            loss, correct, count = eval_step(batch)
+            val_loss += float(loss)
+            val_correct += float(correct)
+            val_count += float(count)
+        val_loss /= max(val_count, 1.0)
+        val_accuracy = val_correct / max(val_count, 1.0)
+
+        # 第一步含追蹤時間，不列入統計
+        steps = np.array(step_times[1:] or step_times)
+        waits = np.array(wait_times[1:] or wait_times)
+        record = {
+            'worker': worker_index,
+            'epoch': epoch,
+            'steps': len(step_times),
+            'step_time_ms': float(steps.mean() * 1000),
+            'input_wait_ms': float(waits.mean() * 1000),
+            'images_per_sec': float(images_per_step / steps.mean()),
+            'loss': total_loss / steps_per_epoch,
+            'val_loss': val_loss,
+            'val_accuracy': val_accuracy,
+        }
+        with open(log_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+        print(f"[worker {worker_index}] epoch {epoch + 1}/{args.epochs}: "
+              f"loss {record['loss']:.4f}  val_loss {val_loss:.4f}  "
+              f"val_acc {val_accuracy:.4f}  "
+              f"{record['images_per_sec']:.1f} images/sec  "
+              f"輸入等待 {record['input_wait_ms']:.1f} ms/step")
+
+        improved, stop = state.update(val_loss, optimizer)
+        if improved:
+            # 先存最佳權重再存記錄 best_loss 的檢查點，中斷時兩者不會不一致
+            best_manager.save()
+            if not is_chief:
+                tf.io.gfile.rmtree(best_manager.directory)
+        state.epoch.assign_add(1)
+        manager.save()
+        if not is_chief:
+            tf.io.gfile.rmtree(manager.directory)
+        if stop:
+            print(f"[worker {worker_index}] 早停於 epoch {epoch + 1}")
+            break
+
+    best = tf.train.latest_checkpoint(best_dir)
+    if best:
+        best_checkpoint.restore(best)
+    # 各 worker 權重同步，只由 chief 寫出模型
+    if is_chief:
+        model_path = os.path.join(args.output, 'model.h5')
+        model.save(model_path)
+        print(f"模型已儲存：{model_path}")
+
+
+def read_worker_logs(output, num_workers):
+    """
+    讀取各 worker 最後一個 epoch 的輸入速率
+    """
+    rates = []
+    for index in range(num_workers):
+        path = os.path.join(output, WORKER_LOG.format(index))
+        with open(path, encoding='utf-8') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        rates.append(records[-1]['images_per_sec'])
+    return rates
+
+
+def benchmark(worker_counts, argv, output):
+    """
+    依序以不同 worker 數訓練，計算擴展效率並寫出 scaling_report.md / .json
+
+    擴展效率 = N 個 worker 的總吞吐量 / (N x 1 個 worker 的吞吐量)
+    """
+    results = []
+    for count in worker_counts:
+        run_dir = os.path.join(output, f"workers_{count}")
+        print(f"\n=== {count} 個 worker ===")
+        codes = launch_local(count, argv, run_dir)
+        if any(codes):
+            print(f"{count} 個 worker 的執行失敗：結束碼 {codes}")
+            continue
+        rates = read_worker_logs(run_dir, count)
+        results.append({'workers': count, 'per_worker': rates,
+                        'total_images_per_sec': float(sum(rates))})
+
+    base = next((r['total_images_per_sec'] for r in results
+                 if r['workers'] == 1), None)
+    lines = ['| Workers | 總吞吐量 (images/sec) | 每個 worker 平均 '
+             '| 擴展效率 |',
+             '| ------- | --------------------- | ---------------- '
+             '| -------- |']
+    for r in results:
+        r['efficiency'] = r['total_images_per_sec'] / (r['workers'] * base) \
+            if base else None
+        efficiency = f"{r['efficiency']:.1%}" if base else '-'
+        lines.append(f"| {r['workers']} | {r['total_images_per_sec']:.1f} | "
+                     f"{np.mean(r['per_worker']):.1f} | {efficiency} |")
+
+    os.makedirs(output, exist_ok=True)
+    with open(os.path.join(output, 'scaling_report.json'), 'w',
+              encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    with open(os.path.join(output, 'scaling_report.md'), 'w',
+              encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    print('\n' + '\n'.join(lines))
+    return results
+
+
+def _strip_options(argv, names):
+    """
+    移除由啟動器重新指定的參數（例如 --output、--num-workers）
+    """
+    result = []
+    skip = False
+    for item in argv:
+        if skip:
+            skip = False
+            continue
+        key = item.split('=', 1)[0]
+        if key in names:
+            skip = '=' not in item
+            continue
+        result.append(item)
+    return result
+
+
+def main():
+    parser = build_parser()
+    parser.description = 'MultiWorkerMirroredStrategy 分散式訓練'
+    parser.set_defaults(output='../runs/distributed')
+    parser.add_argument('--num-workers', type=int, default=1,
+                        help='在本機啟動的 worker 行程數')
+    parser.add_argument('--worker', action='store_true',
+                        help='以 worker 身分執行（依 TF_CONFIG 加入叢集）')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='每個 worker 的運算執行緒數')
+    parser.add_argument('--benchmark', default=None,
+                        help='以逗號分隔的 worker 數，例如 1,2,4,8')
+    args = parser.parse_args()
+    if args.weights == 'none':
+        args.weights = None
+    if args.accum_steps > 1 or args.precision != 'float32' \
+            or args.jit_compile:
+        parser.error('分散式訓練目前只支援 float32、不累積梯度的設定')
+    reject_options(parser, args, ('--name', '--log-every', '--tensor-cache',
+                                  *PROFILE_OPTIONS), '分散式訓練')
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    argv = _strip_options(sys.argv[1:], {'--output', '--num-workers',
+                                         '--benchmark', '--threads'})
+    if args.benchmark:
+        counts = [int(n) for n in args.benchmark.split(',')]
+        benchmark(counts, argv, args.output)
+    else:
+        codes = launch_local(args.num_workers, argv, args.output)
+        sys.exit(max(codes))
+
+
+if __name__ == '__main__':
+    main()
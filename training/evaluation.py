@@ -0,0 +1,231 @@
+"""
+向量化評估：以單次 np.bincount 建立完整混淆矩陣並計算逐類別指標
+
+預測以批次串流：模型在圖中直接輸出 argmax，每個批次只做一次
+bincount(true * K + pred) 累加，之後 precision / recall / F1（逐類別、
+macro 與 weighted 平均）皆由混淆矩陣以陣列運算取得，評估速度只受模型
+吞吐量限制。
+
+結果寫成精簡的 .npz（混淆矩陣、類別名稱與各項指標），generate_charts.py
+直接讀取繪製混淆矩陣與 F1 分布圖。
+
+用法：
+    python evaluation.py --model ../runs/<名稱>/model.h5
+    python evaluation.py --model xception.h5 --split stratified
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+TRAINING_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_REPORT = os.path.join(os.path.dirname(TRAINING_DIR), 'runs',
+                              'evaluation.npz')
+
+
+def confusion_matrix(y_true, y_pred, num_classes):
+    """
+    以單次 bincount 計算混淆矩陣（列為真實類別、欄為預測類別）
+    """
+    y_true = np.asarray(y_true, dtype=np.int64)
+    y_pred = np.asarray(y_pred, dtype=np.int64)
+    counts = np.bincount(y_true * num_classes + y_pred,
+                         minlength=num_classes * num_classes)
+    return counts.reshape(num_classes, num_classes)
+
+
+class ConfusionAccumulator:
+    """
+    逐批累加混淆矩陣
+    """
+
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+        self.matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+
+    def update(self, y_true, y_pred):
+        self.matrix += confusion_matrix(y_true, y_pred, self.num_classes)
+
+
+def _safe_divide(numerator, denominator):
+    return np.divide(numerator, denominator,
+                     out=np.zeros_like(numerator, dtype=np.float64),
+                     where=denominator > 0)
+
+
+def metrics_from_confusion(matrix):
+    """
+    由混淆矩陣計算準確率、逐類別與 macro / weighted 的 precision、recall、F1
+
+    沒有樣本或沒有預測的類別其對應指標為 0（與 sklearn zero_division=0 相同）
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    tp = np.diag(matrix)
+    support = matrix.sum(axis=1)
+    predicted = matrix.sum(axis=0)
+    precision = _safe_divide(tp, predicted)
+    recall = _safe_divide(tp, support)
+    f1 = _safe_divide(2 * precision * recall, precision + recall)
+    weights = _safe_divide(support, np.full_like(support, support.sum()))
+    return {
+        'accuracy': float(tp.sum() / max(matrix.sum(), 1)),
+        'precision': precision,
+        'recall': recall,
+        'f1': f1,
+        'support': support.astype(np.int64),
+        'macro_precision': float(precision.mean()),
+        'macro_recall': float(recall.mean()),
+        'macro_f1': float(f1.mean()),
+        'weighted_precision': float(weights @ precision),
+        'weighted_recall': float(weights @ recall),
+        'weighted_f1': float(weights @ f1),
+    }
+
+
+def evaluate_predictions(y_true, y_pred, num_classes):
+    """
+    已有完整預測時直接計算指標，回傳 (指標, 混淆矩陣)
+    """
+    matrix = confusion_matrix(y_true, y_pred, num_classes)
+    return metrics_from_confusion(matrix), matrix
+
+
+def evaluate_batches(predict_fn, batches, num_classes):
+    """
+    串流評估：predict_fn(images) 回傳機率或 logits，labels 可為 one-hot 或整數
+
+    回傳 (指標, 混淆矩陣)
+    """
+    accumulator = ConfusionAccumulator(num_classes)
+    for images, labels in batches:
+        y_pred = np.asarray(predict_fn(images))
+        if y_pred.ndim > 1:
+            y_pred = y_pred.argmax(axis=1)
+        labels = np.asarray(labels)
+        if labels.ndim > 1:
+            labels = labels.argmax(axis=1)
+        accumulator.update(labels, y_pred)
+    return metrics_from_confusion(accumulator.matrix), accumulator.matrix
+
+
+def evaluate_model(model, dataset, num_classes):
+    """
+    以 tf.function 在圖中取 argmax，只將類別索引傳回主機
+    """
+    import tensorflow as tf
+
+    @tf.function
+    def predict(images, labels):
+        probs = model(images, training=False)
+        return (tf.argmax(labels, axis=1, output_type=tf.int32),
+                tf.argmax(probs, axis=1, output_type=tf.int32))
+
+    accumulator = ConfusionAccumulator(num_classes)
+    for images, labels in dataset:
+        y_true, y_pred = predict(images, labels)
+        accumulator.update(y_true.numpy(), y_pred.numpy())
+    return metrics_from_confusion(accumulator.matrix), accumulator.matrix
+
+
+def summarize(metrics, class_names):
+    """
+    轉為可寫入 JSON 的摘要（train.py summary.json 使用的格式）
+    """
+    return {
+        'accuracy': metrics['accuracy'],
+        'macro_f1': metrics['macro_f1'],
+        'weighted_f1': metrics['weighted_f1'],
+        'per_class_f1': dict(zip(class_names,
+                                 metrics['f1'].round(4).tolist())),
+        'support': dict(zip(class_names, metrics['support'].tolist())),
+    }
+
+
+def save_report(path, metrics, matrix, class_names, **extra):
+    """
+    寫出評估結果 .npz（混淆矩陣、類別名稱與所有指標）
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp.npz'
+    np.savez_compressed(tmp_path, confusion=matrix.astype(np.int32),
+                        class_names=np.asarray(class_names, dtype=str),
+                        **metrics, **extra)
+    os.replace(tmp_path, path)
+
+
+def load_report(path=DEFAULT_REPORT):
+    """
+    讀取評估結果；不存在時回傳 None
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as f:
+        report = {key: f[key] for key in f.files}
+    report['class_names'] = report['class_names'].tolist()
+    for key, value in report.items():
+        if isinstance(value, np.ndarray) and value.ndim == 0:
+            report[key] = value.item()
+    return report
+
+
+def print_report(metrics, class_names, worst=10):
+    print(f"準確率: {metrics['accuracy']:.4f}  "
+          f"macro F1: {metrics['macro_f1']:.4f}  "
+          f"weighted F1: {metrics['weighted_f1']:.4f}")
+    print(f"\nF1 最低的 {worst} 個類別:")
+    print(f"{'類別':<50s} {'precision':>9s} {'recall':>8s} {'f1':>8s} "
+          f"{'support':>8s}")
+    for i in np.argsort(metrics['f1'])[:worst]:
+        print(f"{class_names[i]:<50s} {metrics['precision'][i]:>9.4f} "
+              f"{metrics['recall'][i]:>8.4f} {metrics['f1'][i]:>8.4f} "
+              f"{metrics['support'][i]:>8d}")
+
+
+def main():
+    import tensorflow as tf
+
+    from data_pipeline import build_dataset, find_data_dir, get_class_names
+    from dataset_splits import split_frames
+
+    parser = argparse.ArgumentParser(description='測試集向量化評估')
+    parser.add_argument('--model', required=True)
+    parser.add_argument('--data-dir', default=find_data_dir())
+    parser.add_argument('--split', default=None,
+                        help='dataset_splits 的切分名稱（預設同 notebook）')
+    parser.add_argument('--subset', choices=['test', 'valid'], default='test')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--output', default=DEFAULT_REPORT)
+    parser.add_argument('--tensor-cache', action='store_true',
+                        help='從 tensor_cache.py 的記憶體映射快取讀取圖片')
+    args = parser.parse_args()
+
+    train_df, valid_df, test_df = split_frames(args.data_dir, args.split)
+    frame = valid_df if args.subset == 'valid' or test_df is None \
+        else test_df
+    class_names = get_class_names(train_df)
+    if args.tensor_cache:
+        from tensor_cache import build_cached_dataset, load_or_pack
+
+        dataset = build_cached_dataset(load_or_pack(args.data_dir), frame,
+                                       class_names,
+                                       batch_size=args.batch_size)
+    else:
+        dataset = build_dataset(frame, class_names, training=False,
+                                batch_size=args.batch_size)
+    model = tf.keras.models.load_model(args.model, compile=False)
+
+    start = time.perf_counter()
+    metrics, matrix = evaluate_model(model, dataset, len(class_names))
+    elapsed = time.perf_counter() - start
+    print(f"評估 {int(matrix.sum())} 張圖片，耗時 {elapsed:.1f} 秒 "
+          f"({matrix.sum() / elapsed:.1f} images/sec)\n")
+    print_report(metrics, class_names)
+
+    save_report(args.output, metrics, matrix, class_names,
+                model=os.path.basename(args.model), subset=args.subset)
+    print(f"\n已寫入 {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,370 @@
+"""
+將訓練好的 Keras 模型匯出為 CPU 推論用的格式（SavedModel 與 TFLite）
+
+匯出前先整理 Sequential 模型頂層的推論圖：
+- 移除 Dropout（推論時為恆等映射）
+- 將 Rescaling / BatchNormalization 折疊進下一個 Dense 的權重；純量
+  Rescaling 也可折疊進下一個 valid padding 的 Conv2D
+- 將獨立的 Activation 層合併進前一個 Dense / Conv2D
+
+巢狀模型（Xception / MobileNet 基底）內部與非 Sequential 模型不在此整理：
+卷積後的 BatchNormalization 由 TFLite 轉換器與 grappler 在凍結圖上融合。
+
+SavedModel 匯出的是權重已轉為常數的凍結圖；TFLite 轉換器另外會把
+MatMul + BiasAdd + ReLU 融合為單一運算。
+
+用法：
+    python export_model.py export --model network.h5 --output ../exported
+    python export_model.py benchmark --output ../exported --model network.h5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+IMG_SIZE = (224, 224)
+
+
+def _affine_of(layer):
+    """
+    回傳 Rescaling / BatchNormalization 的逐通道仿射係數 (a, b)：y = a * x + b
+    """
+    import tensorflow as tf
+
+    if isinstance(layer, tf.keras.layers.Rescaling):
+        return (np.asarray(layer.scale, np.float32),
+                np.asarray(layer.offset, np.float32))
+
+    params = iter(layer.get_weights())
+    gamma = next(params) if layer.scale else None
+    beta = next(params) if layer.center else None
+    mean, variance = next(params), next(params)
+    gamma = np.ones_like(mean) if gamma is None else gamma
+    beta = np.zeros_like(mean) if beta is None else beta
+    a = gamma / np.sqrt(variance + layer.epsilon)
+    return a, beta - mean * a
+
+
+def _can_fold_into(layer, following):
+    """
+    判斷仿射層能否折疊進下一層
+    """
+    import tensorflow as tf
+
+    if isinstance(layer, tf.keras.layers.BatchNormalization):
+        # 只處理對最後一軸（特徵軸）正規化的 BatchNormalization
+        axis = np.ravel(layer.axis)
+        if len(axis) != 1 or axis[0] not in (-1, len(layer.input.shape) - 1):
+            return False
+    if isinstance(following, tf.keras.layers.Dense):
+        return True
+    if isinstance(following, tf.keras.layers.Conv2D) \
+            and isinstance(layer, tf.keras.layers.Rescaling):
+        # 純量縮放對 valid padding 的卷積是精確折疊
+        return following.padding == 'valid' \
+            and np.ndim(layer.scale) == 0 and np.ndim(layer.offset) == 0
+    return False
+
+
+def _fold(layer, affine):
+    """
+    建立新的 Dense / Conv2D，其權重已吸收前一層的仿射 y = a * x + b
+    """
+    import tensorflow as tf
+
+    a, b = affine
+    config = layer.get_config()
+    weights = layer.get_weights()
+    kernel = weights[0]
+    bias = weights[1] if layer.use_bias else np.zeros(kernel.shape[-1],
+                                                      np.float32)
+    if isinstance(layer, tf.keras.layers.Dense):
+        new_kernel = kernel * np.broadcast_to(a, kernel.shape[:1])[:, None]
+        new_bias = bias + np.broadcast_to(b, kernel.shape[:1]) @ kernel
+    else:
+        new_kernel = kernel * a
+        new_bias = bias + b * kernel.sum(axis=(0, 1, 2))
+
+    config['use_bias'] = True
+    folded = layer.__class__.from_config(config)
+    return folded, [new_kernel.astype(np.float32),
+                    new_bias.astype(np.float32)]
+
+
+def fold_model(model):
+    """
+    將 Sequential 模型的頂層整理為推論用的等價模型
+
+    巢狀的子模型原樣保留；非 Sequential 模型原樣回傳
+    """
+    import tensorflow as tf
+
+    if not isinstance(model, tf.keras.Sequential):
+        return model
+
+    layers = [layer for layer in model.layers
+              if not isinstance(layer, tf.keras.layers.Dropout)]
+    affine_types = (tf.keras.layers.Rescaling,
+                    tf.keras.layers.BatchNormalization)
+
+    new_layers = []     # (layer, weights 或 None 表示沿用原層)
+    pending = None
+    for i, layer in enumerate(layers):
+        following = layers[i + 1] if i + 1 < len(layers) else None
+        if isinstance(layer, affine_types) and pending is None \
+                and following is not None and _can_fold_into(layer, following):
+            pending = _affine_of(layer)
+            continue
+
+        if pending is not None:
+            new_layers.append(_fold(layer, pending))
+            pending = None
+            continue
+
+        previous = new_layers[-1][0] if new_layers else None
+        if isinstance(layer, tf.keras.layers.Activation) \
+                and isinstance(previous, (tf.keras.layers.Dense,
+                                          tf.keras.layers.Conv2D)) \
+                and previous.get_config()['activation'] == 'linear':
+            config = previous.get_config()
+            config['activation'] = layer.get_config()['activation']
+            weights = new_layers[-1][1] or previous.get_weights()
+            new_layers[-1] = (previous.__class__.from_config(config), weights)
+            continue
+
+        new_layers.append((layer, None))
+
+    folded = tf.keras.Sequential(
+        [tf.keras.Input(model.input_shape[1:])]
+        + [layer for layer, _ in new_layers], name=f"{model.name}_folded")
+    for layer, weights in new_layers:
+        if weights is not None:
+            layer.set_weights(weights)
+    return folded
+
+
+def _frozen_function(model, batch_size=None):
+    import tensorflow as tf
+    from tensorflow.python.framework.convert_to_constants import (
+        convert_variables_to_constants_v2,
+    )
+
+    spec = tf.TensorSpec((batch_size, *model.input_shape[1:]), tf.float32,
+                         name='images')
+    concrete = tf.function(
+        lambda images: {'probs': model(images, training=False)}
+    ).get_concrete_function(spec)
+    return convert_variables_to_constants_v2(concrete)
+
+
+def export(model_path, output_dir, verify=True):
+    """
+    匯出凍結的 SavedModel 與 TFLite，回傳兩者路徑
+    """
+    import tensorflow as tf
+
+    model = tf.keras.models.load_model(model_path, compile=False)
+    folded = fold_model(model)
+    print(f"層數: {len(model.layers)} -> {len(folded.layers)}（折疊後）")
+
+    if verify:
+        sample = np.random.default_rng(0).uniform(
+            0, 255, (4, *model.input_shape[1:])).astype(np.float32)
+        diff = np.abs(model(sample, training=False).numpy()
+                      - folded(sample, training=False).numpy()).max()
+        print(f"折疊前後最大輸出差異: {diff:.2e}")
+
+    name = os.path.splitext(os.path.basename(model_path.rstrip('/')))[0]
+    os.makedirs(output_dir, exist_ok=True)
+
+    saved_model_dir = os.path.join(output_dir, f"{name}_savedmodel")
+    frozen = _frozen_function(folded)
+    module = tf.Module()
+    module.serve = frozen
+    tf.saved_model.save(module, saved_model_dir,
+                        signatures={'serving_default': frozen})
+    print(f"已匯出 SavedModel：{saved_model_dir}")
+
+    tflite_path = os.path.join(output_dir, f"{name}.tflite")
+    converter = tf.lite.TFLiteConverter.from_keras_model(folded)
+    with open(tflite_path, 'wb') as f:
+        f.write(converter.convert())
+    print(f"已匯出 TFLite：{tflite_path} "
+          f"({os.path.getsize(tflite_path) / 1024 ** 2:.1f} MB)")
+    return saved_model_dir, tflite_path
+
+
+class TFLitePredictor:
+    """
+    以 TFLite 直譯器執行推論；優先使用輕量的 tflite_runtime
+
+    以 model_path 建立直譯器時，模型檔會以記憶體映射方式載入
+    """
+
+    def __init__(self, path, num_threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite.python.interpreter import Interpreter
+        self.interpreter = Interpreter(
+            model_path=path, num_threads=num_threads or os.cpu_count())
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self._batch_size = None
+
+    def _quantize(self, images):
+        scale, zero_point = self._input['quantization']
+        if self._input['dtype'] == np.float32 or not scale:
+            return images.astype(self._input['dtype'])
+        info = np.iinfo(self._input['dtype'])
+        return np.clip(np.round(images / scale + zero_point),
+                       info.min, info.max).astype(self._input['dtype'])
+
+    def _dequantize(self, outputs):
+        scale, zero_point = self._output['quantization']
+        if self._output['dtype'] == np.float32 or not scale:
+            return outputs.astype(np.float32)
+        return (outputs.astype(np.float32) - zero_point) * scale
+
+    def __call__(self, images):
+        images = np.asarray(images, np.float32)
+        if images.shape[0] != self._batch_size:
+            self.interpreter.resize_tensor_input(self._input['index'],
+                                                 images.shape)
+            self.interpreter.allocate_tensors()
+            self._batch_size = images.shape[0]
+        self.interpreter.set_tensor(self._input['index'],
+                                    self._quantize(images))
+        self.interpreter.invoke()
+        return self._dequantize(
+            self.interpreter.get_tensor(self._output['index']))
+
+
+class SavedModelPredictor:
+    """
+    直接載入凍結的 SavedModel 簽章，不重建 Keras 模型
+    """
+
+    def __init__(self, path):
+        import tensorflow as tf
+
+        self._tf = tf
+        self._loaded = tf.saved_model.load(path)
+        self._serve = self._loaded.signatures['serving_default']
+
+    def __call__(self, images):
+        images = self._tf.convert_to_tensor(np.asarray(images, np.float32))
+        # 凍結後輸出名稱不一定保留，模型只有單一輸出
+        outputs = self._serve(images=images)
+        return next(iter(outputs.values())).numpy()
+
+
+class KerasPredictor:
+    """
+    原本的 .h5 載入方式（作為比較基準）
+    """
+
+    def __init__(self, path):
+        import tensorflow as tf
+
+        self.model = tf.keras.models.load_model(path, compile=False)
+
+    def __call__(self, images):
+        return self.model(np.asarray(images, np.float32),
+                          training=False).numpy()
+
+
+def load_predictor(path):
+    """
+    依副檔名選擇最輕量的執行環境，回傳 predict(images) -> probs 的可呼叫物件
+    """
+    if path.endswith('.tflite'):
+        return TFLitePredictor(path)
+    if os.path.isdir(path) and os.path.exists(
+            os.path.join(path, 'saved_model.pb')):
+        return SavedModelPredictor(path)
+    return KerasPredictor(path)
+
+
+def _peak_rss_mb():
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 單位為 KB，macOS 為 bytes
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def measure_one(path, repeats=50):
+    """
+    在目前（全新）的行程中量測冷啟動時間、記憶體與單張延遲
+    """
+    start = time.perf_counter()
+    predictor = load_predictor(path)
+    image = np.random.default_rng(0).uniform(
+        0, 255, (1, *IMG_SIZE, 3)).astype(np.float32)
+    predictor(image)
+    cold_start = time.perf_counter() - start
+
+    latencies = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        predictor(image)
+        latencies.append((time.perf_counter() - t) * 1000)
+    return {
+        'path': path,
+        'cold_start_sec': round(cold_start, 3),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+        'latency_ms_p50': round(float(np.percentile(latencies, 50)), 3),
+        'latency_ms_p95': round(float(np.percentile(latencies, 95)), 3),
+    }
+
+
+def benchmark(paths, repeats=50):
+    """
+    每個格式在獨立的子行程中量測，確保冷啟動時間與記憶體不受彼此影響
+    """
+    results = []
+    for path in paths:
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), 'measure-one',
+             '--path', path, '--repeats', str(repeats)],
+            capture_output=True, text=True, check=True)
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    print(f"{'格式':<40s} {'冷啟動(s)':>10s} {'記憶體(MB)':>11s} "
+          f"{'p50(ms)':>9s} {'p95(ms)':>9s}")
+    for r in results:
+        print(f"{os.path.basename(r['path'].rstrip('/')):<40s} "
+              f"{r['cold_start_sec']:>10.3f} {r['peak_rss_mb']:>11.1f} "
+              f"{r['latency_ms_p50']:>9.3f} {r['latency_ms_p95']:>9.3f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='匯出 CPU 推論用模型')
+    parser.add_argument('command', choices=['export', 'benchmark',
+                                            'measure-one'])
+    parser.add_argument('--model', help='訓練好的 Keras 模型（.h5）')
+    parser.add_argument('--output', default='../exported')
+    parser.add_argument('--path', help='measure-one 使用的模型路徑')
+    parser.add_argument('--repeats', type=int, default=50)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export(args.model, args.output)
+    elif args.command == 'measure-one':
+        print(json.dumps(measure_one(args.path, args.repeats)))
+    else:
+        name = os.path.splitext(os.path.basename(args.model))[0]
+        benchmark([args.model,
+                   os.path.join(args.output, f"{name}_savedmodel"),
+                   os.path.join(args.output, f"{name}.tflite")],
+                  args.repeats)
+
+
+if __name__ == '__main__':
+    main()
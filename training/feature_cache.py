@@ -0,0 +1,356 @@
+"""
+凍結骨幹的特徵快取，讓只訓練 Dense 分類頭與超參數搜尋在數秒內完成
+
+骨幹（Xception 或 MobileNet）對每個資料集只執行一次前向傳播，池化後的特徵
+（Xception 2048 維、MobileNet 1024 維）以 float16 存入記憶體映射檔，
+以「類別/檔名 + 模型雜湊」為鍵，骨幹權重變動時自動使用新的快取。
+
+注意：快取的是未經資料增強的特徵，適用於骨幹完全凍結的情境。
+
+用法：
+    python feature_cache.py extract --backbone xception
+    python feature_cache.py train --backbone xception --epochs 20
+    python feature_cache.py sweep --backbone mobilenet
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from data_pipeline import (
+    AUTOTUNE,
+    IMG_SIZE,
+    SEED,
+    create_dataframe,
+    find_data_dir,
+    get_class_names,
+    load_image,
+)
+from dataset_index import relpath
+from dataset_splits import split_frames
+from evaluation import evaluate_predictions
+
+# 每個骨幹的預設分類頭（與對應 notebook 相同）
+BACKBONES = {
+    'xception': {
+        'units': (256,),
+        'batch_norm': True,
+        'dropout': 0.5,
+    },
+    'mobilenet': {
+        'units': (1024, 1024, 512),
+        'batch_norm': False,
+        'dropout': 0.0,
+    },
+}
+
+SWEEP_GRID = {
+    'lr': (1e-3, 3e-4),
+    'units': ((256,), (512,), (1024, 1024, 512)),
+    'dropout': (0.3, 0.5),
+}
+
+
+def build_backbone(name, image_size=IMG_SIZE, weights='imagenet'):
+    """
+    建立凍結的骨幹，輸出池化後的特徵向量
+    """
+    input_shape = (*image_size, 3)
+    if name == 'xception':
+        backbone = tf.keras.applications.xception.Xception(
+            weights=weights, include_top=False, input_shape=input_shape,
+            pooling='max')
+    elif name == 'mobilenet':
+        backbone = tf.keras.applications.MobileNet(
+            weights=weights, include_top=False, input_shape=input_shape,
+            pooling='avg')
+    else:
+        raise ValueError(f"不支援的骨幹: {name}")
+    backbone.trainable = False
+    return backbone
+
+
+def preprocess(name, images):
+    """
+    骨幹的輸入前處理：Xception 沿用 99-5 notebook 的 rescale=1/255，
+    MobileNet 沿用 preprocess_input
+    """
+    if name == 'xception':
+        return images / 255.0
+    return tf.keras.applications.mobilenet.preprocess_input(images)
+
+
+def model_hash(name, backbone):
+    """
+    以骨幹名稱、輸入大小與所有權重內容計算模型雜湊
+    """
+    digest = hashlib.sha1(f"{name}:{backbone.input_shape}".encode())
+    for weight in backbone.weights:
+        digest.update(np.ascontiguousarray(weight.numpy()).tobytes())
+    return digest.hexdigest()
+
+
+def default_cache_dir(data_dir):
+    return os.path.join(os.path.dirname(os.path.abspath(data_dir)), 'cache',
+                        'features')
+
+
+class FeatureCache:
+    """
+    以「類別/檔名」為鍵的特徵矩陣（N, dim），float16 記憶體映射
+
+    快取放在資料集旁的絕對路徑，鍵不含 --data-dir 的寫法，
+    從任何工作目錄執行都能命中同一份快取
+    """
+
+    def __init__(self, array_path, meta):
+        self.array_path = array_path
+        self.meta = meta
+        self.features = np.load(array_path, mmap_mode='r')
+        self.relpaths = meta['relpaths']
+        self._row_of = {p: i for i, p in enumerate(self.relpaths)}
+
+    def __len__(self):
+        return len(self.relpaths)
+
+    def missing(self, filepaths):
+        return [p for p in filepaths if relpath(p) not in self._row_of]
+
+    def rows_for(self, filepaths):
+        return np.array([self._row_of[relpath(p)] for p in filepaths],
+                        dtype=np.int64)
+
+    def lookup(self, filepaths):
+        """
+        取出指定路徑的特徵（依索引排序讀取後還原原本順序）
+        """
+        rows = self.rows_for(filepaths)
+        order = np.argsort(rows)
+        features = np.empty((len(rows), self.features.shape[1]), np.float32)
+        features[order] = self.features[rows[order]]
+        return features
+
+
+def _cache_paths(cache_dir, name, digest):
+    base = os.path.join(cache_dir, f"{name}_{digest[:12]}")
+    return base + '.npy', base + '.json'
+
+
+def open_feature_cache(cache_dir, name, digest):
+    array_path, meta_path = _cache_paths(cache_dir, name, digest)
+    if not (os.path.exists(array_path) and os.path.exists(meta_path)):
+        return None
+    with open(meta_path, encoding='utf-8') as f:
+        meta = json.load(f)
+    if 'relpaths' not in meta:
+        # 舊版快取以工作目錄相對路徑為鍵，重新萃取
+        return None
+    return FeatureCache(array_path, meta)
+
+
+def embed_images(name, backbone, filepaths, batch_size=64):
+    """
+    以骨幹萃取圖片的池化特徵，回傳 float16 矩陣（N, dim）
+    """
+    forward = tf.function(lambda x: backbone(preprocess(name, x),
+                                             training=False))
+    ds = tf.data.Dataset.from_tensor_slices(filepaths)
+    ds = ds.map(lambda p: load_image(p, backbone.input_shape[1:3]),
+                num_parallel_calls=AUTOTUNE, deterministic=True)
+    ds = ds.batch(batch_size).prefetch(AUTOTUNE)
+    chunks = []
+    for i, images in enumerate(ds):
+        chunks.append(forward(images).numpy().astype(np.float16))
+        if (i + 1) % 100 == 0:
+            print(f"  已萃取 {(i + 1) * batch_size}/{len(filepaths)}")
+    dim = backbone.output_shape[-1]
+    return np.concatenate(chunks) if chunks else np.zeros((0, dim),
+                                                           np.float16)
+
+
+def extract_features(name, filepaths, cache_dir, backbone=None,
+                     batch_size=64):
+    """
+    對尚未快取的檔案執行骨幹前向傳播並寫入快取，回傳 FeatureCache
+
+    已存在的列直接沿用，只計算新增的檔案
+    """
+    backbone = backbone or build_backbone(name)
+    digest = model_hash(name, backbone)
+    os.makedirs(cache_dir, exist_ok=True)
+    cache = open_feature_cache(cache_dir, name, digest)
+
+    filepaths = [str(p) for p in filepaths]
+    todo = cache.missing(filepaths) if cache else filepaths
+    if not todo:
+        print(f"特徵快取命中：{len(filepaths)} 筆（模型雜湊 {digest[:12]}）")
+        return cache
+
+    print(f"萃取 {len(todo)} 張圖片的 {name} 特徵...")
+    start = time.perf_counter()
+    new_features = embed_images(name, backbone, todo, batch_size)
+
+    old_paths = cache.relpaths if cache else []
+    dim = new_features.shape[1]
+    array_path, meta_path = _cache_paths(cache_dir, name, digest)
+    tmp_path = array_path + '.tmp.npy'
+    merged = np.lib.format.open_memmap(
+        tmp_path, mode='w+', dtype=np.float16,
+        shape=(len(old_paths) + len(todo), dim))
+    if cache:
+        merged[:len(old_paths)] = cache.features
+    merged[len(old_paths):] = new_features
+    merged.flush()
+    del merged, cache
+    os.replace(tmp_path, array_path)
+
+    meta = {'backbone': name, 'model_hash': digest, 'dim': dim,
+            'relpaths': old_paths + [relpath(p) for p in todo]}
+    with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(meta_path + '.tmp', meta_path)
+    print(f"特徵萃取完成，耗時 {time.perf_counter() - start:.1f} 秒")
+    return FeatureCache(array_path, meta)
+
+
+def build_head(dim, num_classes, units=(256,), dropout=0.5, batch_norm=True):
+    """
+    建立 Dense 分類頭（輸入為池化特徵）
+    """
+    layers = [tf.keras.Input((dim,))]
+    if batch_norm:
+        layers.append(tf.keras.layers.BatchNormalization())
+    for n in units:
+        layers.append(tf.keras.layers.Dense(n, activation='relu'))
+        if dropout:
+            layers.append(tf.keras.layers.Dropout(dropout))
+    layers.append(tf.keras.layers.Dense(num_classes, activation='softmax'))
+    return tf.keras.Sequential(layers, name='head')
+
+
+def _labels(df, class_names):
+    class_index = {name: i for i, name in enumerate(class_names)}
+    return df['Labels'].map(class_index).values.astype(np.int32)
+
+
+def fit_head(x_train, y_train, x_valid, y_valid, num_classes, units=(256,),
+             dropout=0.5, batch_norm=True, lr=1e-3, epochs=20,
+             batch_size=256, verbose=1):
+    """
+    以特徵矩陣與整數標籤訓練分類頭；驗證集為空時改以訓練損失早停
+    """
+    head = build_head(x_train.shape[1], num_classes, units, dropout,
+                      batch_norm)
+    head.compile(tf.keras.optimizers.Adamax(learning_rate=lr),
+                 loss='sparse_categorical_crossentropy',
+                 metrics=['accuracy'])
+    validation = (x_valid, y_valid) if len(x_valid) else None
+    head.fit(x_train, y_train, validation_data=validation,
+             epochs=epochs, batch_size=batch_size, verbose=verbose,
+             callbacks=[tf.keras.callbacks.EarlyStopping(
+                 monitor='val_loss' if validation else 'loss', patience=3,
+                 restore_best_weights=True)])
+    return head
+
+
+def train_head(cache, train_df, valid_df, class_names, units=(256,),
+               dropout=0.5, batch_norm=True, lr=1e-3, epochs=20,
+               batch_size=256, seed=SEED, verbose=1):
+    """
+    以快取特徵訓練分類頭，回傳 (head, 驗證集 macro F1)
+    """
+    tf.keras.utils.set_random_seed(seed)
+    x_valid = cache.lookup(valid_df['Filepaths'])
+    y_valid = _labels(valid_df, class_names)
+    head = fit_head(cache.lookup(train_df['Filepaths']),
+                    _labels(train_df, class_names), x_valid, y_valid,
+                    len(class_names), units, dropout, batch_norm, lr, epochs,
+                    batch_size, verbose)
+
+    y_pred = np.argmax(head.predict(x_valid, batch_size=1024, verbose=0),
+                       axis=1)
+    metrics, _ = evaluate_predictions(y_valid, y_pred, len(class_names))
+    return head, metrics['macro_f1']
+
+
+def sweep(cache, train_df, valid_df, class_names, grid=SWEEP_GRID,
+          epochs=20, batch_norm=True):
+    """
+    對分類頭進行網格搜尋，依驗證集 macro F1 排序
+    """
+    results = []
+    keys = list(grid)
+    for values in itertools.product(*(grid[k] for k in keys)):
+        params = dict(zip(keys, values))
+        start = time.perf_counter()
+        _, macro_f1 = train_head(cache, train_df, valid_df, class_names,
+                                 epochs=epochs, batch_norm=batch_norm,
+                                 verbose=0, **params)
+        params.update(macro_f1=macro_f1,
+                      seconds=time.perf_counter() - start)
+        results.append(params)
+        print(f"lr={params['lr']:<8g} units={str(params['units']):<18s} "
+              f"dropout={params['dropout']:<4g} macro F1={macro_f1:.4f} "
+              f"({params['seconds']:.1f} 秒)")
+    return sorted(results, key=lambda r: -r['macro_f1'])
+
+
+def assemble_model(backbone, head):
+    """
+    將骨幹與訓練好的分類頭組合為完整模型（輸入需先經 preprocess 前處理）
+    """
+    return tf.keras.Sequential([backbone, head])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='凍結骨幹特徵快取')
+    parser.add_argument('command', choices=['extract', 'train', 'sweep'])
+    parser.add_argument('--backbone', choices=list(BACKBONES),
+                        default='xception')
+    parser.add_argument('--data-dir', default=find_data_dir())
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--split', default=None,
+                        help='dataset_splits 的切分名稱（預設同 notebook）')
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--output', default=None,
+                        help='train 完成後儲存完整模型的路徑（.h5）')
+    args = parser.parse_args()
+
+    cache_dir = args.cache_dir or default_cache_dir(args.data_dir)
+    df = create_dataframe(args.data_dir)
+    train_df, valid_df, _ = split_frames(args.data_dir, args.split)
+    class_names = get_class_names(train_df)
+    config = BACKBONES[args.backbone]
+
+    backbone = build_backbone(args.backbone)
+    cache = extract_features(args.backbone, df['Filepaths'], cache_dir,
+                             backbone)
+    if args.command == 'train':
+        head, macro_f1 = train_head(
+            cache, train_df, valid_df, class_names, units=config['units'],
+            dropout=config['dropout'], batch_norm=config['batch_norm'],
+            lr=args.lr, epochs=args.epochs)
+        print(f"驗證集 macro F1: {macro_f1:.4f}")
+        if args.output:
+            assemble_model(backbone, head).save(args.output)
+            print(f"已儲存完整模型：{args.output}")
+    elif args.command == 'sweep':
+        results = sweep(cache, train_df, valid_df, class_names,
+                        epochs=args.epochs,
+                        batch_norm=config['batch_norm'])
+        path = os.path.join(cache_dir, f"{args.backbone}_sweep.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        best = results[0]
+        print(f"\n最佳設定: lr={best['lr']} units={best['units']} "
+              f"dropout={best['dropout']} macro F1={best['macro_f1']:.4f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,9 @@ import os
 import random
 import matplotlib.pyplot as plt
 import matplotlib.font_manager as fm
-from PIL import Image
 import numpy as np
+from dataset_index import load_index
+from thumbnails import open_thumbnails
 
 # 設置中文字體
 font_path = r'C:\Windows\Fonts\msyh.ttc'
@@ -31,36 +32,30 @@ def get_all_category_samples(data_dir):
         print(f"警告：找不到資料集路徑 {data_dir}")
         return None
     
-    # 獲取所有類別資料夾並排序
-    class_folders = [f for f in os.listdir(data_dir) 
-                     if os.path.isdir(os.path.join(data_dir, f))]
-    class_folders.sort()
+    # 從資料集索引取得已排序的類別與圖片清單
+    index = load_index(data_dir)
     
-    print(f"找到 {len(class_folders)} 個類別")
+    print(f"找到 {len(index.class_names)} 個類別")
     
-    for class_name in class_folders:
-        class_path = os.path.join(data_dir, class_name)
-        image_files = [f for f in os.listdir(class_path) 
-                      if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
+    selected = []
+    for class_name in index.class_names:
+        image_files = index.class_files(class_name)
         
         if image_files:
             # 每個類別選取1張圖片
-            img_file = random.choice(image_files)
-            img_path = os.path.join(class_path, img_file)
-            try:
-                img = Image.open(img_path)
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                # 調整大小
-                img = img.resize((200, 200), Image.Resampling.LANCZOS)
-                samples.append((img, class_name))
-                print(f"已載入: {class_name}")
-            except Exception as e:
-                print(f"無法載入圖片 {img_path}: {e}")
-                continue
+            selected.append((random.choice(image_files), class_name))
         else:
             print(f"警告：{class_name} 資料夾中沒有圖片文件")
     
+    # 一次取得所有 200x200 縮圖，未快取的以行程池平行產生
+    # 縮圖快取：重複執行時直接讀取已縮放的圖片
+    images = open_thumbnails(data_dir).get_many(
+        [img_path for img_path, _ in selected], (200, 200))
+    for img, (_, class_name) in zip(images, selected):
+        if img is not None:
+            samples.append((img, class_name))
+            print(f"已載入: {class_name}")
+    
     return samples
 
 def create_all_categories_grid(samples, cols=6, save_path="all_categories_grid.png"):
@@ -211,27 +206,29 @@ def create_categories_by_plant(samples, save_path="categories_by_plant.png"):
     plt.close()
     print(f"已生成：{save_path}")
 
-# 設置隨機種子
-random.seed(42)
-np.random.seed(42)
+# 行程池在 Windows 以 spawn 啟動子行程，主程式需放在 __main__ 判斷內
+if __name__ == '__main__':
+    # 設置隨機種子
+    random.seed(42)
+    np.random.seed(42)
 
-print("開始生成所有類別的植物圖片展示...")
-print(f"資料集路徑: {data_dir}\n")
+    print("開始生成所有類別的植物圖片展示...")
+    print(f"資料集路徑: {data_dir}\n")
 
-# 獲取所有類別的樣本
-samples = get_all_category_samples(data_dir)
+    # 獲取所有類別的樣本
+    samples = get_all_category_samples(data_dir)
 
-if samples:
-    print(f"\n成功載入 {len(samples)} 個類別的圖片")
-    
-    # 1. 生成所有類別的網格圖（6列布局）
-    create_all_categories_grid(samples, cols=6, save_path="all_categories_grid.png")
-    
-    # 2. 按植物種類分組展示（可選，如果圖片太多可能太大）
-    # create_categories_by_plant(samples, save_path="categories_by_plant.png")
-    
-    print("\n所有類別圖片展示已生成完成！")
-else:
-    print("\n無法載入圖片，請檢查資料集路徑")
+    if samples:
+        print(f"\n成功載入 {len(samples)} 個類別的圖片")
+
+        # 1. 生成所有類別的網格圖（6列布局）
+        create_all_categories_grid(samples, cols=6,
+                                   save_path="all_categories_grid.png")
 
+        # 2. 按植物種類分組展示（可選，如果圖片太多可能太大）
+        # create_categories_by_plant(samples,
+        #                            save_path="categories_by_plant.png")
 
+        print("\n所有類別圖片展示已生成完成！")
+    else:
+        print("\n無法載入圖片，請檢查資料集路徑")
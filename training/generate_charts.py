@@ -1,10 +1,14 @@
 """
 生成測試報告所需的視覺化圖表
 """
+import os
+
 import matplotlib.pyplot as plt
 import matplotlib.font_manager as fm
 import numpy as np
 import seaborn as sns
+from evaluation import DEFAULT_REPORT, load_report
+from metrics_log import DEFAULT_RUNS, history, latest_run, read_run
 
 # 設置中文字體 - 使用Microsoft YaHei字體文件
 font_path = r'C:\Windows\Fonts\msyh.ttc'
@@ -24,30 +28,57 @@ except Exception as e:
 
 sns.set_style('darkgrid')
 
-# 訓練歷史數據（從notebook中提取）
-epochs = list(range(1, 40))
-train_loss = [2.878, 0.523, 0.376, 0.290, 0.253, 0.226, 0.204, 0.192, 0.181, 0.173,
-              0.165, 0.157, 0.153, 0.150, 0.148, 0.146, 0.144, 0.142, 0.141, 0.140,
-              0.139, 0.138, 0.137, 0.136, 0.135, 0.135, 0.135, 0.134, 0.135, 0.134,
-              0.135, 0.135, 0.134, 0.134, 0.134, 0.134, 0.133, 0.135, 0.134]
-
-val_loss = [428.41302, 4.20610, 4.62913, 2.90544, 0.59972, 0.68461, 0.38314, 0.21302, 
-            0.19146, 0.18170, 0.38154, 0.14190, 0.14394, 0.13612, 0.13474, 0.13453, 
-            0.12963, 0.13093, 0.12729, 0.12689, 0.12525, 0.12419, 0.12521, 0.12304, 
-            0.12305, 0.12279, 0.12274, 0.12201, 0.12194, 0.12202, 0.12192, 0.12166, 
-            0.12170, 0.12160, 0.12131, 0.12126, 0.12137, 0.12127, 0.12130]
-
-train_acc = [0.9021, 0.97636, 0.98458, 0.99247, 0.99436, 0.99583, 0.99717, 0.99733, 
-             0.99816, 0.99784, 0.99818, 0.99871, 0.99862, 0.99869, 0.99899, 0.99915, 
-             0.99899, 0.99885, 0.99919, 0.99915, 0.99915, 0.99936, 0.99931, 0.99919, 
-             0.99926, 0.99926, 0.99940, 0.99942, 0.99929, 0.99936, 0.99917, 0.99919, 
-             0.99949, 0.99924, 0.99933, 0.99917, 0.99922, 0.99929, 0.99908]
-
-val_acc = [0.07293, 0.05396, 0.17109, 0.38011, 0.90258, 0.87403, 0.94180, 0.98582, 
-           0.99061, 0.98969, 0.94549, 0.99779, 0.99687, 0.99816, 0.99797, 0.99742, 
-           0.99871, 0.99779, 0.99853, 0.99871, 0.99853, 0.99926, 0.99834, 0.99890, 
-           0.99908, 0.99890, 0.99890, 0.99926, 0.99908, 0.99890, 0.99908, 0.99908, 
-           0.99926, 0.99908, 0.99926, 0.99908, 0.99908, 0.99908, 0.99908]
+# 若已執行 evaluation.py，混淆矩陣與 F1 分布改用實際測試集結果
+report = load_report()
+if report is not None:
+    print(f"使用評估結果: {DEFAULT_REPORT}")
+
+def display_name(class_name):
+    return class_name.replace('___', ' - ').replace('_', ' ')
+
+# 訓練歷史：讀取 train.py 最新一次執行的指標記錄（metrics_log.py）
+run = latest_run()
+run_history = history(read_run(os.path.join(DEFAULT_RUNS, run))) \
+    if run is not None else None
+if run_history is not None and len(run_history['epoch']):
+    print(f"使用訓練記錄: {run}")
+    epochs = run_history['epoch'].tolist()
+    train_loss = run_history['loss'].tolist()
+    val_loss = run_history['val_loss'].tolist()
+    train_acc = run_history['accuracy'].tolist()
+    val_acc = run_history['val_accuracy'].tolist()
+else:
+    # 尚無訓練記錄時使用 notebook 的訓練歷史
+    epochs = list(range(1, 40))
+    train_loss = [2.878, 0.523, 0.376, 0.290, 0.253, 0.226, 0.204, 0.192,
+                  0.181, 0.173, 0.165, 0.157, 0.153, 0.150, 0.148, 0.146,
+                  0.144, 0.142, 0.141, 0.140, 0.139, 0.138, 0.137, 0.136,
+                  0.135, 0.135, 0.135, 0.134, 0.135, 0.134, 0.135, 0.135,
+                  0.134, 0.134, 0.134, 0.134, 0.133, 0.135, 0.134]
+
+    val_loss = [428.41302, 4.20610, 4.62913, 2.90544, 0.59972, 0.68461,
+                0.38314, 0.21302, 0.19146, 0.18170, 0.38154, 0.14190,
+                0.14394, 0.13612, 0.13474, 0.13453, 0.12963, 0.13093,
+                0.12729, 0.12689, 0.12525, 0.12419, 0.12521, 0.12304,
+                0.12305, 0.12279, 0.12274, 0.12201, 0.12194, 0.12202,
+                0.12192, 0.12166, 0.12170, 0.12160, 0.12131, 0.12126,
+                0.12137, 0.12127, 0.12130]
+
+    train_acc = [0.9021, 0.97636, 0.98458, 0.99247, 0.99436, 0.99583,
+                 0.99717, 0.99733, 0.99816, 0.99784, 0.99818, 0.99871,
+                 0.99862, 0.99869, 0.99899, 0.99915, 0.99899, 0.99885,
+                 0.99919, 0.99915, 0.99915, 0.99936, 0.99931, 0.99919,
+                 0.99926, 0.99926, 0.99940, 0.99942, 0.99929, 0.99936,
+                 0.99917, 0.99919, 0.99949, 0.99924, 0.99933, 0.99917,
+                 0.99922, 0.99929, 0.99908]
+
+    val_acc = [0.07293, 0.05396, 0.17109, 0.38011, 0.90258, 0.87403,
+               0.94180, 0.98582, 0.99061, 0.98969, 0.94549, 0.99779,
+               0.99687, 0.99816, 0.99797, 0.99742, 0.99871, 0.99779,
+               0.99853, 0.99871, 0.99853, 0.99926, 0.99834, 0.99890,
+               0.99908, 0.99890, 0.99890, 0.99926, 0.99908, 0.99890,
+               0.99908, 0.99908, 0.99926, 0.99908, 0.99926, 0.99908,
+               0.99908, 0.99908, 0.99908]
 
 # 找到最佳epoch
 index_loss = np.argmin(val_loss)
@@ -85,36 +116,47 @@ plt.savefig('training_history.png', dpi=300, bbox_inches='tight')
 plt.close()
 print("已生成：training_history.png")
 
-# 2. 生成簡化的混淆矩陣（基於分類報告數據）
-# 這裡使用模擬數據來展示前20個類別
-class_names_short = ['Apple_scab', 'Apple_Black_rot', 'Apple_Cedar_rust', 
-                     'Apple_healthy', 'Blueberry_healthy', 'Cherry_Powdery',
-                     'Cherry_healthy', 'Corn_Cercospora', 'Corn_Common_rust',
-                     'Corn_Northern_Blight', 'Corn_healthy', 'Grape_Black_rot',
-                     'Grape_Esca', 'Grape_Leaf_blight', 'Grape_healthy',
-                     'Orange_Haunglongbing', 'Peach_Bacterial', 'Peach_healthy',
-                     'Pepper_Bacterial', 'Pepper_healthy']
-
-# 創建一個接近完美的混淆矩陣（大部分在對角線上）
-n_classes = 20
-cm = np.eye(n_classes) * 100  # 對角線元素設為100
-# 添加少量隨機誤分類（0-3個）
-np.random.seed(42)
-for i in range(n_classes):
-    # 每個類別有少量誤分類
-    for j in range(n_classes):
-        if i != j and np.random.random() < 0.02:  # 2%的概率有誤分類
-            cm[i, j] = np.random.randint(1, 3)
-            cm[i, i] -= cm[i, j]  # 從對角線減去誤分類數量
+# 2. 生成混淆矩陣
+if report is not None:
+    cm = report['confusion']
+    class_names_short = [display_name(name) for name in report['class_names']]
+    n_classes = len(class_names_short)
+    cm_title = f'混淆矩陣（測試集，{n_classes}個類別）'
+else:
+    # 沒有評估結果時使用模擬數據來展示前20個類別
+    class_names_short = ['Apple_scab', 'Apple_Black_rot', 'Apple_Cedar_rust',
+                         'Apple_healthy', 'Blueberry_healthy',
+                         'Cherry_Powdery', 'Cherry_healthy',
+                         'Corn_Cercospora', 'Corn_Common_rust',
+                         'Corn_Northern_Blight', 'Corn_healthy',
+                         'Grape_Black_rot', 'Grape_Esca', 'Grape_Leaf_blight',
+                         'Grape_healthy', 'Orange_Haunglongbing',
+                         'Peach_Bacterial', 'Peach_healthy',
+                         'Pepper_Bacterial', 'Pepper_healthy']
+
+    # 創建一個接近完美的混淆矩陣（大部分在對角線上）
+    n_classes = 20
+    cm = np.eye(n_classes) * 100  # 對角線元素設為100
+    # 添加少量隨機誤分類（0-3個）
+    np.random.seed(42)
+    for i in range(n_classes):
+        # 每個類別有少量誤分類
+        for j in range(n_classes):
+            if i != j and np.random.random() < 0.02:  # 2%的概率有誤分類
+                cm[i, j] = np.random.randint(1, 3)
+                cm[i, i] -= cm[i, j]  # 從對角線減去誤分類數量
+    cm_title = '混淆矩陣（前20個類別）'
 
 # 繪製混淆矩陣
-plt.figure(figsize=(14, 12))
+plt.figure(figsize=(14, 12) if n_classes <= 20 else (24, 21))
 # 設置seaborn使用中文字體
 sns.set(font=chinese_font.get_name())
 heatmap = sns.heatmap(cm, annot=True, fmt='.0f', cmap='Blues', 
                       xticklabels=class_names_short, yticklabels=class_names_short,
-                      cbar_kws={'label': '樣本數'}, linewidths=0.5)
-plt.title('混淆矩陣（前20個類別）', fontsize=16, fontweight='bold', pad=20, fontproperties=chinese_font)
+                      cbar_kws={'label': '樣本數'}, linewidths=0.5,
+                      annot_kws={'size': 10 if n_classes <= 20 else 7})
+plt.title(cm_title, fontsize=16, fontweight='bold', pad=20,
+          fontproperties=chinese_font)
 plt.ylabel('真實標籤', fontsize=12, fontproperties=chinese_font)
 plt.xlabel('預測標籤', fontsize=12, fontproperties=chinese_font)
 # 設置colorbar標籤字體
@@ -168,18 +210,27 @@ plt.close()
 print("已生成：performance_comparison.png")
 
 # 4. 生成類別準確率分布圖（基於分類報告中的樣本數和F1分數）
-# 選擇部分代表性類別進行展示
-top_classes = ['Apple_scab', 'Apple_Black_rot', 'Corn_Cercospora', 'Corn_Northern',
-               'Grape_Black_rot', 'Orange_Haunglongbing', 'Tomato_Early_blight',
-               'Tomato_Late_blight', 'Tomato_Septoria', 'Tomato_Target']
-f1_scores = [1.00, 1.00, 0.96, 0.98, 1.00, 1.00, 0.99, 1.00, 1.00, 0.99]
-
-plt.figure(figsize=(12, 6))
+if report is not None:
+    # 所有類別依 F1 排列，F1 最低的類別在最上方
+    order = np.argsort(report['f1'])[::-1]
+    top_classes = [display_name(report['class_names'][i]) for i in order]
+    f1_scores = report['f1'][order].tolist()
+    f1_title = '各類別F1分數分布（測試集）'
+else:
+    # 選擇部分代表性類別進行展示
+    top_classes = ['Apple_scab', 'Apple_Black_rot', 'Corn_Cercospora',
+                   'Corn_Northern', 'Grape_Black_rot', 'Orange_Haunglongbing',
+                   'Tomato_Early_blight',
+                   'Tomato_Late_blight', 'Tomato_Septoria', 'Tomato_Target']
+    f1_scores = [1.00, 1.00, 0.96, 0.98, 1.00, 1.00, 0.99, 1.00, 1.00, 0.99]
+    f1_title = '代表性類別F1分數分布'
+
+plt.figure(figsize=(12, max(6, len(top_classes) * 0.3)))
 colors = ['#4ecdc4' if score >= 0.99 else '#ffa07a' for score in f1_scores]
 bars = plt.barh(top_classes, f1_scores, color=colors, alpha=0.8)
 plt.xlabel('F1 Score', fontsize=12, fontproperties=chinese_font)
-plt.title('代表性類別F1分數分布', fontsize=14, fontweight='bold', fontproperties=chinese_font)
-plt.xlim(0.94, 1.01)
+plt.title(f1_title, fontsize=14, fontweight='bold', fontproperties=chinese_font)
+plt.xlim(min(0.94, min(f1_scores) - 0.02), 1.01)
 for i, (bar, score) in enumerate(zip(bars, f1_scores)):
     width = bar.get_width()
     plt.text(width, bar.get_y() + bar.get_height()/2., 
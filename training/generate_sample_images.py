@@ -5,8 +5,9 @@ import os
 import random
 import matplotlib.pyplot as plt
 import matplotlib.font_manager as fm
-from PIL import Image
 import numpy as np
+from dataset_index import load_index
+from thumbnails import open_thumbnails
 
 # 設置中文字體
 font_path = r'C:\Windows\Fonts\msyh.ttc'
@@ -33,36 +34,29 @@ def get_sample_images(data_dir, num_classes=12, images_per_class=1):
         print("將創建占位圖像")
         return None
     
-    # 獲取所有類別資料夾
-    class_folders = [f for f in os.listdir(data_dir) 
-                     if os.path.isdir(os.path.join(data_dir, f))]
-    class_folders.sort()
+    # 從資料集索引取得已排序的類別與圖片清單
+    index = load_index(data_dir)
     
     # 選擇前num_classes個類別，並確保包含健康和多種病害類型
-    selected_classes = class_folders[:num_classes]
+    selected_classes = index.class_names[:num_classes]
     
+    selected = []
     for class_name in selected_classes:
-        class_path = os.path.join(data_dir, class_name)
-        image_files = [f for f in os.listdir(class_path) 
-                      if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
+        image_files = index.class_files(class_name)
         
         if image_files:
             # 隨機選擇images_per_class張圖片
             selected_images = random.sample(image_files, min(images_per_class, len(image_files)))
-            
-            for img_file in selected_images:
-                img_path = os.path.join(class_path, img_file)
-                try:
-                    img = Image.open(img_path)
-                    # 轉換為RGB（處理RGBA等格式）
-                    if img.mode != 'RGB':
-                        img = img.convert('RGB')
-                    # 調整大小以便展示（統一尺寸）
-                    img = img.resize((224, 224), Image.Resampling.LANCZOS)
-                    samples.append((img, class_name))
-                except Exception as e:
-                    print(f"無法載入圖片 {img_path}: {e}")
-                    continue
+            selected.extend((img_path, class_name)
+                            for img_path in selected_images)
+    
+    # 一次取得所有縮圖（統一 224x224，未快取的以行程池平行產生）
+    # 縮圖快取：重複執行時直接讀取已縮放的圖片
+    images = open_thumbnails(data_dir).get_many(
+        [img_path for img_path, _ in selected], (224, 224))
+    for img, (_, class_name) in zip(images, selected):
+        if img is not None:
+            samples.append((img, class_name))
     
     return samples
 
@@ -141,26 +135,21 @@ def create_category_comparison(data_dir, categories=None, save_path="category_co
         ]
     
     samples = []
+    index = load_index(data_dir)
+    selected = []
     for class_name in categories:
-        class_path = os.path.join(data_dir, class_name)
-        if not os.path.exists(class_path):
-            continue
-        
-        image_files = [f for f in os.listdir(class_path) 
-                      if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
+        # 不存在的類別回傳空清單
+        image_files = index.class_files(class_name)
         
         if image_files:
-            img_file = random.choice(image_files)
-            img_path = os.path.join(class_path, img_file)
-            try:
-                img = Image.open(img_path)
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                img = img.resize((300, 300), Image.Resampling.LANCZOS)
-                samples.append((img, class_name))
-            except Exception as e:
-                print(f"無法載入圖片 {img_path}: {e}")
-                continue
+            selected.append((random.choice(image_files), class_name))
+    
+    # 縮圖快取：重複執行時直接讀取已縮放的圖片
+    images = open_thumbnails(data_dir).get_many(
+        [img_path for img_path, _ in selected], (300, 300))
+    for img, (_, class_name) in zip(images, selected):
+        if img is not None:
+            samples.append((img, class_name))
     
     if len(samples) == 0:
         return
@@ -202,22 +191,22 @@ def create_category_comparison(data_dir, categories=None, save_path="category_co
     plt.close()
     print(f"已生成：{save_path}")
 
-# 設置隨機種子以確保可重現
-random.seed(42)
-np.random.seed(42)
-
-print("開始生成植物圖片展示...")
-print(f"資料集路徑: {data_dir}")
-
-# 1. 生成樣本圖片網格（12個不同類別）
-samples = get_sample_images(data_dir, num_classes=12, images_per_class=1)
-create_sample_grid(samples, 
-                  title="植物病害檢測資料集 - 樣本圖片展示（部分類別）",
-                  save_path="sample_images_grid.png")
+# 行程池在 Windows 以 spawn 啟動子行程，主程式需放在 __main__ 判斷內
+if __name__ == '__main__':
+    # 設置隨機種子以確保可重現
+    random.seed(42)
+    np.random.seed(42)
 
-# 2. 生成健康vs病害對比圖
-create_category_comparison(data_dir, save_path="category_comparison.png")
+    print("開始生成植物圖片展示...")
+    print(f"資料集路徑: {data_dir}")
 
-print("\n所有植物圖片展示已生成完成！")
+    # 1. 生成樣本圖片網格（12個不同類別）
+    samples = get_sample_images(data_dir, num_classes=12, images_per_class=1)
+    create_sample_grid(samples, 
+                      title="植物病害檢測資料集 - 樣本圖片展示（部分類別）",
+                      save_path="sample_images_grid.png")
 
+    # 2. 生成健康vs病害對比圖
+    create_category_comparison(data_dir, save_path="category_comparison.png")
 
+    print("\n所有植物圖片展示已生成完成！")
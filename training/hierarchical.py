@@ -0,0 +1,432 @@
+"""
+兩階段分類頭：共用骨幹特徵先經 14 類植物頭，再路由到該植物的小型病害頭
+
+- 類別名稱 Plant___Disease 以與 create_categories_by_plant
+  （generate_all_categories.py）相同的方式取出植物名稱，38 類分為 14 種植物；
+  只有一個類別的植物（藍莓、柳橙等）不需要病害頭
+- 路由以 tf.dynamic_partition 依預測的植物將批次分組，每個病害頭對每組
+  只執行一次，再以 tf.dynamic_stitch 還原原本順序；輸出為 38 類的
+  P(植物) * P(病害 | 植物)，可直接取 argmax 或交給 evaluation
+- 植物頭、病害頭與作為對照的扁平 38 類 Dense 頭都以 feature_cache 的凍結
+  骨幹特徵訓練，使用相同的特徵與切分；病害頭以真實植物的樣本訓練
+
+完成後寫出各分類頭（.h5）、hierarchy.json、summary.json 與
+hierarchical_report.md，比較兩種分類頭的 FLOPs（含骨幹與只計分類頭）、
+批次延遲與逐類別 F1。
+
+用法：
+    python hierarchical.py --backbone xception
+    python hierarchical.py --backbone mobilenet --disease-units 128
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from data_pipeline import (
+    IMG_SIZE,
+    SEED,
+    create_dataframe,
+    find_data_dir,
+    get_class_names,
+)
+from dataset_splits import split_frames
+from evaluation import evaluate_predictions, summarize
+from feature_cache import (
+    BACKBONES,
+    build_backbone,
+    default_cache_dir,
+    extract_features,
+    fit_head,
+    preprocess,
+    train_head,
+)
+from metrics_log import DEFAULT_RUNS
+
+# 植物頭只需分 14 類，隱藏層比扁平頭（Xception 預設 256）小；
+# 兩者合計的每張 FLOPs 仍低於扁平頭
+PLANT_UNITS = (128,)
+DISEASE_UNITS = (64,)
+LATENCY_BATCH_SIZES = (1, 32)
+# 扁平頭 F1 高於兩階段頭超過此值的類別列入報告
+F1_TOLERANCE = 0.01
+
+
+def plant_name(class_name):
+    """
+    與 create_categories_by_plant 相同：取第一個 ___ 前的部分並去除括號註記
+    （另外去除殘留的底線，例如 Corn_(maize) -> Corn）
+    """
+    if '___' not in class_name:
+        return class_name
+    return (class_name.split('___')[0].replace('(including_sour)', '')
+            .replace('(maize)', '').replace(',_bell', '').strip(' _'))
+
+
+class PlantHierarchy:
+    """
+    類別與植物的對應：plant_of[類別] 為植物索引，members[植物] 為該植物的
+    類別索引（依類別順序），local_of[類別] 為類別在其植物內的索引
+    """
+
+    def __init__(self, class_names):
+        self.class_names = list(class_names)
+        names = [plant_name(name) for name in self.class_names]
+        self.plants = sorted(set(names))
+        plant_index = {plant: i for i, plant in enumerate(self.plants)}
+        self.plant_of = np.array([plant_index[n] for n in names], np.int32)
+        self.members = [np.flatnonzero(self.plant_of == p)
+                        for p in range(len(self.plants))]
+        self.local_of = np.zeros(len(self.class_names), np.int32)
+        for members in self.members:
+            self.local_of[members] = np.arange(len(members))
+
+    @property
+    def num_plants(self):
+        return len(self.plants)
+
+    def scatter_matrix(self, plant):
+        """
+        [該植物類別數, 總類別數] 的 0/1 矩陣，將植物內機率放回 38 類的位置
+        """
+        members = self.members[plant]
+        matrix = np.zeros((len(members), len(self.class_names)), np.float32)
+        matrix[np.arange(len(members)), members] = 1.0
+        return matrix
+
+
+class HierarchicalHead:
+    """
+    植物頭 + 各植物的病害頭；disease_heads[植物] 為 None 表示該植物只有一類
+    """
+
+    def __init__(self, hierarchy, plant_head, disease_heads):
+        self.hierarchy = hierarchy
+        self.plant_head = plant_head
+        self.disease_heads = list(disease_heads)
+        self._scatter = [tf.constant(hierarchy.scatter_matrix(p))
+                         for p in range(hierarchy.num_plants)]
+        dim = plant_head.input_shape[-1]
+        self._route = tf.function(
+            self._route_batch,
+            input_signature=[tf.TensorSpec((None, dim), tf.float32)])
+
+    def __call__(self, features):
+        return self._route(tf.convert_to_tensor(features, tf.float32))
+
+    def _route_batch(self, features):
+        num_plants = self.hierarchy.num_plants
+        plant_probs = self.plant_head(features, training=False)
+        plant = tf.argmax(plant_probs, axis=1, output_type=tf.int32)
+        rows = tf.dynamic_partition(tf.range(tf.shape(features)[0]), plant,
+                                    num_plants)
+        groups = tf.dynamic_partition(features, plant, num_plants)
+        confidence = tf.dynamic_partition(
+            tf.reduce_max(plant_probs, axis=1), plant, num_plants)
+        outputs = []
+        for p, head in enumerate(self.disease_heads):
+            if head is None:
+                local = tf.ones([tf.shape(groups[p])[0], 1])
+            else:
+                local = head(groups[p], training=False)
+            outputs.append(tf.matmul(local * confidence[p][:, None],
+                                     self._scatter[p]))
+        return tf.dynamic_stitch(rows, outputs)
+
+    def predict(self, features, batch_size=1024):
+        return np.concatenate([
+            self(features[i:i + batch_size]).numpy()
+            for i in range(0, len(features), batch_size)]) if len(features) \
+            else np.zeros((0, len(self.hierarchy.class_names)), np.float32)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.plant_head.save(os.path.join(directory, 'plant_head.h5'))
+        files = []
+        for plant, head in zip(self.hierarchy.plants, self.disease_heads):
+            name = None if head is None else f"disease_{plant}.h5"
+            if head is not None:
+                head.save(os.path.join(directory, name))
+            files.append(name)
+        with open(os.path.join(directory, 'hierarchy.json'), 'w',
+                  encoding='utf-8') as f:
+            json.dump({'class_names': self.hierarchy.class_names,
+                       'plants': self.hierarchy.plants,
+                       'disease_heads': files}, f, ensure_ascii=False,
+                      indent=2)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, 'hierarchy.json'),
+                  encoding='utf-8') as f:
+            meta = json.load(f)
+
+        def load(name):
+            return tf.keras.models.load_model(os.path.join(directory, name),
+                                              compile=False)
+
+        return cls(PlantHierarchy(meta['class_names']), load('plant_head.h5'),
+                   [None if name is None else load(name)
+                    for name in meta['disease_heads']])
+
+
+def _class_labels(frame, class_names):
+    class_index = {name: i for i, name in enumerate(class_names)}
+    return frame['Labels'].map(class_index).values.astype(np.int32)
+
+
+def train_hierarchical(x_train, y_train, x_valid, y_valid, hierarchy,
+                       plant_units=PLANT_UNITS, disease_units=DISEASE_UNITS,
+                       dropout=0.5, batch_norm=True, lr=1e-3, epochs=20,
+                       seed=SEED, verbose=1):
+    """
+    以特徵與 38 類標籤訓練植物頭與每種植物的病害頭，回傳 HierarchicalHead
+    """
+    tf.keras.utils.set_random_seed(seed)
+    print(f"植物頭：{hierarchy.num_plants} 類")
+    plant_head = fit_head(x_train, hierarchy.plant_of[y_train], x_valid,
+                          hierarchy.plant_of[y_valid], hierarchy.num_plants,
+                          plant_units, dropout, batch_norm, lr, epochs,
+                          verbose=verbose)
+    disease_heads = []
+    for p, members in enumerate(hierarchy.members):
+        if len(members) == 1:
+            disease_heads.append(None)
+            continue
+        print(f"病害頭 {hierarchy.plants[p]}：{len(members)} 類")
+        train_rows = hierarchy.plant_of[y_train] == p
+        valid_rows = hierarchy.plant_of[y_valid] == p
+        disease_heads.append(fit_head(
+            x_train[train_rows], hierarchy.local_of[y_train[train_rows]],
+            x_valid[valid_rows], hierarchy.local_of[y_valid[valid_rows]],
+            len(members), disease_units, dropout, batch_norm, lr, epochs,
+            verbose=verbose))
+    return HierarchicalHead(hierarchy, plant_head, disease_heads)
+
+
+def count_flops(model, input_shape):
+    """
+    以 TF profiler 計算凍結圖（批次大小 1）的浮點運算數
+    """
+    from tensorflow.python.framework.convert_to_constants import (
+        convert_variables_to_constants_v2,
+    )
+
+    spec = tf.TensorSpec((1, *input_shape), tf.float32)
+    concrete = tf.function(
+        lambda x: model(x, training=False)).get_concrete_function(spec)
+    frozen = convert_variables_to_constants_v2(concrete)
+    options = tf.compat.v1.profiler.ProfileOptionBuilder.float_operation()
+    options['output'] = 'none'
+    return int(tf.compat.v1.profiler.profile(
+        graph=frozen.graph, options=options).total_float_ops)
+
+
+def head_flops(flat_head, hierarchical, routed_plants):
+    """
+    每張圖片的分類頭 FLOPs；兩階段頭依 routed_plants（預測的植物）的比例
+    計算病害頭的期望值，路由的散佈矩陣乘法也計入
+    """
+    hierarchy = hierarchical.hierarchy
+    dim = flat_head.input_shape[-1]
+    fractions = np.bincount(routed_plants, minlength=hierarchy.num_plants) \
+        / max(len(routed_plants), 1)
+    plant = count_flops(hierarchical.plant_head, (dim,))
+    per_plant = []
+    for p, head in enumerate(hierarchical.disease_heads):
+        scatter = 2 * len(hierarchy.members[p]) * len(hierarchy.class_names)
+        per_plant.append(scatter + (0 if head is None
+                                    else count_flops(head, (dim,))))
+    return {
+        'flat': count_flops(flat_head, (dim,)),
+        'hierarchical': int(plant + fractions @ np.array(per_plant)),
+        'plant_head': plant,
+        'disease_heads': dict(zip(hierarchy.plants, per_plant)),
+    }
+
+
+def measure_latency(fn, inputs, repeats=50):
+    """
+    已暖機的 fn(inputs) 每個批次的延遲（ms）p50 / p95
+    """
+    fn(inputs)
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        np.asarray(fn(inputs))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {'p50': round(float(np.percentile(latencies, 50)), 3),
+            'p95': round(float(np.percentile(latencies, 95)), 3)}
+
+
+def latency(name, backbone, flat_head, hierarchical, features,
+            batch_sizes=LATENCY_BATCH_SIZES, repeats=50):
+    """
+    只計分類頭（快取特徵）與含骨幹（隨機圖片）的批次延遲
+    """
+    flat = tf.function(lambda x: flat_head(x, training=False))
+    results = {}
+    for batch_size in batch_sizes:
+        batch = tf.constant(np.resize(features, (batch_size,
+                                                 features.shape[1])))
+        results[f"head_batch{batch_size}"] = {
+            'flat': measure_latency(flat, batch, repeats),
+            'hierarchical': measure_latency(hierarchical, batch, repeats)}
+
+    def with_backbone(head):
+        return tf.function(lambda images: head(
+            backbone(preprocess(name, images), training=False)))
+
+    batch_size = max(batch_sizes)
+    images = tf.random.stateless_uniform((batch_size, *IMG_SIZE, 3),
+                                         seed=[SEED, 0], maxval=255)
+    results[f"full_batch{batch_size}"] = {
+        'flat': measure_latency(with_backbone(flat_head), images,
+                                max(repeats // 5, 3)),
+        'hierarchical': measure_latency(with_backbone(hierarchical), images,
+                                        max(repeats // 5, 3))}
+    return results
+
+
+def compare(summary, tolerance=F1_TOLERANCE):
+    """
+    扁平頭與兩階段頭的 FLOPs、延遲、整體指標與 F1 落後的類別（Markdown）
+    """
+    flops, flat, hier = summary['flops'], summary['flat'], \
+        summary['hierarchical']
+    full_flat = flops['backbone'] + flops['flat']
+    full_hier = flops['backbone'] + flops['hierarchical']
+    lines = [
+        f"| | 扁平 {len(flat['per_class_f1'])} 類 | "
+        f"兩階段（{len(summary['plants'])} 種植物 -> 病害） |",
+        '| --- | --- | --- |',
+        f"| 分類頭 FLOPs / 張 | {flops['flat']:,} | "
+        f"{flops['hierarchical']:,} "
+        f"({flops['hierarchical'] / flops['flat']:.2f}x) |",
+        f"| 含骨幹 FLOPs / 張 | {full_flat:,} | {full_hier:,} "
+        f"({full_hier / full_flat:.4f}x) |",
+    ]
+    for key, values in summary['latency'].items():
+        lines.append(f"| 延遲 {key} p50 | {values['flat']['p50']:.2f} ms | "
+                     f"{values['hierarchical']['p50']:.2f} ms |")
+    lines += [
+        f"| 測試集準確率 | {flat['accuracy']:.4f} | "
+        f"{hier['accuracy']:.4f} |",
+        f"| macro F1 | {flat['macro_f1']:.4f} | {hier['macro_f1']:.4f} |",
+        '',
+        f"植物頭路由準確率: {summary['plant_accuracy']:.4f}",
+    ]
+    behind = [(name, flat['per_class_f1'][name], f1)
+              for name, f1 in hier['per_class_f1'].items()
+              if f1 < flat['per_class_f1'][name] - tolerance]
+    total = len(hier['per_class_f1'])
+    lines += ['', f"與扁平頭 F1 差距在 {tolerance} 以內的類別: "
+              f"{total - len(behind)}/{total}"]
+    if behind:
+        lines += ['', '| 類別 | 扁平 F1 | 兩階段 F1 |', '| --- | --- | --- |']
+        lines += [f"| {name} | {f:.4f} | {h:.4f} |"
+                  for name, f, h in sorted(behind, key=lambda r: r[2] - r[1])]
+    return '\n'.join(lines) + '\n'
+
+
+def run(args, backbone=None):
+    """
+    訓練扁平頭與兩階段頭並比較，回傳摘要並寫出模型與報告
+    """
+    config = BACKBONES[args.backbone]
+    train_df, valid_df, test_df = split_frames(args.data_dir, args.split,
+                                              args.seed)
+    if test_df is None:
+        test_df = valid_df
+    class_names = get_class_names(train_df)
+    hierarchy = PlantHierarchy(class_names)
+
+    backbone = backbone or build_backbone(args.backbone)
+    cache = extract_features(
+        args.backbone, create_dataframe(args.data_dir)['Filepaths'],
+        args.cache_dir or default_cache_dir(args.data_dir), backbone)
+    x_train, x_valid, x_test = (cache.lookup(frame['Filepaths'])
+                                for frame in (train_df, valid_df, test_df))
+    y_train, y_valid, y_test = (_class_labels(frame, class_names)
+                                for frame in (train_df, valid_df, test_df))
+
+    print(f"扁平頭：{len(class_names)} 類")
+    flat_head, _ = train_head(
+        cache, train_df, valid_df, class_names, units=config['units'],
+        dropout=config['dropout'], batch_norm=config['batch_norm'],
+        lr=args.lr, epochs=args.epochs, seed=args.seed)
+    hierarchical = train_hierarchical(
+        x_train, y_train, x_valid, y_valid, hierarchy, args.plant_units,
+        args.disease_units, config['dropout'], config['batch_norm'], args.lr,
+        args.epochs, args.seed)
+
+    flat_pred = flat_head.predict(x_test, batch_size=1024,
+                                  verbose=0).argmax(axis=1)
+    hier_pred = hierarchical.predict(x_test).argmax(axis=1)
+    routed = hierarchical.plant_head.predict(x_test, batch_size=1024,
+                                             verbose=0).argmax(axis=1)
+    summary = {
+        'config': vars(args),
+        'plants': {plant: [class_names[i] for i in members]
+                   for plant, members in zip(hierarchy.plants,
+                                             hierarchy.members)},
+        'flat': summarize(evaluate_predictions(
+            y_test, flat_pred, len(class_names))[0], class_names),
+        'hierarchical': summarize(evaluate_predictions(
+            y_test, hier_pred, len(class_names))[0], class_names),
+        'plant_accuracy': float(np.mean(routed == hierarchy.plant_of[y_test])),
+        'flops': {'backbone': count_flops(backbone,
+                                          backbone.input_shape[1:]),
+                  **head_flops(flat_head, hierarchical, routed)},
+        'latency': latency(args.backbone, backbone, flat_head, hierarchical,
+                           x_test if len(x_test) else x_train),
+    }
+
+    output_dir = os.path.join(args.output, args.name or
+                              f"hierarchical_{args.backbone}_"
+                              f"{time.strftime('%Y%m%d-%H%M%S')}")
+    hierarchical.save(output_dir)
+    flat_head.save(os.path.join(output_dir, 'flat_head.h5'))
+    with open(os.path.join(output_dir, 'summary.json'), 'w',
+              encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    report = compare(summary)
+    with open(os.path.join(output_dir, 'hierarchical_report.md'), 'w',
+              encoding='utf-8') as f:
+        f.write(report)
+    print('\n' + report)
+    print(f"結果已寫入 {output_dir}")
+    return summary
+
+
+def _units(text):
+    return tuple(int(n) for n in text.split(',') if n)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='兩階段植物 -> 病害分類頭')
+    parser.add_argument('--backbone', choices=list(BACKBONES),
+                        default='xception')
+    parser.add_argument('--data-dir', default=find_data_dir())
+    parser.add_argument('--cache-dir', default=None,
+                        help='feature_cache 的特徵快取資料夾')
+    parser.add_argument('--split', default=None,
+                        help='dataset_splits 的切分名稱（預設同 notebook）')
+    parser.add_argument('--output', default=DEFAULT_RUNS)
+    parser.add_argument('--name', default=None,
+                        help='執行名稱（預設依設定產生）')
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--plant-units', type=_units,
+                        default=PLANT_UNITS, help='植物頭的隱藏層大小')
+    parser.add_argument('--disease-units', type=_units,
+                        default=DISEASE_UNITS, help='病害頭的隱藏層大小')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
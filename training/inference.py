@@ -0,0 +1,335 @@
+"""
+批次推論引擎，取代逐張呼叫 model.predict 的迴圈
+
+將輸入組成固定大小的批次，解碼在 tf.data 中平行執行，每個批次只執行一次
+已編譯的前向傳播，並直接回傳 top-k 類別名稱。設定 cache（見
+prediction_cache.py）後只對快取未命中的圖片執行前向傳播。
+
+用法：
+    python inference.py --model network.h5 --input 圖片資料夾 --top-k 3
+    python inference.py --model network.h5 --input 圖片資料夾 --cache
+    python inference.py --model network.h5 --input 圖片資料夾 --benchmark
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from data_pipeline import (
+    AUTOTUNE,
+    IMG_SIZE,
+    RESCALE,
+    RESIZE_METHOD,
+    decode_image,
+    load_image,
+)
+from dataset_index import IMAGE_EXTENSIONS, load_index
+
+BATCH_SIZES = (1, 8, 16, 32, 64, 128)
+
+
+def load_class_names(data_dir):
+    """
+    取得與訓練時相同順序的類別名稱（資料集索引的類別排序）
+    """
+    return load_index(data_dir).class_names
+
+
+def list_image_files(directory):
+    """
+    遞迴列出資料夾內所有圖片檔（排序）
+    """
+    paths = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(root, name))
+    return sorted(paths)
+
+
+class BatchPredictor:
+    """
+    固定批次大小的推論器
+
+    - model: Keras 模型或模型檔路徑（.h5 / SavedModel）
+    - class_names: 與訓練時相同順序的類別名稱
+    - scale: 輸入像素的縮放係數；預設與本專案訓練的模型相同（1/255），
+      自訂 CNN 內含 Rescaling 層時為 1.0
+    - method: 縮放插值方式，需與訓練時一致（預設 nearest）
+    - cache: PredictionCache（見 prediction_cache.open_prediction_cache），
+      None 時不使用快取
+    """
+
+    def __init__(self, model, class_names, batch_size=32, image_size=IMG_SIZE,
+                 scale=RESCALE, method=RESIZE_METHOD, top_k=3, cache=None):
+        if isinstance(model, str):
+            model = tf.keras.models.load_model(model, compile=False)
+        self.model = model
+        self.class_names = list(class_names)
+        self.batch_size = batch_size
+        self.image_size = tuple(image_size)
+        self.scale = scale
+        self.method = method
+        self.top_k = min(top_k, len(self.class_names))
+        self.cache = cache
+
+        # 固定輸入形狀，整個推論過程只會追蹤（trace）一次
+        spec = tf.TensorSpec((batch_size, *self.image_size, 3), tf.float32)
+        self._forward = tf.function(self._forward_batch,
+                                    input_signature=[spec])
+        self._forward_probs = tf.function(self._probs_batch,
+                                          input_signature=[spec])
+
+    def _probs_batch(self, images):
+        return self.model(images * self.scale, training=False)
+
+    def _forward_batch(self, images):
+        return tf.math.top_k(self._probs_batch(images), k=self.top_k)
+
+    def _pad(self, images):
+        """
+        將最後一個不足的批次補滿，維持固定形狀
+        """
+        count = tf.shape(images)[0]
+        pad = self.batch_size - count
+        images = tf.pad(images, [[0, pad], [0, 0], [0, 0], [0, 0]])
+        return images, count
+
+    def _run(self, dataset):
+        scores, indices = [], []
+        for images in dataset:
+            images, count = self._pad(images)
+            top = self._forward(images)
+            scores.append(top.values.numpy()[:count])
+            indices.append(top.indices.numpy()[:count])
+        if not scores:
+            return (np.zeros((0, self.top_k), np.float32),
+                    np.zeros((0, self.top_k), np.int32))
+        return np.concatenate(scores), np.concatenate(indices)
+
+    def _format(self, scores, indices):
+        return [[(self.class_names[i], float(s)) for i, s in zip(idx, sc)]
+                for sc, idx in zip(scores, indices)]
+
+    def format_probs(self, probs):
+        """
+        將完整機率 [N, 類別數] 轉為 top-k 結果（同分時索引小者在前）
+        """
+        probs = np.asarray(probs).reshape(-1, len(self.class_names))
+        indices = np.argsort(-probs, axis=1, kind='stable')[:, :self.top_k]
+        return self._format(np.take_along_axis(probs, indices, axis=1),
+                            indices)
+
+    def predict_probs(self, images):
+        """
+        回傳一個批次（N <= batch_size）的完整類別機率，不查詢快取
+        """
+        images = tf.convert_to_tensor(np.asarray(images, np.float32))
+        images, count = self._pad(images)
+        return self._forward_probs(images).numpy()[:count]
+
+    def _cached_probs(self, images, keys=None):
+        """
+        查詢快取，只對未命中的圖片執行前向傳播；回傳 (機率, 快取鍵)
+
+        keys 由呼叫端提供時表示已查詢過快取且未命中，不再重複查詢
+        """
+        images = np.asarray(images, np.float32)
+        if keys is None:
+            keys = [self.cache.key(image) for image in images]
+            probs = [self.cache.get(key) for key in keys]
+        else:
+            probs = [None] * len(keys)
+        missing = [i for i, p in enumerate(probs) if p is None]
+        if missing:
+            start = time.perf_counter()
+            computed = self.predict_probs(images[missing])
+            self.cache.record_compute(time.perf_counter() - start,
+                                      len(missing))
+            for i, p in zip(missing, computed):
+                self.cache.put(keys[i], p)
+                probs[i] = p
+        return probs, keys
+
+    def _run_cached(self, dataset):
+        probs, keys = [], []
+        for images in dataset:
+            batch_probs, batch_keys = self._cached_probs(images.numpy())
+            probs.extend(batch_probs)
+            keys.extend(batch_keys)
+        return probs, keys
+
+    def predict_batch(self, images, keys=None):
+        """
+        預測一個已縮放為 image_size 的批次（N <= batch_size），不經過 tf.data
+
+        keys 為呼叫端已計算且確認未命中的快取鍵（serve.py 在解碼時查詢）
+        """
+        if self.cache is not None:
+            return self.format_probs(self._cached_probs(images, keys)[0])
+        images = tf.convert_to_tensor(np.asarray(images, np.float32))
+        images, count = self._pad(images)
+        top = self._forward(images)
+        return self._format(top.values.numpy()[:count],
+                            top.indices.numpy()[:count])
+
+    def decode(self, data):
+        """
+        解碼圖片位元組並縮放為 image_size，與 path_dataset 相同的前處理
+
+        serve.py 以此解碼請求，同一張圖片在伺服器與路徑推論得到相同的
+        像素與快取鍵
+        """
+        return decode_image(data, self.image_size, self.method).numpy()
+
+    def path_dataset(self, paths):
+        """
+        平行讀取與解碼圖片路徑的批次資料集
+        """
+        ds = tf.data.Dataset.from_tensor_slices(list(paths))
+        ds = ds.map(lambda p: load_image(p, self.image_size, self.method),
+                    num_parallel_calls=AUTOTUNE, deterministic=True)
+        return ds.batch(self.batch_size).prefetch(AUTOTUNE)
+
+    def array_dataset(self, arrays):
+        """
+        將任意 (H, W, 3) 陣列串流轉為固定大小批次
+        """
+        spec = tf.TensorSpec((None, None, 3), tf.float32)
+        ds = tf.data.Dataset.from_generator(
+            lambda: (np.asarray(a, np.float32) for a in arrays),
+            output_signature=spec)
+        ds = ds.map(lambda x: tf.image.resize(x, self.image_size,
+                                              method=self.method),
+                    num_parallel_calls=AUTOTUNE, deterministic=True)
+        return ds.batch(self.batch_size).prefetch(AUTOTUNE)
+
+    def predict_paths(self, paths):
+        """
+        預測圖片路徑列表，回傳每張圖的 [(類別名稱, 機率), ...]
+
+        使用快取時先以 (路徑, 修改時間, 大小) 查詢，命中的圖片不需解碼
+        """
+        if self.cache is None:
+            return self._format(*self._run(self.path_dataset(paths)))
+        paths = list(paths)
+        aliases = [self.cache.file_alias(path) for path in paths]
+        probs = [self.cache.get_alias(alias) for alias in aliases]
+        missing = [i for i, p in enumerate(probs) if p is None]
+        if missing:
+            computed, keys = self._run_cached(
+                self.path_dataset([paths[i] for i in missing]))
+            for i, p, key in zip(missing, computed, keys):
+                self.cache.set_alias(aliases[i], key)
+                probs[i] = p
+        return self.format_probs(probs)
+
+    def predict_directory(self, directory):
+        """
+        預測資料夾內所有圖片，回傳 {路徑: top-k 結果}
+        """
+        paths = list_image_files(directory)
+        return dict(zip(paths, self.predict_paths(paths)))
+
+    def predict_arrays(self, arrays):
+        """
+        預測陣列串流（例如 test_ds 中的圖片），值域為 0-255
+        """
+        if self.cache is not None:
+            return self.format_probs(
+                self._run_cached(self.array_dataset(arrays))[0])
+        return self._format(*self._run(self.array_dataset(arrays)))
+
+
+def benchmark(model, class_names, paths, batch_sizes=BATCH_SIZES,
+              num_images=512, **kwargs):
+    """
+    量測不同批次大小的吞吐量（images/sec），並與逐張 model.predict 比較
+    """
+    paths = (list(paths) * (num_images // max(len(paths), 1) + 1))[:num_images]
+    if isinstance(model, str):
+        model = tf.keras.models.load_model(model, compile=False)
+
+    results = {}
+    for batch_size in batch_sizes:
+        predictor = BatchPredictor(model, class_names, batch_size=batch_size,
+                                   **kwargs)
+        # 暖機：觸發追蹤與編譯
+        predictor.predict_paths(paths[:batch_size])
+        start = time.perf_counter()
+        predictor.predict_paths(paths)
+        results[batch_size] = len(paths) / (time.perf_counter() - start)
+        print(f"batch_size={batch_size:<4d} {results[batch_size]:10.1f} "
+              f"images/sec")
+
+    # 原本 notebook 的做法：每張圖呼叫一次 model.predict
+    predictor = BatchPredictor(model, class_names, batch_size=1, **kwargs)
+    loop_paths = paths[:min(len(paths), 64)]
+    images = [batch for batch in predictor.path_dataset(loop_paths)]
+    model.predict(images[0], verbose=0)
+    start = time.perf_counter()
+    for image in images:
+        model.predict(image * predictor.scale, verbose=0)
+    results['model.predict'] = len(images) / (time.perf_counter() - start)
+    print(f"{'逐張 model.predict':<15s} {results['model.predict']:10.1f} "
+          f"images/sec")
+    return results
+
+
+def main():
+    from data_pipeline import find_data_dir
+    from prediction_cache import (
+        MAX_DISK_MB,
+        default_cache_dir,
+        open_prediction_cache,
+        print_stats,
+    )
+
+    parser = argparse.ArgumentParser(description='批次推論')
+    parser.add_argument('--model', required=True)
+    parser.add_argument('--input', required=True, nargs='+',
+                        help='圖片資料夾或圖片路徑')
+    parser.add_argument('--data-dir', default=find_data_dir(),
+                        help='用於取得類別名稱的訓練資料夾')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--top-k', type=int, default=3)
+    parser.add_argument('--scale', type=float, default=RESCALE,
+                        help='模型輸入縮放（自訂 CNN 內含 Rescaling 時用 1.0）')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='量測不同批次大小的吞吐量')
+    parser.add_argument('--cache', action='store_true',
+                        help='使用預測快取（記憶體 + 磁碟）')
+    parser.add_argument('--cache-dir', default=None,
+                        help='快取磁碟層位置（預設為資料集旁的 '
+                        'cache/predictions）')
+    parser.add_argument('--cache-mb', type=float, default=MAX_DISK_MB)
+    args = parser.parse_args()
+
+    class_names = load_class_names(args.data_dir)
+    paths = []
+    for item in args.input:
+        paths.extend(list_image_files(item) if os.path.isdir(item) else [item])
+
+    if args.benchmark:
+        benchmark(args.model, class_names, paths, scale=args.scale,
+                  top_k=args.top_k)
+        return
+
+    predictor = BatchPredictor(args.model, class_names,
+                               batch_size=args.batch_size, scale=args.scale,
+                               top_k=args.top_k)
+    if args.cache or args.cache_dir:
+        predictor.cache = open_prediction_cache(
+            predictor, args.cache_dir or default_cache_dir(args.data_dir),
+            max_disk_mb=args.cache_mb)
+    for path, top in zip(paths, predictor.predict_paths(paths)):
+        summary = ', '.join(f"{name} ({score:.3f})" for name, score in top)
+        print(f"{path}: {summary}")
+    if predictor.cache is not None:
+        print_stats(predictor.cache.stats())
+
+
+if __name__ == '__main__':
+    main()
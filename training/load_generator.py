@@ -0,0 +1,134 @@
+"""
+對本機預測伺服器（serve.py）發送並行請求，量測微批次帶來的吞吐量差異
+
+用法：
+    python load_generator.py --images 圖片資料夾 --concurrency 32 \
+        --requests 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+import numpy as np
+
+from dataset_index import IMAGE_EXTENSIONS
+
+
+def load_payloads(directory, limit=256, seed=42):
+    """
+    讀取最多 limit 張圖片的原始位元組作為請求內容
+    """
+    paths = []
+    for root, _, files in os.walk(directory):
+        paths.extend(os.path.join(root, f) for f in files
+                     if f.lower().endswith(IMAGE_EXTENSIONS))
+    paths.sort()
+    random.Random(seed).shuffle(paths)
+    payloads = []
+    for path in paths[:limit]:
+        with open(path, 'rb') as f:
+            payloads.append(f.read())
+    return payloads
+
+
+async def _request(reader, writer, host, method, path, body=b''):
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\n"
+        f"Host: {host}\r\n"
+        f"Content-Type: application/octet-stream\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"\r\n".encode('latin-1') + body)
+    await writer.drain()
+    header = await reader.readuntil(b'\r\n\r\n')
+    lines = header.decode('latin-1').split('\r\n')
+    status = int(lines[0].split(' ')[1])
+    length = 0
+    for line in lines[1:]:
+        if line.lower().startswith('content-length:'):
+            length = int(line.split(':', 1)[1])
+    data = await reader.readexactly(length)
+    return status, json.loads(data)
+
+
+async def _client(host, port, payloads, counter, total, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while True:
+            index = counter[0]
+            if index >= total:
+                break
+            counter[0] += 1
+            start = time.perf_counter()
+            status, _ = await _request(reader, writer, host, 'POST',
+                                       '/predict',
+                                       payloads[index % len(payloads)])
+            if status == 200:
+                latencies.append((time.perf_counter() - start) * 1000)
+            else:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def run_load(host, port, payloads, concurrency=32, total=1000):
+    """
+    以 concurrency 個 keep-alive 連線送出 total 個請求，
+    回傳客戶端統計與伺服器指標
+    """
+    counter = [0]
+    latencies, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        _client(host, port, payloads, counter, total, latencies, errors)
+        for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await asyncio.open_connection(host, port)
+    _, server_metrics = await _request(reader, writer, host, 'GET',
+                                       '/metrics')
+    writer.close()
+
+    latencies = np.array(latencies)
+    return {
+        'requests': total,
+        'errors': len(errors),
+        'elapsed_sec': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'client_latency_ms': {
+            q: round(float(np.percentile(latencies, int(q[1:]))), 3)
+            for q in ('p50', 'p95', 'p99')} if len(latencies) else {},
+        'server': server_metrics,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='預測伺服器壓力測試')
+    parser.add_argument('--images', required=True, help='請求用的圖片資料夾')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=1000)
+    args = parser.parse_args()
+
+    payloads = load_payloads(args.images)
+    if not payloads:
+        print(f"找不到圖片：{args.images}")
+        return
+    result = asyncio.run(run_load(args.host, args.port, payloads,
+                                  args.concurrency, args.requests))
+
+    server = result['server']
+    print(f"請求數: {result['requests']}  錯誤: {result['errors']}  "
+          f"耗時: {result['elapsed_sec']} 秒")
+    print(f"吞吐量: {result['throughput_rps']} requests/sec")
+    print(f"客戶端延遲 (ms): {result['client_latency_ms']}")
+    print(f"伺服器延遲 (ms): {server['latency_ms']}")
+    print(f"佇列深度: {server['queue_depth']}")
+    print(f"批次大小: {server['batch_size']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""
+訓練指標記錄：逐 epoch 與每 N 步的指標以 Arrow IPC 串流格式附加寫入
+
+train.py 的 MetricsLogger callback 在 runs/<名稱>/ 下寫出 metrics-00000.arrow
+（從檢查點繼續時寫出下一個分段），每列記錄 loss / accuracy、學習率、
+步驟時間、等待輸入的時間與每秒處理圖片數。串流格式只會在檔尾附加批次，訓練中斷時已寫入的批次仍可讀取。
+
+讀取以 pa.memory_map 進行，多個執行的歷史可直接載入比較，generate_charts.py
+也由此取得訓練曲線，不需再從 notebook 複製數值。每個分段的 schema 中繼資料
+記錄執行類型（train / profile / distill / progressive / resumable），
+latest_run 預設只找 train.py 的完整訓練。
+
+用法：
+    python metrics_log.py list                 # 列出 runs/ 下所有執行
+    python metrics_log.py show <執行名稱>       # 顯示逐 epoch 指標
+    python metrics_log.py list --kind distill  # 只列出某類型的執行
+"""
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+TRAINING_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_RUNS = os.path.join(os.path.dirname(TRAINING_DIR), 'runs')
+
+SCHEMA = pa.schema([
+    ('kind', pa.string()),          # 'step' 或 'epoch'
+    ('epoch', pa.int32()),          # 從 1 開始
+    ('step', pa.int64()),           # 累計訓練步數
+    ('wall_time', pa.float64()),
+    ('loss', pa.float32()),
+    ('accuracy', pa.float32()),
+    ('val_loss', pa.float32()),
+    ('val_accuracy', pa.float32()),
+    ('learning_rate', pa.float32()),
+    ('step_time_ms', pa.float32()),
+    ('input_wait_ms', pa.float32()),
+    ('images_per_sec', pa.float32()),
+])
+RUN_KINDS = ('train', 'profile', 'distill', 'progressive', 'resumable')
+
+
+def _segments(run_dir):
+    return sorted(glob.glob(os.path.join(run_dir, 'metrics-*.arrow')))
+
+
+class MetricsWriter:
+    """
+    以 Arrow IPC 串流格式附加寫入；每個寫入器對應一個新的分段檔
+
+    run_kind 寫入 schema 中繼資料，見 RUN_KINDS
+    """
+
+    def __init__(self, run_dir, run_kind):
+        if run_kind not in RUN_KINDS:
+            raise ValueError(f"未知的執行類型: {run_kind}")
+        os.makedirs(run_dir, exist_ok=True)
+        self.path = os.path.join(run_dir,
+                                 f"metrics-{len(_segments(run_dir)):05d}.arrow")
+        self._sink = pa.OSFile(self.path, 'wb')
+        self._writer = pa.ipc.new_stream(
+            self._sink, SCHEMA.with_metadata({'run_kind': run_kind}))
+
+    def write(self, rows):
+        if not rows:
+            return
+        self._writer.write_batch(pa.RecordBatch.from_pylist(rows,
+                                                             schema=SCHEMA))
+        self._sink.flush()
+
+    def close(self):
+        self._writer.close()
+        self._sink.close()
+
+
+def _read_segment(path):
+    """
+    以記憶體映射讀取一個分段；中斷寫入的不完整批次會被略過
+    """
+    batches = []
+    try:
+        reader = pa.ipc.open_stream(pa.memory_map(path))
+        while True:
+            batches.append(reader.read_next_batch())
+    except StopIteration:
+        pass
+    except pa.ArrowInvalid:
+        pass
+    return batches
+
+
+def read_run(run_dir):
+    """
+    讀取一個執行的所有分段為 pyarrow.Table
+    """
+    batches = [batch for path in _segments(run_dir)
+               for batch in _read_segment(path)]
+    return pa.Table.from_batches(batches, schema=SCHEMA)
+
+
+def run_kind(run_dir):
+    """
+    執行類型（第一個分段的 schema 中繼資料）；沒有記錄時回傳 None
+    """
+    segments = _segments(run_dir)
+    if not segments:
+        return None
+    try:
+        metadata = pa.ipc.open_stream(pa.memory_map(segments[0])) \
+            .schema.metadata or {}
+    except pa.ArrowInvalid:
+        return None
+    kind = metadata.get(b'run_kind')
+    return kind.decode('utf-8') if kind is not None else None
+
+
+def list_runs(root=DEFAULT_RUNS, kind=None):
+    """
+    有指標記錄的執行名稱，依最後寫入時間排序（最新的在最後）
+
+    kind 為 None 時列出所有類型
+    """
+    runs = []
+    for run_dir in glob.glob(os.path.join(root, '*')):
+        segments = _segments(run_dir)
+        if segments and (kind is None or run_kind(run_dir) == kind):
+            runs.append((max(os.path.getmtime(p) for p in segments),
+                         os.path.basename(run_dir)))
+    return [name for _, name in sorted(runs)]
+
+
+def latest_run(root=DEFAULT_RUNS, kind='train'):
+    """
+    最新一次指定類型的執行；預設只找 train.py 的完整訓練，不會取到
+    --profile、蒸餾或漸進式訓練的記錄
+    """
+    runs = list_runs(root, kind)
+    return runs[-1] if runs else None
+
+
+def read_runs(names=None, root=DEFAULT_RUNS, kind=None):
+    """
+    讀取多個執行並加上 run 欄位，方便比較不同設定的歷史
+    """
+    tables = []
+    for name in names or list_runs(root, kind):
+        table = read_run(os.path.join(root, name))
+        tables.append(table.append_column(
+            'run', pa.array([name] * table.num_rows, pa.string())))
+    if not tables:
+        return None
+    return pa.concat_tables(tables)
+
+
+def history(table, kind='epoch'):
+    """
+    取出某類型的列，回傳 {欄位: numpy 陣列}；缺值為 NaN
+    """
+    table = table.filter(pc.equal(table['kind'], kind))
+    return {name: table[name].to_numpy() for name in table.column_names
+            if name != 'kind'}
+
+
+def fingerprint(root=DEFAULT_RUNS):
+    """
+    最新訓練的記錄指紋（名稱、分段數與大小），供 build_figures 判斷是否重繪
+    """
+    name = latest_run(root)
+    if name is None:
+        return 'missing'
+    segments = _segments(os.path.join(root, name))
+    return name + ''.join(f"\0{os.path.getsize(p)}" for p in segments)
+
+
+def _print_history(name, epochs):
+    print(f"\n{name}")
+    print(f"{'epoch':>5s} {'loss':>8s} {'acc':>7s} {'val_loss':>9s} "
+          f"{'val_acc':>8s} {'lr':>9s} {'step ms':>8s} {'wait ms':>8s} "
+          f"{'img/s':>7s}")
+    for i in range(len(epochs['epoch'])):
+        print(f"{epochs['epoch'][i]:>5d} {epochs['loss'][i]:>8.4f} "
+              f"{epochs['accuracy'][i]:>7.4f} {epochs['val_loss'][i]:>9.4f} "
+              f"{epochs['val_accuracy'][i]:>8.4f} "
+              f"{epochs['learning_rate'][i]:>9.2e} "
+              f"{epochs['step_time_ms'][i]:>8.1f} "
+              f"{epochs['input_wait_ms'][i]:>8.1f} "
+              f"{epochs['images_per_sec'][i]:>7.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='訓練指標記錄')
+    parser.add_argument('command', choices=['list', 'show'])
+    parser.add_argument('runs', nargs='*', help='執行名稱（預設為全部或最新）')
+    parser.add_argument('--root', default=DEFAULT_RUNS)
+    parser.add_argument('--kind', choices=RUN_KINDS, default=None,
+                        help='只列出此類型的執行（show 預設為最新的 train）')
+    args = parser.parse_args()
+
+    if args.command == 'show':
+        kind = args.kind or 'train'
+        names = args.runs or [latest_run(args.root, kind)]
+        if names == [None]:
+            parser.error(f"{args.root} 下沒有 {kind} 類型的指標記錄")
+        for name in names:
+            _print_history(name, history(read_run(
+                os.path.join(args.root, name))))
+        return
+
+    start = time.perf_counter()
+    table = read_runs(args.runs or None, args.root, args.kind)
+    elapsed = (time.perf_counter() - start) * 1000
+    if table is None:
+        print(f"{args.root} 下沒有指標記錄")
+        return
+    print(f"讀取 {table.num_rows} 列，耗時 {elapsed:.1f} ms")
+    print(f"{'執行':<40s} {'epochs':>6s} {'最佳 val_loss':>13s} "
+          f"{'img/s':>7s} {'wait ms':>8s}")
+    for name in dict.fromkeys(table['run'].to_pylist()):
+        epochs = history(table.filter(pc.equal(table['run'], name)))
+        if not len(epochs['epoch']):
+            continue
+        print(f"{name:<40s} {len(epochs['epoch']):>6d} "
+              f"{np.nanmin(epochs['val_loss']):>13.4f} "
+              f"{np.nanmedian(epochs['images_per_sec']):>7.1f} "
+              f"{np.nanmedian(epochs['input_wait_ms']):>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,389 @@
+"""
+感知雜湊近似重複索引：找出幾乎相同的葉片照片，建立不洩漏的群組切分
+
+PlantVillage 有許多同一片葉子連拍的近似重複圖片；notebook 隨機的
+train_test_split 會把它們分散到 train/valid/test，高估測試準確率，
+訓練時也重複計算幾乎相同的樣本。
+
+- 以行程池平行計算每張圖片的 pHash（32x32 DCT 低頻 8x8）與 dHash（9x8 水平
+  梯度），各壓縮為一個 uint64；雜湊依 manifest 的檔名、大小與 mtime 快取，
+  只計算新增或變動的圖片
+- HammingIndex 以多重索引雜湊（multi-index hashing）查詢：64 位元切成
+  radius + 1 段，距離不超過 radius 的兩個雜湊至少有一段完全相同，只需比較
+  同段相同的候選，再以 SWAR popcount 向量化計算漢明距離
+- pHash 距離不超過 --phash-radius 且 dHash 距離不超過 --dhash-radius 的
+  配對以連通元件合併為群組，dataset_splits 依群組切分（同群組不跨切分），
+  並可選擇限制 train 中每個群組的張數
+
+用法：
+    python near_duplicates.py scan
+    python near_duplicates.py split dedup --max-per-group 3
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from dataset_index import default_index_path, load_index
+from dataset_splits import SEED, compute_rows, create_split
+
+HASH_VERSION = 1
+HASH_SIZE = 8            # 8x8 = 64 位元
+PHASH_RADIUS = 6         # pHash 漢明距離上限
+DHASH_RADIUS = 10        # dHash 漢明距離上限（確認 pHash 候選）
+# 每次展開的候選配對上限，限制記憶體用量
+MAX_CANDIDATES = 4_000_000
+
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+_H01 = np.uint64(0x0101010101010101)
+
+
+def default_hash_path(data_dir):
+    """
+    雜湊快取放在 manifest 旁
+    """
+    return default_index_path(data_dir).replace('_index.npz', '_hashes.npz')
+
+
+def _dct_matrix(n):
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    matrix[0] /= np.sqrt(2)
+    return matrix * np.sqrt(2 / n)
+
+
+_DCT = _dct_matrix(HASH_SIZE * 4)
+
+
+def pack_bits(bits):
+    """
+    [N, 64] 布林陣列 -> [N] uint64（第一個位元為最高位）
+    """
+    return np.packbits(np.asarray(bits, dtype=bool).reshape(-1, 64),
+                       axis=1).view('>u8').ravel().astype(np.uint64)
+
+
+def popcount64(x):
+    """
+    uint64 陣列逐元素的位元數（SWAR，numpy < 2.0 沒有 bitwise_count）
+    """
+    x = np.asarray(x, dtype=np.uint64)
+    x = x - ((x >> np.uint64(1)) & _M1)
+    x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+    x = (x + (x >> np.uint64(4))) & _M4
+    return ((x * _H01) >> np.uint64(56)).astype(np.int32)
+
+
+def hamming(a, b):
+    return popcount64(np.bitwise_xor(a, b))
+
+
+def image_hashes(path):
+    """
+    回傳 (pHash 位元, dHash 位元)，各為 64 個布林值
+
+    以 JPEG draft 直接低解析度解碼，只需原圖一小部分的解碼成本
+    """
+    size = HASH_SIZE * 4
+    with Image.open(path) as img:
+        img.draft('L', (size * 2, size * 2))
+        gray = img.convert('L')
+        pixels = np.asarray(gray.resize((size, size),
+                                        Image.Resampling.LANCZOS),
+                            dtype=np.float64)
+        small = np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE),
+                                       Image.Resampling.LANCZOS),
+                           dtype=np.int16)
+    low = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    # 中位數不含 DC 係數，避免整體亮度主導
+    phash = low > np.median(low[1:])
+    dhash = (small[:, 1:] > small[:, :-1]).ravel()
+    return phash, dhash
+
+
+def _hash_or_none(path):
+    try:
+        return image_hashes(path)
+    except Exception:
+        return None
+
+
+class ImageHashes:
+    """
+    與 manifest 列對齊的 pHash / dHash（uint64）；valid 為 False 的圖片無法解碼
+    """
+
+    def __init__(self, keys, phash, dhash, valid):
+        self.keys = np.asarray(keys, dtype=str)
+        self.phash = np.asarray(phash, dtype=np.uint64)
+        self.dhash = np.asarray(dhash, dtype=np.uint64)
+        self.valid = np.asarray(valid, dtype=bool)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, version=HASH_VERSION, keys=self.keys,
+                 phash=self.phash, dhash=self.dhash, valid=self.valid)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        讀取雜湊快取；不存在或版本不符時回傳 None
+        """
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as f:
+            if int(f['version']) != HASH_VERSION:
+                return None
+            return cls(f['keys'], f['phash'], f['dhash'], f['valid'])
+
+
+def _row_keys(index):
+    """
+    以類別/檔名、大小與 mtime 識別每張圖片，內容變動時鍵值自然改變
+    """
+    return [f"{path}\0{size}\0{mtime}" for path, size, mtime in zip(
+        index.relpaths, index.sizes.tolist(), index.mtimes.tolist())]
+
+
+def compute_hashes(index, path=None, workers=None):
+    """
+    回傳與 index 列對齊的 ImageHashes；只計算快取中沒有的圖片
+    """
+    path = path or default_hash_path(index.data_dir)
+    keys = _row_keys(index)
+    cached = ImageHashes.load(path)
+    known = {}
+    if cached is not None:
+        known = dict(zip(cached.keys.tolist(), range(len(cached))))
+
+    rows = np.array([known.get(key, -1) for key in keys], dtype=np.int64)
+    phash = np.zeros(len(keys), dtype=np.uint64)
+    dhash = np.zeros(len(keys), dtype=np.uint64)
+    valid = np.zeros(len(keys), dtype=bool)
+    hit = rows >= 0
+    if cached is not None:
+        phash[hit] = cached.phash[rows[hit]]
+        dhash[hit] = cached.dhash[rows[hit]]
+        valid[hit] = cached.valid[rows[hit]]
+
+    pending = np.flatnonzero(~hit)
+    if len(pending):
+        paths = [index.filepaths[i] for i in pending.tolist()]
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_hash_or_none, paths, chunksize=64))
+        ok = np.array([r is not None for r in results], dtype=bool)
+        if ok.any():
+            bits = [r for r in results if r is not None]
+            phash[pending[ok]] = pack_bits(np.stack([p for p, _ in bits]))
+            dhash[pending[ok]] = pack_bits(np.stack([d for _, d in bits]))
+        valid[pending] = ok
+        print(f"已計算 {len(pending)} 張圖片的感知雜湊，耗時 "
+              f"{time.perf_counter() - start:.1f} 秒"
+              + (f"（{int((~ok).sum())} 張無法解碼）" if not ok.all() else ''))
+
+    hashes = ImageHashes(keys, phash, dhash, valid)
+    if len(pending) or cached is None or len(cached) != len(keys):
+        hashes.save(path)
+    return hashes
+
+
+class HammingIndex:
+    """
+    uint64 雜湊的多重索引雜湊（multi-index hashing）
+
+    64 位元切成 radius + 1 段；依鴿籠原理，距離不超過 radius 的雜湊至少有
+    一段完全相同。每段各自排序，查詢時以 searchsorted 取出同段相同的候選，
+    再計算完整的漢明距離。
+    """
+
+    def __init__(self, codes, radius):
+        self.codes = np.asarray(codes, dtype=np.uint64)
+        self.radius = radius
+        bounds = np.linspace(0, 64, radius + 2).astype(int)
+        self.segments = list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+        self.tables = []
+        for lo, hi in self.segments:
+            keys = self._segment(self.codes, lo, hi)
+            order = np.argsort(keys, kind='stable')
+            self.tables.append((keys[order], order))
+
+    @staticmethod
+    def _segment(codes, lo, hi):
+        mask = np.uint64((1 << (hi - lo)) - 1)
+        return (codes >> np.uint64(64 - hi)) & mask
+
+    def query(self, code):
+        """
+        回傳與 code 距離不超過 radius 的列號與距離
+        """
+        code = np.uint64(code)
+        candidates = []
+        for (lo, hi), (keys, order) in zip(self.segments, self.tables):
+            key = self._segment(code, lo, hi)
+            start, stop = np.searchsorted(keys, [key, key + np.uint64(1)])
+            candidates.append(order[start:stop])
+        rows = np.unique(np.concatenate(candidates))
+        distances = hamming(self.codes[rows], code)
+        keep = distances <= self.radius
+        return rows[keep], distances[keep]
+
+    def pairs(self):
+        """
+        所有距離不超過 radius 的配對 (i, j)，i < j
+        """
+        n = len(self.codes)
+        found = []
+        for keys, order in self.tables:
+            # 每個元素與同一段落中排在它後面的元素配對
+            stops = np.searchsorted(keys, keys, side='right')
+            counts = stops - np.arange(n) - 1
+            ends = np.cumsum(counts)
+            begin = 0
+            while begin < n:
+                stop = int(np.searchsorted(ends, (ends[begin - 1] if begin
+                                                  else 0) + MAX_CANDIDATES,
+                                           side='right'))
+                stop = max(stop, begin + 1)
+                chunk = counts[begin:stop]
+                left = np.repeat(np.arange(begin, stop), chunk)
+                offsets = np.arange(len(left)) - np.repeat(
+                    np.cumsum(chunk) - chunk, chunk)
+                i, j = order[left], order[left + 1 + offsets]
+                keep = hamming(self.codes[i], self.codes[j]) <= self.radius
+                i, j = i[keep], j[keep]
+                found.append(np.minimum(i, j).astype(np.int64) * n +
+                             np.maximum(i, j))
+                begin = stop
+        pairs = np.unique(np.concatenate(found)) if found else \
+            np.zeros(0, np.int64)
+        return pairs // n, pairs % n
+
+
+def find_groups(hashes, phash_radius=PHASH_RADIUS, dhash_radius=DHASH_RADIUS):
+    """
+    回傳 (每列的群組編號, 配對 i, 配對 j)；無法解碼的圖片各自成一組
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    rows = np.flatnonzero(hashes.valid)
+    i, j = HammingIndex(hashes.phash[rows], phash_radius).pairs()
+    i, j = rows[i], rows[j]
+    confirmed = hamming(hashes.dhash[i], hashes.dhash[j]) <= dhash_radius
+    i, j = i[confirmed], j[confirmed]
+
+    n = len(hashes)
+    graph = coo_matrix((np.ones(len(i), dtype=np.int8), (i, j)), shape=(n, n))
+    _, groups = connected_components(graph, directed=False)
+    return groups.astype(np.int32), i, j
+
+
+def leaked_rows(rows, groups):
+    """
+    valid/test 中與 train 某張圖片屬於同一群組的列數
+    """
+    train_groups = np.unique(groups[rows['train']])
+    return {split: int(np.isin(groups[r], train_groups).sum())
+            for split, r in rows.items() if split != 'train'}
+
+
+def training_rate(root=None):
+    """
+    最新一次訓練記錄的每秒圖片數（中位數）；沒有記錄時回傳 None
+    """
+    try:
+        import metrics_log
+    except ImportError:
+        return None
+    root = root or metrics_log.DEFAULT_RUNS
+    name = metrics_log.latest_run(root)
+    if name is None:
+        return None
+    rates = metrics_log.history(metrics_log.read_run(
+        os.path.join(root, name)))['images_per_sec']
+    rates = rates[np.isfinite(rates)]
+    return float(np.median(rates)) if len(rates) else None
+
+
+def print_groups(index, groups, i, j):
+    sizes = np.bincount(groups)
+    duplicated = sizes[groups] > 1
+    cross = int((index.labels[i] != index.labels[j]).sum())
+    print(f"近似重複配對: {len(i)}（{cross} 對跨類別）")
+    print(f"群組: {len(sizes)}，其中 {int((sizes > 1).sum())} 個有重複，"
+          f"涵蓋 {int(duplicated.sum())} 張圖片；最大群組 {sizes.max()} 張")
+    per_class = np.bincount(index.labels[duplicated],
+                            minlength=len(index.class_names))
+    for label in np.argsort(-per_class)[:5].tolist():
+        if per_class[label]:
+            print(f"  {index.class_names[label]}: {per_class[label]} 張")
+
+
+def main():
+    from data_pipeline import find_data_dir
+
+    parser = argparse.ArgumentParser(description='感知雜湊近似重複索引')
+    parser.add_argument('command', choices=['scan', 'split'])
+    parser.add_argument('name', nargs='?', default='dedup',
+                        help='split 時建立的切分名稱')
+    parser.add_argument('--data-dir', default=find_data_dir())
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--phash-radius', type=int, default=PHASH_RADIUS)
+    parser.add_argument('--dhash-radius', type=int, default=DHASH_RADIUS)
+    parser.add_argument('--ratios', type=float, nargs='+',
+                        default=[0.8, 0.1, 0.1])
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--max-per-group', type=int, default=None,
+                        help='train 中每個群組最多保留的張數')
+    parser.add_argument('--images-per-sec', type=float, default=None,
+                        help='訓練吞吐量（預設取最新訓練記錄）')
+    args = parser.parse_args()
+
+    index = load_index(args.data_dir)
+    hashes = compute_hashes(index, workers=args.workers)
+    start = time.perf_counter()
+    groups, i, j = find_groups(hashes, args.phash_radius, args.dhash_radius)
+    print(f"{len(index)} 張圖片，索引配對耗時 "
+          f"{(time.perf_counter() - start) * 1000:.0f} ms")
+    print_groups(index, groups, i, j)
+
+    notebook = compute_rows(index.labels, args.ratios, args.seed,
+                            stratify=False)
+    leaks = leaked_rows(notebook, groups)
+    print("\nnotebook 隨機切分中與 train 近似重複的圖片: " + '，'.join(
+        f"{split} {count}/{len(notebook[split])}"
+        for split, count in leaks.items()))
+    if args.command == 'scan':
+        return
+
+    split = create_split(index, args.name, args.ratios, args.seed,
+                         groups=groups, max_per_group=args.max_per_group)
+    leaks = leaked_rows(split.rows, groups)
+    print(f"群組切分 {split}，洩漏: " + '，'.join(
+        f"{name} {count}" for name, count in leaks.items()))
+
+    removed = len(notebook['train']) - len(split.rows['train'])
+    rate = args.images_per_sec or training_rate()
+    print(f"\ntrain 減少 {removed} 張圖片"
+          f"（{removed / len(notebook['train']) * 100:.1f}%）")
+    if rate:
+        print(f"以 {rate:.1f} images/sec 計，每個 epoch 少 "
+              f"{removed / rate:.1f} 秒")
+    else:
+        print("沒有訓練記錄，以 --images-per-sec 指定吞吐量即可換算每個 "
+              "epoch 節省的秒數")
+
+
+if __name__ == '__main__':
+    main()
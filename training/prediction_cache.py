@@ -0,0 +1,396 @@
+"""
+內容定址的預測快取：同一張圖片重複送出時不再執行前向傳播
+
+鍵為模型輸入像素（data_pipeline.decode_image 縮放後的 float32）的
+SHA-256 雜湊，並以模型版本（權重、輸入大小、縮放係數與插值方式的雜湊）
+加鹽；換模型或前處理時鍵值自然改變。值為完整的類別機率向量，任意 top-k
+都可由同一筆快取產生。
+
+- 記憶體層：OrderedDict LRU，命中只需數微秒
+- 磁碟層：單一固定大小的組關聯封裝檔（--cache-mb），每組 4 槽、組內取代
+  最久未使用的項目；查詢與寫入只讀寫一組，重新啟動後仍可命中
+- 別名：檔案 (路徑, mtime, 大小) 或請求內容的雜湊對應到像素鍵，完全相同的
+  重複請求連解碼都可略過（只存在記憶體中）
+
+BatchPredictor(cache=...) 只對未命中的圖片執行前向傳播；serve.py 在排入
+微批次前先查詢快取，/metrics 回報命中率與查詢延遲。
+
+用法：
+    python prediction_cache.py --model network.h5 --input 圖片資料夾
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+
+MEMORY_ITEMS = 4096
+MAX_DISK_MB = 256
+PACK_MAGIC = b'PCACHE01'
+PACK_WAYS = 4
+# 魔術字、每筆的機率數、每組槽數、組數
+_HEADER = struct.Struct('<8sIII')
+
+
+def default_cache_dir(data_dir):
+    return os.path.join(os.path.dirname(os.path.abspath(data_dir)), 'cache',
+                        'predictions')
+
+
+def model_version(model, *config):
+    """
+    以所有權重與前處理設定計算模型版本
+    """
+    digest = hashlib.sha1(repr((model.input_shape, config)).encode('utf-8'))
+    for weight in model.weights:
+        digest.update(np.ascontiguousarray(weight.numpy()).tobytes())
+    return digest.hexdigest()
+
+
+def open_prediction_cache(predictor, disk_dir=None, memory_items=MEMORY_ITEMS,
+                          max_disk_mb=MAX_DISK_MB):
+    """
+    依 BatchPredictor 的模型與前處理設定建立快取
+    """
+    version = model_version(predictor.model, predictor.image_size,
+                            predictor.scale, predictor.method)
+    return PredictionCache(version, memory_items, disk_dir, max_disk_mb)
+
+
+def _remove_shard_dirs(directory):
+    """
+    刪除舊版「每筆一個 .bin 檔」的 key[:2] 分層資料夾
+    """
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if len(name) == 2 and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class _PackFile:
+    """
+    磁碟層的單一封裝檔：檔頭後接 num_sets 組、每組 PACK_WAYS 個固定長度的槽
+
+    每個槽為 16 位元組鍵 + 最後使用時間（ns）+ float32 機率向量。鍵的前
+    8 位元組決定所在的組，查詢與寫入只讀寫該組的數百位元組；組內已滿時取代
+    最久未使用的槽。檔案在建立時即延伸為上限大小，之後不再成長，也不需要
+    掃描資料夾或刪檔來淘汰項目。上限或類別數改變時捨棄舊檔重建
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.width = None
+        self._file = None
+
+    @classmethod
+    def open(cls, path, max_bytes):
+        pack = cls(path, max_bytes)
+        try:
+            with open(path, 'rb') as f:
+                magic, width, ways, num_sets = _HEADER.unpack(
+                    f.read(_HEADER.size))
+        except (FileNotFoundError, struct.error):
+            return pack
+        pack._layout(width)
+        size = _HEADER.size + pack.num_sets * pack.set_bytes
+        if (magic, ways, num_sets, os.path.getsize(path)) == \
+                (PACK_MAGIC, PACK_WAYS, pack.num_sets, size):
+            pack._file = open(path, 'r+b')
+        else:
+            pack.width = None
+        return pack
+
+    def _layout(self, width):
+        self.width = width
+        self.record = np.dtype([('key', 'V16'), ('used', '<u8'),
+                                ('probs', '<f4', (width,))])
+        self.set_bytes = self.record.itemsize * PACK_WAYS
+        self.num_sets = max(1, (self.max_bytes - _HEADER.size)
+                            // self.set_bytes)
+
+    def create(self, width):
+        self._layout(width)
+        self._file = open(self.path, 'w+b')
+        self._file.write(_HEADER.pack(PACK_MAGIC, width, PACK_WAYS,
+                                      self.num_sets))
+        # 支援稀疏檔的檔案系統只為實際寫入的區塊配置空間
+        self._file.truncate(_HEADER.size + self.num_sets * self.set_bytes)
+
+    def _read_set(self, key):
+        offset = _HEADER.size + self.set_bytes * (
+            int.from_bytes(key[:8], 'little') % self.num_sets)
+        self._file.seek(offset)
+        slots = np.frombuffer(self._file.read(self.set_bytes), self.record)
+        return offset, slots
+
+    def _write(self, offset, data):
+        self._file.seek(offset)
+        self._file.write(data)
+        self._file.flush()
+
+    def get(self, key):
+        if self._file is None:
+            return None
+        offset, slots = self._read_set(key)
+        for i, slot in enumerate(slots):
+            if slot['key'].tobytes() == key:
+                self._write(offset + i * self.record.itemsize + len(key),
+                            struct.pack('<Q', time.time_ns()))
+                return slot['probs'].copy()
+        return None
+
+    def put(self, key, probs):
+        if len(probs) != self.width:
+            return
+        offset, slots = self._read_set(key)
+        keys = [slot.tobytes() for slot in slots['key']]
+        # 空槽的使用時間為 0，會優先被選用
+        i = keys.index(key) if key in keys else int(np.argmin(slots['used']))
+        self._write(offset + i * self.record.itemsize,
+                    key + struct.pack('<Q', time.time_ns())
+                    + probs.astype('<f4').tobytes())
+
+    def disk_bytes(self):
+        """
+        實際佔用的磁碟空間（以配置的區塊計算）
+        """
+        if self._file is None:
+            return 0
+        stat = os.fstat(self._file.fileno())
+        blocks = getattr(stat, 'st_blocks', None)
+        return stat.st_size if blocks is None else blocks * 512
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class PredictionCache:
+    """
+    記憶體 LRU + 磁碟兩層的預測快取；disk_dir 為 None 時只使用記憶體
+    """
+
+    def __init__(self, version, memory_items=MEMORY_ITEMS, disk_dir=None,
+                 max_disk_mb=MAX_DISK_MB, window=10000):
+        self.version = version
+        self.memory_items = memory_items
+        self.disk_dir = disk_dir and os.path.join(disk_dir, version[:16])
+        self.max_disk_bytes = int(max_disk_mb * 1024 ** 2)
+        self._memory = OrderedDict()
+        self._aliases = OrderedDict()
+        # serve.py 在事件迴圈與模型執行緒中都會存取快取
+        self._lock = threading.Lock()
+        self._salt = version.encode('ascii')
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lookup_us = deque(maxlen=window)
+        self.compute_ms = deque(maxlen=window)
+        self._pack = None
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            _remove_shard_dirs(self.disk_dir)
+            self._pack = _PackFile.open(
+                os.path.join(self.disk_dir, 'predictions.pack'),
+                self.max_disk_bytes)
+
+    def __len__(self):
+        return len(self._memory)
+
+    def key(self, pixels):
+        """
+        模型輸入像素的雜湊（含形狀與模型版本），取 128 位元
+
+        一律以 float32 雜湊：推論與伺服器都以 data_pipeline.decode_image
+        解碼縮放，同一張圖片在兩者得到相同的鍵
+        """
+        pixels = np.ascontiguousarray(pixels, dtype=np.float32)
+        digest = hashlib.sha256(self._salt)
+        digest.update(f"{pixels.shape}".encode('ascii'))
+        digest.update(pixels.data)
+        return digest.hexdigest()[:32]
+
+    @staticmethod
+    def bytes_alias(data):
+        return 'b:' + hashlib.sha256(data).hexdigest()[:32]
+
+    @staticmethod
+    def file_alias(path):
+        stat = os.stat(path)
+        return f"f:{os.path.abspath(path)}\0{stat.st_mtime_ns}\0{stat.st_size}"
+
+    def _remember(self, key, probs):
+        with self._lock:
+            self._memory[key] = probs
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        依序查詢記憶體與磁碟；磁碟命中時放回記憶體層
+        """
+        start = time.perf_counter()
+        from_disk = False
+        with self._lock:
+            probs = self._memory.get(key)
+            if probs is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+            elif self._pack is not None:
+                probs = self._pack.get(bytes.fromhex(key))
+                from_disk = probs is not None
+        if from_disk:
+            self._remember(key, probs)
+            self.disk_hits += 1
+        if probs is None:
+            self.misses += 1
+        self.lookup_us.append((time.perf_counter() - start) * 1e6)
+        return probs
+
+    def put(self, key, probs):
+        probs = np.asarray(probs, dtype=np.float32)
+        self._remember(key, probs)
+        if self._pack is None:
+            return
+        with self._lock:
+            if self._pack.width is None:
+                self._pack.create(len(probs))
+            self._pack.put(bytes.fromhex(key), probs)
+
+    def get_alias(self, alias):
+        """
+        依別名取得預測；別名未知時回傳 None（不計入未命中）
+        """
+        with self._lock:
+            key = self._aliases.get(alias)
+        return None if key is None else self.get(key)
+
+    def set_alias(self, alias, key):
+        with self._lock:
+            self._aliases[alias] = key
+            self._aliases.move_to_end(alias)
+            while len(self._aliases) > self.memory_items * 4:
+                self._aliases.popitem(last=False)
+
+    def record_compute(self, seconds, count):
+        """
+        記錄未命中時每張圖片的前向傳播時間
+        """
+        if count:
+            self.compute_ms.extend([seconds * 1000 / count] * count)
+
+    def close(self):
+        if self._pack is not None:
+            self._pack.close()
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+
+        def percentile(values, q):
+            return round(float(np.percentile(values, q)), 3) if values \
+                else None
+
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': round((lookups - self.misses) / lookups, 4)
+            if lookups else None,
+            'memory_items': len(self._memory),
+            'disk_mb': round(self._pack.disk_bytes() / 1024 ** 2, 2)
+            if self._pack is not None else 0.0,
+            'lookup_us': {'p50': percentile(self.lookup_us, 50),
+                          'p95': percentile(self.lookup_us, 95)},
+            'compute_ms_per_image': {'p50': percentile(self.compute_ms, 50)},
+        }
+
+
+def print_stats(stats):
+    print(f"預測快取: 命中 {stats['memory_hits']}（記憶體）+ "
+          f"{stats['disk_hits']}（磁碟），未命中 {stats['misses']}"
+          + (f"，命中率 {stats['hit_rate'] * 100:.1f}%"
+             if stats['hit_rate'] is not None else ''))
+    lookup, compute = stats['lookup_us'], stats['compute_ms_per_image']
+    if lookup['p50'] is not None:
+        print(f"  查詢 p50 {lookup['p50']:.1f} µs  p95 {lookup['p95']:.1f} µs"
+              + (f"，未命中時每張前向傳播 {compute['p50']:.2f} ms"
+                 if compute['p50'] is not None else ''))
+
+
+def benchmark(predictor, paths):
+    """
+    量測未命中、記憶體命中（路徑別名與像素鍵）與磁碟命中的每張延遲
+
+    磁碟層使用暫存資料夾，避免既有快取讓「未命中」變成命中；
+    回傳 {情境: 每張圖片毫秒數}
+    """
+    with tempfile.TemporaryDirectory() as disk_dir:
+        return _benchmark(predictor, paths, disk_dir)
+
+
+def _benchmark(predictor, paths, disk_dir):
+    def per_image(fn, *args):
+        start = time.perf_counter()
+        fn(*args)
+        return (time.perf_counter() - start) * 1000 / len(paths)
+
+    predictor.cache = None
+    images = np.concatenate([batch.numpy() for batch in
+                             predictor.path_dataset(paths)])
+    # 暖機：兩個前向傳播函式各追蹤一次
+    predictor.predict_paths(paths[:predictor.batch_size])
+    predictor.predict_probs(images[:1])
+    results = {'無快取': per_image(predictor.predict_paths, paths)}
+
+    cache = open_prediction_cache(predictor, disk_dir)
+    predictor.cache = cache
+    results['未命中（含寫入快取）'] = per_image(predictor.predict_paths, paths)
+    results['記憶體命中：路徑'] = per_image(predictor.predict_paths, paths)
+
+    def by_pixels():
+        for start in range(0, len(images), predictor.batch_size):
+            predictor.predict_batch(images[start:start + predictor.batch_size])
+
+    results['記憶體命中：像素'] = per_image(by_pixels)
+    # 新的快取實例：記憶體層為空，全部由磁碟層命中
+    cache.close()
+    predictor.cache = PredictionCache(cache.version, disk_dir=disk_dir)
+    results['磁碟命中：像素'] = per_image(by_pixels)
+    predictor.cache.close()
+
+    for name, ms in results.items():
+        print(f"{name:<16s} {ms * 1000:12.1f} µs/張")
+    print_stats(predictor.cache.stats())
+    return results
+
+
+def main():
+    from data_pipeline import RESCALE, find_data_dir
+    from inference import BatchPredictor, list_image_files, load_class_names
+
+    parser = argparse.ArgumentParser(description='預測快取延遲量測')
+    parser.add_argument('--model', required=True)
+    parser.add_argument('--input', required=True, help='圖片資料夾')
+    parser.add_argument('--data-dir', default=find_data_dir(),
+                        help='用於取得類別名稱的訓練資料夾')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--scale', type=float, default=RESCALE,
+                        help='模型輸入縮放（自訂 CNN 內含 Rescaling 時用 1.0）')
+    args = parser.parse_args()
+
+    predictor = BatchPredictor(args.model, load_class_names(args.data_dir),
+                               batch_size=args.batch_size, scale=args.scale)
+    benchmark(predictor, list_image_files(args.input))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+"""
+漸進式解析度訓練：先以低解析度、大批次訓練，依排程逐步提高到 224px
+
+排程以 "解析度:批次大小:epochs" 逗號分隔。Xception 以不固定輸入尺寸建立
+（全卷積 + 全域池化），各階段共用同一組權重，只重建該解析度的資料集。
+低解析度階段每步計算量約為 (128/224)^2，可用較大的批次快速走過前期。
+
+除了原本 val_loss 的 patience 3，驗證集 macro-F1 連續 --f1-patience 個 epoch
+沒有提升也視為停滯：低解析度階段停滯時進入下一個解析度，最後階段停滯時
+結束訓練，並還原最後階段中 macro-F1 最高的權重。val_loss 與 macro-F1 由
+同一次驗證走訪計算，不重複執行 Keras 的驗證。
+
+完成後寫出與 train.py 相同格式的 summary.json；指定 --baseline（train.py 的
+summary.json）時另外寫出 progressive_report.md，比較訓練時間與逐類別 F1。
+
+用法：
+    python progressive_train.py --schedule 128:64:8,176:48:8,224:32:24
+    python progressive_train.py --baseline ../runs/<train.py 執行>/summary.json
+"""
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from data_pipeline import IMG_SIZE, build_dataset, get_class_names
+from dataset_splits import split_frames
+from evaluation import ConfusionAccumulator, metrics_from_confusion
+from train import (
+    PROFILE_OPTIONS,
+    DequeueClock,
+    MetricsLogger,
+    build_model,
+    build_parser,
+    compile_model,
+    evaluate_f1,
+    peak_memory_mb,
+    reject_options,
+)
+
+SCHEDULE = '128:64:8,176:48:8,224:32:24'
+F1_PATIENCE = 2
+F1_MIN_DELTA = 0.001
+# 逐類別 F1 低於基準超過此值才列為退步
+F1_TOLERANCE = 0.005
+
+
+def parse_schedule(text):
+    """
+    "128:64:8,224:32:24" -> [(128, 64, 8), (224, 32, 24)]
+    """
+    stages = []
+    for item in text.split(','):
+        size, batch_size, epochs = (int(v) for v in item.split(':'))
+        stages.append((size, batch_size, epochs))
+    return stages
+
+
+class PlateauStop(tf.keras.callbacks.Callback):
+    """
+    每個 epoch 以單次驗證走訪同時計算 val_loss、val_accuracy 與 macro-F1
+    （fit 不另外傳入 validation_data），並寫入 logs 供 ReduceLROnPlateau
+    與 History 使用
+
+    val_loss 連續 loss_patience 個 epoch 未改善，或 macro-F1 連續
+    f1_patience 個 epoch 未提升 min_delta 時：
+    - 非最後階段：結束該階段，進入下一個解析度
+    - 最後階段：結束訓練；只有最後階段保留 macro-F1 最高的權重
+
+    不同解析度的指標無法互相比較，每個階段開始時以 begin_stage 重設。
+    """
+
+    def __init__(self, num_classes, loss_patience=3, f1_patience=F1_PATIENCE,
+                 min_delta=F1_MIN_DELTA):
+        super().__init__()
+        self.num_classes = num_classes
+        self.loss_patience = loss_patience
+        self.f1_patience = f1_patience
+        self.min_delta = min_delta
+        self.valid_ds = None
+        self.final = False
+        self.best_epoch = None
+        self.best_weights = None
+        self.stopped = None
+        self.stage_stopped = None
+        self.macro_f1 = []
+        self._predict = None
+
+    def begin_stage(self, valid_ds, final):
+        self.valid_ds = valid_ds
+        self.final = final
+        self.best_loss = np.inf
+        self.loss_wait = 0
+        self.best_f1 = -1.0
+        self.f1_wait = 0
+        self.stage_stopped = None
+
+    def _validate(self):
+        if self._predict is None:
+            @tf.function
+            def predict(images, labels):
+                probs = tf.cast(self.model(images, training=False),
+                                tf.float32)
+                loss = tf.reduce_sum(
+                    tf.keras.losses.categorical_crossentropy(labels, probs))
+                return (loss, tf.argmax(labels, axis=1, output_type=tf.int32),
+                        tf.argmax(probs, axis=1, output_type=tf.int32))
+
+            self._predict = predict
+        accumulator = ConfusionAccumulator(self.num_classes)
+        total_loss, count = 0.0, 0
+        for images, labels in self.valid_ds:
+            loss, y_true, y_pred = self._predict(images, labels)
+            total_loss += float(loss)
+            count += len(y_true)
+            accumulator.update(y_true.numpy(), y_pred.numpy())
+        return (total_loss / max(count, 1),
+                metrics_from_confusion(accumulator.matrix))
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs if logs is not None else {}
+        val_loss, metrics = self._validate()
+        f1 = metrics['macro_f1']
+        logs.update(val_loss=val_loss, val_accuracy=metrics['accuracy'])
+        self.macro_f1.append(f1)
+        print(f"驗證集 loss: {val_loss:.4f}  accuracy: "
+              f"{metrics['accuracy']:.4f}  macro F1: {f1:.4f}")
+
+        if val_loss < self.best_loss:
+            self.best_loss, self.loss_wait = val_loss, 0
+        else:
+            self.loss_wait += 1
+        if f1 > self.best_f1 + self.min_delta:
+            self.f1_wait = 0
+        else:
+            self.f1_wait += 1
+        if f1 > self.best_f1:
+            self.best_f1 = f1
+            if self.final:
+                self.best_epoch = epoch + 1
+                self.best_weights = self.model.get_weights()
+
+        if self.f1_wait >= self.f1_patience:
+            self.stage_stopped = 'macro_f1'
+        elif self.loss_wait >= self.loss_patience:
+            self.stage_stopped = 'val_loss'
+        if self.stage_stopped:
+            if self.final:
+                self.stopped = self.stage_stopped
+                print(f"早停（{self.stopped} 停滯）於 epoch {epoch + 1}")
+            else:
+                print(f"{self.stage_stopped} 停滯，於 epoch {epoch + 1} "
+                      f"進入下一個解析度")
+            self.model.stop_training = True
+
+
+def train(args):
+    """
+    依排程訓練，回傳摘要並寫出 summary.json 與 model.h5
+    """
+    tf.keras.utils.set_random_seed(args.seed)
+    tf.keras.mixed_precision.set_global_policy(args.precision)
+
+    train_df, valid_df, test_df = split_frames(args.data_dir, args.split,
+                                              args.seed)
+    if test_df is None:
+        test_df = valid_df
+    class_names = get_class_names(train_df)
+    schedule = parse_schedule(args.schedule)
+
+    model = build_model(len(class_names), image_size=(None, None),
+                        weights=args.weights)
+    trainer = compile_model(model, args)
+    output_dir = os.path.join(args.output, args.name or
+                              f"progressive_{time.strftime('%Y%m%d-%H%M%S')}")
+    plateau = PlateauStop(len(class_names), f1_patience=args.f1_patience)
+    clock = DequeueClock()
+    history, stages = {}, []
+    epoch = 0
+
+    start = time.perf_counter()
+    for stage, (size, batch_size, epochs) in enumerate(schedule):
+        image_size = (size, size)
+        print(f"\n=== {size}px，批次 {batch_size}，最多 {epochs} 個 epoch ===")
+        train_ds = build_dataset(train_df, class_names, training=True,
+                                 batch_size=batch_size, image_size=image_size,
+                                 seed=args.seed)
+        plateau.begin_stage(
+            build_dataset(valid_df, class_names, batch_size=batch_size,
+                          image_size=image_size),
+            final=stage == len(schedule) - 1)
+        logger = MetricsLogger(output_dir, batch_size, args.log_every, clock,
+                               run_kind='progressive')
+        stage_start = time.perf_counter()
+        # plateau 須在 ReduceLROnPlateau 之前，先把 val_loss 寫入 logs
+        result = trainer.fit(
+            clock.wrap(train_ds), initial_epoch=epoch, epochs=epoch + epochs,
+            steps_per_epoch=args.steps_per_epoch,
+            callbacks=[plateau, tf.keras.callbacks.ReduceLROnPlateau(
+                monitor='val_loss', factor=0.5, patience=1, verbose=1),
+                logger],
+            verbose=1)
+        ran = len(result.history['loss'])
+        epoch += ran
+        for key, values in result.history.items():
+            history.setdefault(key, []).extend(float(v) for v in values)
+        stages.append({'image_size': size, 'batch_size': batch_size,
+                       'epochs_run': ran, 'ended_by': plateau.stage_stopped,
+                       'seconds': time.perf_counter() - stage_start,
+                       'timing': logger.summary()})
+    train_seconds = time.perf_counter() - start
+
+    if plateau.best_weights is not None:
+        trainer.set_weights(plateau.best_weights)
+    test_ds = build_dataset(test_df, class_names, image_size=IMG_SIZE)
+    os.makedirs(output_dir, exist_ok=True)
+    history['val_macro_f1'] = plateau.macro_f1
+    summary = {
+        'config': vars(args),
+        'schedule': stages,
+        'epochs_run': epoch,
+        'best_epoch': plateau.best_epoch,
+        'stopped_by': plateau.stopped,
+        'train_seconds': train_seconds,
+        'memory': peak_memory_mb(),
+        'history': history,
+        'test': evaluate_f1(model, test_ds, class_names),
+    }
+    with open(os.path.join(output_dir, 'summary.json'), 'w',
+              encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    model.save(os.path.join(output_dir, 'model.h5'))
+
+    print(f"\n訓練時間: {train_seconds:.1f} 秒，{epoch} 個 epoch"
+          f"（最佳 epoch {plateau.best_epoch}）")
+    print(f"測試集準確率: {summary['test']['accuracy']:.4f}  "
+          f"macro F1: {summary['test']['macro_f1']:.4f}")
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        report = compare(summary, baseline)
+        with open(os.path.join(output_dir, 'progressive_report.md'), 'w',
+                  encoding='utf-8') as f:
+            f.write(report)
+        print('\n' + report)
+    print(f"結果已寫入 {output_dir}")
+    return summary
+
+
+def compare(summary, baseline, tolerance=F1_TOLERANCE):
+    """
+    與 train.py 基準比較訓練時間、整體指標與逐類別 F1，回傳 Markdown 報告
+    """
+    test, base = summary['test'], baseline['test']
+    speedup = baseline['train_seconds'] / summary['train_seconds']
+    lines = [
+        '| | 基準 (224px) | 漸進式解析度 |',
+        '| --- | --- | --- |',
+        f"| 訓練時間 | {baseline['train_seconds'] / 60:.1f} 分鐘 | "
+        f"{summary['train_seconds'] / 60:.1f} 分鐘 ({speedup:.2f}x) |",
+        f"| Epochs | {baseline['epochs_run']} | {summary['epochs_run']} |",
+        f"| 測試集準確率 | {base['accuracy']:.4f} | {test['accuracy']:.4f} |",
+        f"| macro F1 | {base['macro_f1']:.4f} | {test['macro_f1']:.4f} |",
+        f"| weighted F1 | {base['weighted_f1']:.4f} | "
+        f"{test['weighted_f1']:.4f} |",
+    ]
+    per_class = test['per_class_f1']
+    base_per_class = base['per_class_f1']
+    shared = [name for name in base_per_class if name in per_class]
+    regressed = [(name, base_per_class[name], per_class[name])
+                 for name in shared
+                 if per_class[name] < base_per_class[name] - tolerance]
+    lines += ['', f"達到基準 F1（容許 {tolerance}）的類別: "
+              f"{len(shared) - len(regressed)}/{len(shared)}"]
+    if regressed:
+        lines += ['', '| 類別 | 基準 F1 | 漸進式 F1 |', '| --- | --- | --- |']
+        lines += [f"| {name} | {b:.4f} | {p:.4f} |"
+                  for name, b, p in sorted(regressed,
+                                           key=lambda r: r[2] - r[1])]
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = build_parser()
+    parser.description = '漸進式解析度訓練'
+    parser.add_argument('--schedule', default=SCHEDULE,
+                        help='解析度:批次大小:epochs，以逗號分隔')
+    parser.add_argument('--f1-patience', type=int, default=F1_PATIENCE,
+                        help='驗證集 macro-F1 未提升幾個 epoch 即停止')
+    parser.add_argument('--baseline', default=None,
+                        help='train.py 的 summary.json，用來產生比較報告')
+    args = parser.parse_args()
+    # 批次大小與 epoch 數由 --schedule 決定
+    reject_options(parser, args, ('--epochs', '--batch-size', '--tensor-cache',
+                                  *PROFILE_OPTIONS), '漸進式訓練')
+    if args.weights == 'none':
+        args.weights = None
+    train(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""
+訓練後 INT8 全整數量化，並以逐類別 F1 作為精度回歸閘門
+
+校正資料從 train_df 依 Labels 分層抽樣；量化後在測試集重新評估，
+任一類別的 F1 下降超過門檻即視為失敗，不寫出量化模型。
+
+用法：
+    python quantize.py --model xception.h5 --output ../exported
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from data_pipeline import (
+    AUTOTUNE,
+    IMG_SIZE,
+    RESCALE,
+    SEED,
+    find_data_dir,
+    get_class_names,
+    load_image,
+)
+from dataset_splits import split_frames
+from evaluation import evaluate_predictions
+from export_model import TFLitePredictor, fold_model
+
+MAX_F1_DROP = 0.01
+CALIBRATION_SAMPLES = 500
+
+
+def stratified_sample(df, num_samples=CALIBRATION_SAMPLES, seed=SEED):
+    """
+    依 Labels 分層抽樣，每個類別至少一張
+    """
+    fraction = min(1.0, num_samples / len(df))
+    rng = np.random.default_rng(seed)
+    rows = []
+    for indices in df.groupby('Labels').indices.values():
+        count = max(1, round(len(indices) * fraction))
+        rows.extend(rng.choice(indices, count, replace=False))
+    return df.iloc[rng.permutation(rows)]
+
+
+def _image_dataset(df, batch_size, scale):
+    ds = tf.data.Dataset.from_tensor_slices(df['Filepaths'].astype(str).values)
+    ds = ds.map(lambda p: load_image(p, IMG_SIZE) * scale,
+                num_parallel_calls=AUTOTUNE, deterministic=True)
+    return ds.batch(batch_size).prefetch(AUTOTUNE)
+
+
+def representative_dataset(df, scale):
+    """
+    TFLite 轉換器使用的校正資料產生器（每次一張）
+    """
+    def generator():
+        for image in _image_dataset(df, 1, scale):
+            yield [image]
+    return generator
+
+
+def convert(model, calibration_df=None, scale=RESCALE):
+    """
+    轉換為 TFLite；提供 calibration_df 時進行 INT8 全整數量化
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(fold_model(model))
+    if calibration_df is not None:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset(
+            calibration_df, scale)
+        converter.target_spec.supported_ops = [
+            tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+    return converter.convert()
+
+
+def per_class_f1(predict_fn, df, class_names, batch_size=32, scale=RESCALE):
+    """
+    對測試集計算準確率與逐類別 precision / recall / F1
+    """
+    class_index = {name: i for i, name in enumerate(class_names)}
+    y_true = df['Labels'].map(class_index).values
+    y_pred = np.concatenate([np.argmax(predict_fn(images.numpy()), axis=1)
+                             for images in _image_dataset(df, batch_size,
+                                                          scale)])
+    metrics, _ = evaluate_predictions(y_true, y_pred, len(class_names))
+    return {
+        'accuracy': metrics['accuracy'],
+        'macro_f1': metrics['macro_f1'],
+        'precision': metrics['precision'].tolist(),
+        'recall': metrics['recall'].tolist(),
+        'f1': metrics['f1'].tolist(),
+        'support': metrics['support'].tolist(),
+    }
+
+
+def measure_speed(predictor, batch_size=32, repeats=20):
+    """
+    量測單張延遲（p50，毫秒）與批次吞吐量（images/sec）
+    """
+    rng = np.random.default_rng(0)
+    single = rng.uniform(0, 1, (1, *IMG_SIZE, 3)).astype(np.float32)
+    batch = rng.uniform(0, 1, (batch_size, *IMG_SIZE, 3)).astype(np.float32)
+
+    predictor(single)
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        predictor(single)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    predictor(batch)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        predictor(batch)
+    throughput = repeats * batch_size / (time.perf_counter() - start)
+    return float(np.median(latencies)), throughput
+
+
+def compare_f1(baseline, quantized, class_names, max_drop=MAX_F1_DROP):
+    """
+    回傳 F1 下降超過門檻的類別 [(類別, 原 F1, 量化後 F1), ...]
+    """
+    failures = []
+    for name, before, after in zip(class_names, baseline['f1'],
+                                   quantized['f1']):
+        if before - after > max_drop:
+            failures.append((name, before, after))
+    return failures
+
+
+def quantize(model_path, output_dir, train_df, test_df, class_names,
+             max_drop=MAX_F1_DROP, num_samples=CALIBRATION_SAMPLES,
+             scale=RESCALE):
+    """
+    量化並執行精度閘門；通過時寫出 INT8 模型與報告，否則結束碼為 1
+
+    浮點模型的 F1 以原 Keras 模型評估，大小與速度則以浮點 TFLite 比較
+    """
+    model = tf.keras.models.load_model(model_path, compile=False)
+    calibration_df = stratified_sample(train_df, num_samples)
+    print(f"校正樣本: {len(calibration_df)} 張，"
+          f"涵蓋 {calibration_df['Labels'].nunique()} 個類別")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        float_path = os.path.join(tmp, 'float.tflite')
+        int8_path = os.path.join(tmp, 'int8.tflite')
+        with open(float_path, 'wb') as f:
+            f.write(convert(model, scale=scale))
+        with open(int8_path, 'wb') as f:
+            f.write(convert(model, calibration_df, scale=scale))
+
+        print("評估浮點模型...")
+        baseline = per_class_f1(
+            lambda x: model(x, training=False).numpy(), test_df, class_names,
+            scale=scale)
+        print("評估 INT8 模型...")
+        int8_predictor = TFLitePredictor(int8_path)
+        quantized = per_class_f1(int8_predictor, test_df, class_names,
+                                 scale=scale)
+
+        float_latency, float_throughput = measure_speed(
+            TFLitePredictor(float_path))
+        int8_latency, int8_throughput = measure_speed(int8_predictor)
+
+        report = {
+            'max_f1_drop': max_drop,
+            'float': {'size_mb': os.path.getsize(float_path) / 1024 ** 2,
+                      'latency_ms': float_latency,
+                      'throughput': float_throughput, **baseline},
+            'int8': {'size_mb': os.path.getsize(int8_path) / 1024 ** 2,
+                     'latency_ms': int8_latency,
+                     'throughput': int8_throughput, **quantized},
+            'class_names': class_names,
+        }
+
+        print(f"\n{'':<8s} {'大小(MB)':>9s} {'延遲(ms)':>9s} "
+              f"{'images/sec':>11s} {'準確率':>8s} {'macro F1':>9s}")
+        for key in ('float', 'int8'):
+            r = report[key]
+            print(f"{key:<8s} {r['size_mb']:>9.2f} {r['latency_ms']:>9.2f} "
+                  f"{r['throughput']:>11.1f} {r['accuracy']:>8.4f} "
+                  f"{r['macro_f1']:>9.4f}")
+
+        failures = compare_f1(baseline, quantized, class_names, max_drop)
+        report['failed_classes'] = [name for name, _, _ in failures]
+
+        name = os.path.splitext(os.path.basename(model_path))[0]
+        os.makedirs(output_dir, exist_ok=True)
+        with open(os.path.join(output_dir, f"{name}_int8_report.json"), 'w',
+                  encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+        if failures:
+            print(f"\n量化失敗：{len(failures)} 個類別 F1 下降超過 {max_drop}")
+            for class_name, before, after in failures:
+                print(f"  {class_name}: {before:.4f} -> {after:.4f}")
+            return None
+
+        output_path = os.path.join(output_dir, f"{name}_int8.tflite")
+        shutil.move(int8_path, output_path)
+    print(f"\n已通過精度閘門，匯出：{output_path}")
+    return output_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='INT8 訓練後量化')
+    parser.add_argument('--model', required=True)
+    parser.add_argument('--data-dir', default=find_data_dir())
+    parser.add_argument('--output', default='../exported')
+    parser.add_argument('--split', default=None,
+                        help='dataset_splits 的切分名稱（預設同 notebook）')
+    parser.add_argument('--max-f1-drop', type=float, default=MAX_F1_DROP,
+                        help='允許的單一類別 F1 最大下降幅度')
+    parser.add_argument('--samples', type=int, default=CALIBRATION_SAMPLES,
+                        help='校正樣本數')
+    parser.add_argument('--scale', type=float, default=RESCALE,
+                        help='模型輸入縮放（自訂 CNN 內含 Rescaling 時用 1.0）')
+    args = parser.parse_args()
+
+    train_df, valid_df, test_df = split_frames(args.data_dir, args.split)
+    if test_df is None:
+        test_df = valid_df
+    result = quantize(args.model, args.output, train_df, test_df,
+                      get_class_names(train_df), args.max_f1_drop,
+                      args.samples, args.scale)
+    if result is None:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,467 @@
+"""
+可中斷續訓的 Xception 訓練：背景執行緒非同步寫出檢查點，重新執行相同指令即從
+中斷的步驟繼續
+
+- 檢查點包含模型權重、優化器狀態（iterations 與各 slot）、學習率衰減與早停
+  計數、目前最佳權重，以及輸入迭代器的位置（epoch 與 epoch 內的步數）
+- 每個 epoch 的資料順序只由 (seed, epoch) 決定；續訓時重建該 epoch 的順序，
+  在解碼前以檔案路徑略過已訓練的批次；資料增強的隨機參數由 (seed, epoch,
+  批次編號) 決定，續訓後的批次內容與增強都與未中斷時完全相同
+- 訓練迴圈只在主執行緒把變數複製到主機記憶體，序列化與寫檔由背景執行緒完成；
+  以暫存檔 + os.replace 寫入，只保留最近 --keep-checkpoints 個檢查點
+- 收到 SIGTERM / SIGINT（搶佔、Ctrl+C）時在目前步驟結束後存檔並離開
+
+學習率衰減與早停與 train.build_callbacks 相同：val_loss 未改善即學習率減半，
+連續 3 個 epoch 未改善則停止並還原最佳權重。
+
+用法：
+    python resumable_train.py --name xception --checkpoint-every 200
+    # 中斷後執行相同指令即繼續
+"""
+import glob
+import json
+import os
+import re
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from data_pipeline import finalize_batches, get_class_names, load_image
+from dataset_splits import split_frames
+from metrics_log import MetricsWriter
+from train import (
+    PROFILE_OPTIONS,
+    build_model,
+    build_parser,
+    evaluate_f1,
+    peak_memory_mb,
+    reject_options,
+)
+
+CHECKPOINT_EVERY = 200
+KEEP_CHECKPOINTS = 3
+
+
+def epoch_order(num_rows, epoch, seed):
+    """
+    某個 epoch 的資料順序，只由 (seed, epoch) 決定
+    """
+    return np.random.default_rng([seed, epoch]).permutation(num_rows)
+
+
+def epoch_dataset(frame, class_names, epoch, start_step, batch_size, seed):
+    """
+    建立某個 epoch 從 start_step 開始的訓練資料集
+
+    已訓練的批次在讀檔前就以路徑略過，續訓不需重新解碼前面的圖片；
+    資料增強的批次編號從 start_step 起算
+    """
+    class_index = {name: i for i, name in enumerate(class_names)}
+    order = epoch_order(len(frame), epoch, seed)[start_step * batch_size:]
+    paths = frame['Filepaths'].astype(str).values[order]
+    labels = frame['Labels'].map(class_index).values.astype(np.int32)[order]
+
+    ds = tf.data.Dataset.from_tensor_slices((paths, labels))
+    ds = ds.map(lambda path, label: (load_image(path), label),
+                num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    ds = ds.batch(batch_size)
+    return finalize_batches(ds, len(class_names), training=True,
+                            seed=seed + epoch, first_batch=start_step)
+
+
+def _optimizer_variables(optimizer):
+    variables = optimizer.variables
+    return list(variables() if callable(variables) else variables)
+
+
+def _build_optimizer(optimizer, model):
+    """
+    先建立優化器的 slot 變數，還原檢查點時才能逐一指定
+    """
+    if hasattr(optimizer, 'build'):
+        optimizer.build(model.trainable_variables)
+    else:
+        optimizer._create_all_weights(model.trainable_variables)
+
+
+class ResumeState:
+    """
+    需要跨中斷保存的純 Python 訓練狀態（寫入檢查點的 JSON）
+    """
+
+    def __init__(self, lr):
+        self.epoch = 0
+        self.step = 0                 # epoch 內已完成的步數
+        self.global_step = 0
+        self.lr = lr
+        self.best_loss = float('inf')
+        self.wait = 0                 # 早停：連續未改善的 epoch 數
+        self.lr_best = float('inf')
+        self.lr_wait = 0              # 學習率衰減：連續未改善的 epoch 數
+        self.loss_sum = 0.0           # 目前 epoch 的累計值（mid-epoch 續訓用）
+        self.correct = 0.0
+        self.seen = 0
+        self.train_seconds = 0.0
+        self.stopped = False
+        self.history = {'loss': [], 'accuracy': [], 'val_loss': [],
+                        'val_accuracy': [], 'learning_rate': []}
+
+    def to_json(self):
+        return json.dumps(self.__dict__)
+
+    @classmethod
+    def from_json(cls, text):
+        state = cls(0.0)
+        state.__dict__.update(json.loads(text))
+        return state
+
+    def update(self, val_loss, patience=3, lr_factor=0.5, min_delta=1e-4):
+        """
+        epoch 結束時更新早停與學習率衰減，回傳是否為目前最佳
+
+        與 EarlyStopping(patience) 及 ReduceLROnPlateau(factor, patience=1,
+        min_delta=1e-4) 的判斷相同
+        """
+        improved = val_loss < self.best_loss
+        if improved:
+            self.best_loss = val_loss
+            self.wait = 0
+        else:
+            self.wait += 1
+            self.stopped = self.wait >= patience
+        if val_loss < self.lr_best - min_delta:
+            self.lr_best = val_loss
+            self.lr_wait = 0
+        else:
+            self.lr_wait += 1
+            if self.lr_wait >= 1:
+                self.lr *= lr_factor
+                self.lr_wait = 0
+                print(f"val_loss 未改善，學習率降為 {self.lr:.2e}")
+        return improved
+
+
+class AsyncCheckpointer:
+    """
+    由背景執行緒寫出檢查點；同時最多只有一個寫入進行中
+
+    save() 只在呼叫端複製變數值（numpy），序列化與寫檔不阻塞訓練迴圈
+    """
+
+    def __init__(self, directory, keep=KEEP_CHECKPOINTS):
+        self.directory = directory
+        self.keep = keep
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+        os.makedirs(directory, exist_ok=True)
+        # 清除上次寫入到一半被中斷的暫存檔（含舊版的 ckpt-N.npz.tmp.npz）
+        for pattern in ('.ckpt-*.tmp', 'ckpt-*.tmp.npz'):
+            for tmp_path in glob.glob(os.path.join(directory, pattern)):
+                os.remove(tmp_path)
+
+    def _paths(self):
+        steps = []
+        for path in glob.glob(os.path.join(self.directory, 'ckpt-*.npz')):
+            match = re.fullmatch(r'ckpt-(\d+)\.npz', os.path.basename(path))
+            # 略過名稱不符的檔案（例如手動複製的備份）
+            if match:
+                steps.append((int(match.group(1)), path))
+        return [path for _, path in sorted(steps)]
+
+    def latest(self):
+        paths = self._paths()
+        return paths[-1] if paths else None
+
+    def _write(self, path, arrays, state):
+        # 暫存檔以 . 開頭且不以 .npz 結尾，寫入中被中斷也不會被 _paths 讀到
+        tmp_path = os.path.join(self.directory,
+                                f".{os.path.basename(path)[:-4]}.tmp")
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, state=state, **arrays)
+        os.replace(tmp_path, path)
+        for old in self._paths()[:-self.keep]:
+            os.remove(old)
+        return path
+
+    def save(self, step, arrays, state):
+        # 等待上一個寫入完成（並讓寫入錯誤在訓練迴圈中拋出）
+        self.wait()
+        path = os.path.join(self.directory, f"ckpt-{step:08d}.npz")
+        self._pending = self._executor.submit(self._write, path, arrays,
+                                              state)
+
+    def wait(self):
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+    @staticmethod
+    def load(path):
+        """
+        讀取檢查點，回傳 ({名稱: 陣列}, 狀態 JSON)
+        """
+        with np.load(path) as f:
+            arrays = {key: f[key] for key in f.files if key != 'state'}
+            return arrays, str(f['state'])
+
+
+def snapshot(model, optimizer, best_weights):
+    """
+    在主執行緒複製所有需要保存的變數值
+    """
+    arrays = {f"model/{i}": w for i, w in enumerate(model.get_weights())}
+    arrays.update({f"optimizer/{i}": v.numpy() for i, v in
+                   enumerate(_optimizer_variables(optimizer))})
+    if best_weights is not None:
+        arrays.update({f"best/{i}": w for i, w in enumerate(best_weights)})
+    return arrays
+
+
+def restore(arrays, model, optimizer):
+    """
+    將檢查點陣列寫回模型與優化器，回傳最佳權重（沒有則為 None）
+    """
+    def collect(prefix):
+        keys = sorted((k for k in arrays if k.startswith(prefix)),
+                      key=lambda k: int(k.split('/')[1]))
+        return [arrays[k] for k in keys]
+
+    model.set_weights(collect('model/'))
+    for variable, value in zip(_optimizer_variables(optimizer),
+                               collect('optimizer/')):
+        variable.assign(value)
+    return collect('best/') or None
+
+
+class StopRequest:
+    """
+    收到 SIGTERM / SIGINT 時只設定旗標，由訓練迴圈在步驟結束後存檔離開
+    """
+
+    def __init__(self):
+        self.requested = False
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self._handle)
+
+    def _handle(self, signum, frame):
+        print(f"\n收到訊號 {signum}，目前步驟結束後存檔並離開")
+        self.requested = True
+
+
+def train(args):
+    """
+    執行（或繼續）一次可中斷的訓練，完成後寫出 summary.json 與 model.h5
+    """
+    tf.keras.utils.set_random_seed(args.seed)
+    tf.keras.mixed_precision.set_global_policy(args.precision)
+
+    train_df, valid_df, test_df = split_frames(args.data_dir, args.split,
+                                              args.seed)
+    if test_df is None:
+        test_df = valid_df
+    class_names = get_class_names(train_df)
+    steps_per_epoch = args.steps_per_epoch or \
+        -(-len(train_df) // args.batch_size)
+
+    def eval_dataset(frame):
+        class_index = {name: i for i, name in enumerate(class_names)}
+        ds = tf.data.Dataset.from_tensor_slices((
+            frame['Filepaths'].astype(str).values,
+            frame['Labels'].map(class_index).values.astype(np.int32)))
+        ds = ds.map(lambda path, label: (load_image(path), label),
+                    num_parallel_calls=tf.data.AUTOTUNE)
+        return finalize_batches(ds.batch(args.batch_size), len(class_names))
+
+    valid_ds, test_ds = eval_dataset(valid_df), eval_dataset(test_df)
+
+    model = build_model(len(class_names), weights=args.weights)
+    optimizer = tf.keras.optimizers.Adamax(learning_rate=args.lr)
+    _build_optimizer(optimizer, model)
+    loss_fn = tf.keras.losses.CategoricalCrossentropy()
+
+    @tf.function(jit_compile=args.jit_compile)
+    def train_step(images, labels):
+        with tf.GradientTape() as tape:
+            probs = model(images, training=True)
+            loss = loss_fn(labels, probs)
+        grads = tape.gradient(loss, model.trainable_variables)
+        optimizer.apply_gradients(zip(grads, model.trainable_variables))
+        correct = tf.reduce_sum(tf.cast(
+            tf.argmax(probs, 1) == tf.argmax(labels, 1), tf.float32))
+        return loss, correct
+
+    @tf.function
+    def eval_step(images, labels):
+        probs = model(images, training=False)
+        loss = loss_fn(labels, probs) * tf.cast(tf.shape(images)[0],
+                                                tf.float32)
+        correct = tf.reduce_sum(tf.cast(
+            tf.argmax(probs, 1) == tf.argmax(labels, 1), tf.float32))
+        return loss, correct
+
+    output_dir = os.path.join(args.output, args.name)
+    checkpointer = AsyncCheckpointer(os.path.join(output_dir, 'checkpoints'),
+                                     args.keep_checkpoints)
+    state = ResumeState(args.lr)
+    best_weights = None
+    latest = checkpointer.latest()
+    if latest:
+        arrays, text = AsyncCheckpointer.load(latest)
+        state = ResumeState.from_json(text)
+        best_weights = restore(arrays, model, optimizer)
+        print(f"從 {latest} 繼續：epoch {state.epoch + 1} "
+              f"第 {state.step} 步（累計 {state.global_step} 步）")
+
+    def save_checkpoint():
+        start = time.perf_counter()
+        checkpointer.save(state.global_step,
+                          snapshot(model, optimizer, best_weights),
+                          state.to_json())
+        return time.perf_counter() - start
+
+    writer = MetricsWriter(output_dir, 'resumable')
+    stop = StopRequest()
+    snapshot_seconds = []
+
+    while not state.stopped and state.epoch < args.epochs \
+            and not stop.requested:
+        optimizer.learning_rate.assign(state.lr)
+        iterator = iter(epoch_dataset(train_df, class_names, state.epoch,
+                                      state.step, args.batch_size, args.seed))
+        epoch_start = time.perf_counter()
+        step_times, waits = [], []
+        while state.step < steps_per_epoch and not stop.requested:
+            start = time.perf_counter()
+            try:
+                images, labels = next(iterator)
+            except StopIteration:
+                break
+            fetched = time.perf_counter()
+            loss, correct = train_step(images, labels)
+            batch = int(labels.shape[0])
+            state.loss_sum += float(loss) * batch
+            state.correct += float(correct)
+            state.seen += batch
+            state.step += 1
+            state.global_step += 1
+            waits.append(fetched - start)
+            step_times.append(time.perf_counter() - start)
+            if state.global_step % args.checkpoint_every == 0:
+                snapshot_seconds.append(save_checkpoint())
+            if state.global_step % args.log_every == 0:
+                writer.write([{
+                    'kind': 'step', 'epoch': state.epoch + 1,
+                    'step': state.global_step, 'wall_time': time.time(),
+                    'loss': state.loss_sum / state.seen,
+                    'accuracy': state.correct / state.seen,
+                    'learning_rate': state.lr,
+                    'step_time_ms': float(np.mean(step_times[-args.log_every:])
+                                          * 1000),
+                    'input_wait_ms': float(np.mean(waits[-args.log_every:])
+                                           * 1000),
+                    'images_per_sec': float(args.batch_size / np.mean(
+                        step_times[-args.log_every:])),
+                }])
+        state.train_seconds += time.perf_counter() - epoch_start
+        if stop.requested:
+            break
+
+        val_loss, val_correct, val_seen = 0.0, 0.0, 0
+        for images, labels in valid_ds:
+            loss, correct = eval_step(images, labels)
+            val_loss += float(loss)
+            val_correct += float(correct)
+            val_seen += int(labels.shape[0])
+        val_loss /= val_seen
+
+        epoch_row = {
+            'loss': state.loss_sum / max(state.seen, 1),
+            'accuracy': state.correct / max(state.seen, 1),
+            'val_loss': val_loss, 'val_accuracy': val_correct / val_seen,
+            'learning_rate': state.lr,
+        }
+        for key, value in epoch_row.items():
+            state.history[key].append(value)
+        # 第一步含追蹤時間，不列入統計
+        times = np.array(step_times[1:] or step_times or [np.nan])
+        writer.write([dict(
+            epoch_row, kind='epoch', epoch=state.epoch + 1,
+            step=state.global_step, wall_time=time.time(),
+            step_time_ms=float(times.mean() * 1000),
+            input_wait_ms=float(np.mean(waits[1:] or waits or [np.nan])
+                                * 1000),
+            images_per_sec=float(args.batch_size / times.mean()))])
+        print(f"epoch {state.epoch + 1}/{args.epochs}: "
+              f"loss {epoch_row['loss']:.4f}  acc {epoch_row['accuracy']:.4f}"
+              f"  val_loss {val_loss:.4f}  "
+              f"val_acc {epoch_row['val_accuracy']:.4f}  lr {state.lr:.2e}")
+
+        if state.update(val_loss):
+            best_weights = model.get_weights()
+        state.epoch += 1
+        state.step = 0
+        state.loss_sum, state.correct, state.seen = 0.0, 0.0, 0
+        snapshot_seconds.append(save_checkpoint())
+
+    if stop.requested:
+        save_checkpoint()
+    writer.close()
+    checkpointer.close()
+    if stop.requested:
+        print(f"已存檔於第 {state.global_step} 步，重新執行相同指令即可繼續")
+        return None
+
+    if state.stopped:
+        print(f"早停於 epoch {state.epoch}，還原最佳權重")
+    if best_weights is not None:
+        model.set_weights(best_weights)
+    summary = {
+        'config': vars(args),
+        'epochs_run': state.epoch,
+        'global_steps': state.global_step,
+        'train_seconds': state.train_seconds,
+        'checkpoint_snapshot_ms_mean': float(np.mean(snapshot_seconds) * 1000)
+        if snapshot_seconds else None,
+        'memory': peak_memory_mb(),
+        'history': state.history,
+        'test': evaluate_f1(model, test_ds, class_names),
+    }
+    with open(os.path.join(output_dir, 'summary.json'), 'w',
+              encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    model.save(os.path.join(output_dir, 'model.h5'))
+    print(f"測試集準確率: {summary['test']['accuracy']:.4f}  "
+          f"macro F1: {summary['test']['macro_f1']:.4f}")
+    print(f"結果已寫入 {output_dir}")
+    return summary
+
+
+def main():
+    parser = build_parser()
+    parser.description = '可中斷續訓的 Xception 訓練'
+    parser.set_defaults(name='resumable')
+    parser.add_argument('--checkpoint-every', type=int,
+                        default=CHECKPOINT_EVERY,
+                        help='每幾步寫出一個檢查點（每個 epoch 結束也會存檔）')
+    parser.add_argument('--keep-checkpoints', type=int,
+                        default=KEEP_CHECKPOINTS, help='保留的檢查點數量')
+    args = parser.parse_args()
+    if args.weights == 'none':
+        args.weights = None
+    if args.accum_steps > 1 or args.precision == 'mixed_float16':
+        parser.error('可續訓的訓練不支援梯度累積與 mixed_float16 '
+                     '（可使用 mixed_bfloat16）')
+    reject_options(parser, args, ('--tensor-cache', *PROFILE_OPTIONS),
+                   '可續訓的訓練')
+    train(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+"""
+本機 HTTP 預測伺服器，將同時到達的請求動態合併為微批次（micro-batch）
+
+啟動時只載入一次模型；每個請求的圖片放入佇列，背景工作協程在
+max_batch_size 或 max_wait_ms 任一條件達成時送出一個批次。
+
+請求先查詢預測快取（prediction_cache.py）：內容完全相同的請求連解碼都
+略過，解碼後像素相同的請求不進入佇列，只有未命中的圖片會排入微批次。
+
+端點：
+    POST /predict   內容為 JPEG/PNG 圖片位元組，回傳 top-k 類別 JSON
+    GET  /metrics   延遲百分位數（p50/p95/p99）、佇列深度、批次與快取統計
+    GET  /health
+
+用法：
+    python serve.py --model network.h5 --max-batch-size 32 --max-wait-ms 5
+    python serve.py --model network.h5 --cache-dir cache/predictions
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from data_pipeline import RESCALE
+from inference import BatchPredictor, load_class_names
+from prediction_cache import MAX_DISK_MB, MEMORY_ITEMS, open_prediction_cache
+
+MAX_BODY_BYTES = 16 * 1024 ** 2
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+               413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class ServerMetrics:
+    """
+    記錄最近的請求延遲、佇列深度與批次大小
+    """
+
+    def __init__(self, window=10000):
+        self.latencies_ms = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.queue_depths = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.started = time.time()
+
+    def snapshot(self, queue_depth):
+        latencies = np.array(self.latencies_ms) if self.latencies_ms else None
+        depths = np.array(self.queue_depths) if self.queue_depths else None
+        batches = np.array(self.batch_sizes) if self.batch_sizes else None
+
+        def percentile(values, q):
+            return None if values is None else round(
+                float(np.percentile(values, q)), 3)
+
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'uptime_sec': round(time.time() - self.started, 1),
+            'latency_ms': {'p50': percentile(latencies, 50),
+                           'p95': percentile(latencies, 95),
+                           'p99': percentile(latencies, 99)},
+            'queue_depth': {'current': queue_depth,
+                            'mean': None if depths is None
+                            else round(float(depths.mean()), 2),
+                            'max': None if depths is None
+                            else int(depths.max())},
+            'batch_size': {'mean': None if batches is None
+                           else round(float(batches.mean()), 2),
+                           'max': None if batches is None
+                           else int(batches.max()),
+                           'batches': len(self.batch_sizes)},
+        }
+
+
+class MicroBatcher:
+    """
+    將佇列中的請求合併成批次，模型在單一執行緒中執行，不阻塞事件迴圈
+    """
+
+    def __init__(self, predictor, max_batch_size=32, max_wait_ms=5.0,
+                 metrics=None):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.metrics = metrics or ServerMetrics()
+        self.queue = asyncio.Queue()
+        # 模型只在一個執行緒執行，避免同時有多個批次搶 CPU
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, image, key=None):
+        future = asyncio.get_running_loop().create_future()
+        self.metrics.queue_depths.append(self.queue.qsize())
+        await self.queue.put((image, key, future))
+        return await future
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            # Python 3.11 起兩者相同；3.9/3.10（TensorFlow 2.10）仍是不同類別
+            except (TimeoutError, asyncio.TimeoutError):
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            images = np.stack([image for image, _, _ in batch])
+            keys = [key for _, key, _ in batch]
+            self.metrics.batch_sizes.append(len(batch))
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self.predictor.predict_batch, images,
+                    None if None in keys else keys)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+class PredictionServer:
+    """
+    以 asyncio streams 實作的精簡 HTTP/1.1 伺服器（支援 keep-alive）
+    """
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+        self.metrics = batcher.metrics
+        self.predictor = batcher.predictor
+        self.cache = batcher.predictor.cache
+        self._decode_pool = ThreadPoolExecutor()
+
+    def _decode(self, body):
+        """
+        在解碼執行緒中解碼並計算快取鍵，回傳 (圖片, 鍵, 快取結果)
+
+        與 inference.py 使用相同的解碼與縮放（BatchPredictor.decode），
+        兩者對同一張圖片得到相同的快取鍵
+        """
+        image = self.predictor.decode(body)
+        if self.cache is None:
+            return image, None, None
+        key = self.cache.key(image)
+        return image, key, self.cache.get(key)
+
+    async def _read_request(self, reader):
+        """
+        讀取一個請求；內容超過 MAX_BODY_BYTES 時讀取後丟棄並回傳 body=None，
+        請求行或 Content-Length 格式錯誤時拋出 ValueError
+        """
+        header = await reader.readuntil(b'\r\n\r\n')
+        lines = header.decode('latin-1').split('\r\n')
+        method, path, _ = lines[0].split(' ', 2)
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length > MAX_BODY_BYTES:
+            # 讀完並丟棄內容，用戶端才收得到 413 而不是連線被重設
+            while length > 0:
+                chunk = await reader.read(min(length, 1024 ** 2))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b'', length)
+                length -= len(chunk)
+            return method, path, headers, None
+        body = await reader.readexactly(length) if length else b''
+        return method, path, headers, body
+
+    @staticmethod
+    def _write_response(writer, status, payload, keep_alive):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        writer.write(
+            f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+            f"Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+            f"\r\n".encode('latin-1') + body)
+
+    async def _predict(self, body):
+        start = time.perf_counter()
+        top = None
+        if self.cache is not None:
+            # 內容完全相同的重複請求：不解碼、不排隊
+            alias = self.cache.bytes_alias(body)
+            probs = self.cache.get_alias(alias)
+            if probs is not None:
+                top = self.predictor.format_probs(probs)[0]
+        if top is None:
+            loop = asyncio.get_running_loop()
+            image, key, probs = await loop.run_in_executor(
+                self._decode_pool, self._decode, body)
+            if probs is not None:
+                top = self.predictor.format_probs(probs)[0]
+            else:
+                top = await self.batcher.submit(image, key)
+            if key is not None:
+                self.cache.set_alias(alias, key)
+        self.metrics.latencies_ms.append((time.perf_counter() - start) * 1000)
+        return {'predictions': [{'class': name, 'score': score}
+                                for name, score in top]}
+
+    async def _route(self, method, path, body):
+        if method == 'POST' and path == '/predict':
+            if body is None:
+                return 413, {'error': '圖片過大'}
+            if not body:
+                return 400, {'error': '請求內容為空'}
+            self.metrics.requests += 1
+            try:
+                return 200, await self._predict(body)
+            except (OSError, tf.errors.InvalidArgumentError) as e:
+                self.metrics.errors += 1
+                return 400, {'error': f"無法解碼圖片: {e}"}
+        if method == 'GET' and path == '/metrics':
+            snapshot = self.metrics.snapshot(self.batcher.queue.qsize())
+            if self.cache is not None:
+                snapshot['cache'] = self.cache.stats()
+            return 200, snapshot
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+        return 404, {'error': f"找不到 {method} {path}"}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    method, path, headers, body = \
+                        await self._read_request(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except (ValueError, asyncio.LimitOverrunError) as e:
+                    # 無法判斷請求的邊界，回覆後關閉連線
+                    self._write_response(
+                        writer, 400, {'error': f"無法解析請求: {e}"}, False)
+                    await writer.drain()
+                    break
+                # 過大的請求回覆 413 後關閉連線
+                keep_alive = body is not None and \
+                    headers.get('connection', '').lower() != 'close'
+                try:
+                    status, payload = await self._route(method, path, body)
+                except Exception as e:
+                    self.metrics.errors += 1
+                    status, payload = 500, {'error': str(e)}
+                self._write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+
+async def serve(model, class_names, host='127.0.0.1', port=8000,
+                max_batch_size=32, max_wait_ms=5.0, scale=RESCALE, top_k=3,
+                cache_items=MEMORY_ITEMS, cache_dir=None,
+                cache_mb=MAX_DISK_MB):
+    """
+    載入模型並啟動伺服器（直到被中斷）
+
+    cache_items 為 0 時停用預測快取；cache_dir 為 None 時只使用記憶體層
+    """
+    predictor = BatchPredictor(model, class_names, batch_size=max_batch_size,
+                               scale=scale, top_k=top_k)
+    # 先執行一次前向傳播，避免第一個請求承擔追蹤時間
+    predictor.predict_batch(np.zeros((1, *predictor.image_size, 3)))
+    if cache_items > 0:
+        predictor.cache = open_prediction_cache(predictor, cache_dir,
+                                                cache_items, cache_mb)
+
+    batcher = MicroBatcher(predictor, max_batch_size, max_wait_ms)
+    server = PredictionServer(batcher)
+    worker = asyncio.create_task(batcher.run())
+    http = await asyncio.start_server(server.handle, host, port)
+    print(f"伺服器已啟動：http://{host}:{port}  "
+          f"(max_batch_size={max_batch_size}, max_wait_ms={max_wait_ms})")
+    try:
+        async with http:
+            await http.serve_forever()
+    finally:
+        worker.cancel()
+
+
+def main():
+    from data_pipeline import find_data_dir
+
+    parser = argparse.ArgumentParser(description='微批次 HTTP 預測伺服器')
+    parser.add_argument('--model', required=True)
+    parser.add_argument('--data-dir', default=find_data_dir(),
+                        help='用於取得類別名稱的訓練資料夾')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    parser.add_argument('--scale', type=float, default=RESCALE,
+                        help='模型輸入縮放（自訂 CNN 內含 Rescaling 時用 1.0）')
+    parser.add_argument('--top-k', type=int, default=3)
+    parser.add_argument('--cache-items', type=int, default=MEMORY_ITEMS,
+                        help='預測快取記憶體層的項目數（0 停用快取）')
+    parser.add_argument('--cache-dir', default=None,
+                        help='預測快取磁碟層位置（未指定時只使用記憶體）')
+    parser.add_argument('--cache-mb', type=float, default=MAX_DISK_MB)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.model, load_class_names(args.data_dir),
+                          args.host, args.port, args.max_batch_size,
+                          args.max_wait_ms, args.scale, args.top_k,
+                          args.cache_items, args.cache_dir, args.cache_mb))
+    except KeyboardInterrupt:
+        print("伺服器已停止")
+
+
+if __name__ == '__main__':
+    main()
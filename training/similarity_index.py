@@ -0,0 +1,436 @@
+"""
+相似葉片搜尋索引：給定一張查詢圖片，找出資料集中最相近的已標註圖片
+
+嵌入向量來自 feature_cache 的凍結骨幹（Xception pooling='max' 2048 維或
+MobileNet 全域平均池化 1024 維），L2 正規化後以 float16 分段寫入記憶體映射檔；
+新增圖片時只寫出新的分段，不重寫既有向量。
+
+- 精確搜尋：逐段以批次矩陣乘法計算餘弦相似度並保留 top-k（IVF-PQ 未訓練時的
+  預設路徑，也作為召回率的基準）
+- 近似搜尋（IVF-PQ）：粗分群 nlist 個倒排串列，每個向量對群中心的殘差以
+  乘積量化壓縮為 m 個位元組。查詢時只掃描最相近的 nprobe 個串列，以查表
+  計算近似內積，再以原始向量重新排序前 k * rerank 個候選
+- 新增的向量以既有的群中心與碼本編碼，重新訓練（--retrain）時才重算所有編碼
+
+索引放在 cache/similarity/<骨幹>_<模型雜湊>/，骨幹權重變動時自動使用新的索引。
+圖片以「類別/檔名」記錄，與 --data-dir 的寫法及工作目錄無關。
+
+用法：
+    python similarity_index.py build --backbone xception
+    python similarity_index.py query 葉片.jpg --k 5
+    python similarity_index.py benchmark --queries 200
+"""
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+
+from dataset_index import relpath
+
+NLIST = 256                 # 倒排串列數
+NUM_SUBQUANTIZERS = 64      # 每個向量的 PQ 位元組數
+KSUB = 256                  # 每個子空間的碼字數（uint8）
+NPROBE = 4
+RERANK = 4                  # 以原始向量重新排序前 k * RERANK 個候選
+TRAIN_SAMPLE = 16384
+KMEANS_ITERATIONS = 15
+EXACT_CHUNK = 8192
+SEED = 42
+
+# float16 -> float32 查表，比 astype 快約一倍
+_HALF_TO_FLOAT = np.arange(65536, dtype=np.uint16).view(np.float16) \
+    .astype(np.float32)
+
+
+def default_index_dir(data_dir, backbone, digest):
+    return os.path.join(os.path.dirname(os.path.abspath(data_dir)), 'cache',
+                        'similarity', f"{backbone}_{digest[:12]}")
+
+
+def normalize(vectors):
+    """
+    L2 正規化（內積即為餘弦相似度）
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def to_float32(vectors):
+    """
+    float16 陣列（含記憶體映射）轉為 float32
+    """
+    vectors = np.asarray(vectors)
+    if vectors.dtype != np.float16:
+        return vectors.astype(np.float32, copy=False)
+    return np.take(_HALF_TO_FLOAT, vectors.view(np.uint16))
+
+
+def _assign(x, centroids, chunk=4096):
+    """
+    每列最近的群中心（argmin ||x - c||^2 = argmax 2 x·c - ||c||^2）
+    """
+    bias = (centroids ** 2).sum(1)
+    return np.concatenate([
+        np.argmax(2 * to_float32(x[i:i + chunk]) @ centroids.T - bias,
+                  axis=1)
+        for i in range(0, len(x), chunk)]).astype(np.int32)
+
+
+def _kmeans(x, k, rng, iterations=KMEANS_ITERATIONS):
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _assign(x, centroids)
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=k)
+        present = np.flatnonzero(counts)
+        starts = np.r_[0, np.cumsum(counts[present])[:-1]]
+        centroids[present] = np.add.reduceat(x[order], starts, axis=0) \
+            / counts[present, None]
+        # 空的群重新以隨機樣本初始化
+        empty = np.flatnonzero(counts == 0)
+        centroids[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+    return centroids
+
+
+class SimilarityIndex:
+    """
+    分段記憶體映射的 float16 嵌入向量，加上可選的 IVF-PQ 近似索引
+
+    每個分段 vectors-NNNNN.npy 是一次 add 寫入的向量；IVF-PQ 訓練後每個分段
+    另有 codes-NNNNN.npz（倒排串列編號與 PQ 編碼）
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._load()
+
+    def _load(self):
+        with open(os.path.join(self.directory, 'index.json'),
+                  encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if 'relpaths' not in self.meta:
+            # 舊版索引記錄工作目錄相對路徑，取最後兩層即為「類別/檔名」
+            self.meta['relpaths'] = [relpath(p) for p in
+                                     self.meta.pop('filepaths')]
+        self.relpaths = self.meta['relpaths']
+        self.labels = self.meta['labels']
+        self.segments = [np.load(path, mmap_mode='r')
+                         for path in self._segment_paths('vectors', '.npy')]
+        self.offsets = np.cumsum([0] + [len(s) for s in self.segments])
+        self.coarse = self.codebooks = None
+        quantizer = os.path.join(self.directory, 'quantizer.npz')
+        if os.path.exists(quantizer):
+            with np.load(quantizer) as f:
+                self.coarse, self.codebooks = f['coarse'], f['codebooks']
+            self._load_lists()
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def trained(self):
+        return self.coarse is not None
+
+    @classmethod
+    def create(cls, directory, dim, backbone, model_hash):
+        """
+        開啟索引，不存在時建立空的索引
+        """
+        if not os.path.exists(os.path.join(directory, 'index.json')):
+            os.makedirs(directory, exist_ok=True)
+            _write_json(os.path.join(directory, 'index.json'), {
+                'backbone': backbone, 'model_hash': model_hash, 'dim': dim,
+                'relpaths': [], 'labels': []})
+        return cls(directory)
+
+    def _segment_paths(self, prefix, suffix):
+        return sorted(glob.glob(os.path.join(self.directory,
+                                             f"{prefix}-*{suffix}")))
+
+    def _codes_path(self, segment):
+        return os.path.join(self.directory, f"codes-{segment:05d}.npz")
+
+    def _load_lists(self):
+        """
+        合併各分段的編碼，依倒排串列排序
+        """
+        lists, codes = [], []
+        for path in self._segment_paths('codes', '.npz'):
+            with np.load(path) as f:
+                lists.append(f['lists'])
+                codes.append(f['codes'])
+        lists = np.concatenate(lists)
+        self.list_rows = np.argsort(lists, kind='stable').astype(np.int64)
+        self.list_offsets = np.searchsorted(lists[self.list_rows],
+                                            np.arange(len(self.coarse) + 1))
+        self.row_lists = lists
+        self.codes = np.concatenate(codes)
+        m, ksub, _ = self.codebooks.shape
+        self._code_offsets = np.arange(m, dtype=np.intp) * ksub
+
+    def _encode(self, vectors, chunk=1024):
+        """
+        回傳 (倒排串列編號, PQ 編碼)
+        """
+        lists = _assign(vectors, self.coarse)
+        m, ksub, dsub = self.codebooks.shape
+        bias = (self.codebooks ** 2).sum(-1)
+        codes = np.empty((len(vectors), m), dtype=np.uint8)
+        for i in range(0, len(vectors), chunk):
+            residual = (to_float32(vectors[i:i + chunk])
+                        - self.coarse[lists[i:i + chunk]]).reshape(-1, m, dsub)
+            scores = 2 * np.einsum('nmd,mkd->nmk', residual,
+                                   self.codebooks) - bias
+            codes[i:i + chunk] = np.argmax(scores, axis=-1)
+        return lists, codes
+
+    def add(self, filepaths, features, labels):
+        """
+        寫出新分段；已訓練時以既有的群中心與碼本編碼
+        """
+        vectors = normalize(features)
+        segment = len(self.segments)
+        path = os.path.join(self.directory, f"vectors-{segment:05d}.npy")
+        np.save(path + '.tmp.npy', vectors.astype(np.float16))
+        os.replace(path + '.tmp.npy', path)
+        if self.trained:
+            lists, codes = self._encode(vectors)
+            _save_npz(self._codes_path(segment), lists=lists, codes=codes)
+
+        self.meta['relpaths'] = self.relpaths + [relpath(p)
+                                                 for p in filepaths]
+        self.meta['labels'] = self.labels + list(labels)
+        _write_json(os.path.join(self.directory, 'index.json'), self.meta)
+        self._load()
+
+    def vectors(self, rows):
+        """
+        依全域列號取出向量（float32）
+        """
+        rows = np.asarray(rows)
+        segment = np.searchsorted(self.offsets, rows, side='right') - 1
+        out = np.empty((len(rows), self.meta['dim']), np.float32)
+        for s in np.unique(segment).tolist():
+            mask = segment == s
+            out[mask] = to_float32(self.segments[s][rows[mask]
+                                                    - self.offsets[s]])
+        return out
+
+    def train(self, nlist=NLIST, num_subquantizers=NUM_SUBQUANTIZERS,
+              sample=TRAIN_SAMPLE, seed=SEED):
+        """
+        以隨機樣本訓練粗分群與 PQ 碼本，並重新編碼所有分段
+        """
+        dim = self.meta['dim']
+        if dim % num_subquantizers:
+            raise ValueError(f"維度 {dim} 無法平均分為 {num_subquantizers} 段")
+        rng = np.random.default_rng(seed)
+        rows = np.sort(rng.choice(len(self), min(sample, len(self)),
+                                  replace=False))
+        x = self.vectors(rows)
+        nlist = max(1, min(nlist, len(x) // 8))
+        ksub = min(KSUB, len(x))
+        start = time.perf_counter()
+        self.coarse = _kmeans(x, nlist, rng)
+        residual = (x - self.coarse[_assign(x, self.coarse)]).reshape(
+            len(x), num_subquantizers, -1)
+        self.codebooks = np.stack([_kmeans(residual[:, j], ksub, rng)
+                                   for j in range(num_subquantizers)])
+        _save_npz(os.path.join(self.directory, 'quantizer.npz'),
+                  coarse=self.coarse, codebooks=self.codebooks)
+        for segment, vectors in enumerate(self.segments):
+            lists, codes = self._encode(vectors)
+            _save_npz(self._codes_path(segment), lists=lists, codes=codes)
+        self._load_lists()
+        print(f"IVF-PQ 訓練完成（nlist={nlist}，m={num_subquantizers}），"
+              f"耗時 {time.perf_counter() - start:.1f} 秒")
+
+    def exact_search(self, queries, k=5, chunk=EXACT_CHUNK):
+        """
+        精確搜尋：逐段批次矩陣乘法，回傳 (相似度, 列號)，形狀皆為 [Q, k]
+        """
+        queries = normalize(np.atleast_2d(queries))
+        best_scores = np.full((len(queries), 0), -np.inf, np.float32)
+        best_rows = np.zeros((len(queries), 0), np.int64)
+        for offset, segment in zip(self.offsets[:-1].tolist(), self.segments):
+            for i in range(0, len(segment), chunk):
+                chunk_scores = queries @ to_float32(segment[i:i + chunk]).T
+                chunk_rows = np.broadcast_to(
+                    np.arange(offset + i, offset + i + chunk_scores.shape[1]),
+                    chunk_scores.shape)
+                scores = np.concatenate([best_scores, chunk_scores], axis=1)
+                rows = np.concatenate([best_rows, chunk_rows], axis=1)
+                if scores.shape[1] > k:
+                    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                    scores = np.take_along_axis(scores, top, 1)
+                    rows = np.take_along_axis(rows, top, 1)
+                best_scores, best_rows = scores, rows
+        order = np.argsort(-best_scores, axis=1)
+        return (np.take_along_axis(best_scores, order, 1),
+                np.take_along_axis(best_rows, order, 1))
+
+    def search(self, queries, k=5, nprobe=NPROBE, rerank=RERANK):
+        """
+        IVF-PQ 近似搜尋，回傳 (相似度, 列號)；未訓練時使用精確搜尋
+        """
+        if not self.trained:
+            return self.exact_search(queries, k)
+        queries = normalize(np.atleast_2d(queries))
+        m, ksub, dsub = self.codebooks.shape
+        scores = np.full((len(queries), k), -np.inf, np.float32)
+        rows = np.full((len(queries), k), -1, np.int64)
+        for q, query in enumerate(queries):
+            coarse = self.coarse @ query
+            probe = np.argpartition(-coarse, min(nprobe, len(coarse)) - 1)[
+                :nprobe]
+            candidates = np.concatenate([
+                self.list_rows[self.list_offsets[p]:self.list_offsets[p + 1]]
+                for p in probe.tolist()])
+            if not len(candidates):
+                continue
+            # 內積 = q·c + q·殘差；殘差部分以每個子空間的查表加總
+            table = np.matmul(self.codebooks,
+                              query.reshape(m, dsub, 1))[..., 0]
+            approx = coarse[self.row_lists[candidates]] + table.ravel()[
+                self.codes[candidates] + self._code_offsets].sum(1)
+            keep = min(k * rerank, len(candidates))
+            shortlist = candidates[np.argpartition(-approx, keep - 1)[:keep]]
+            exact = self.vectors(shortlist) @ query
+            top = np.argsort(-exact)[:k]
+            scores[q, :len(top)] = exact[top]
+            rows[q, :len(top)] = shortlist[top]
+        return scores, rows
+
+
+def _write_json(path, data):
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+
+
+def _save_npz(path, **arrays):
+    np.savez(path + '.tmp.npz', **arrays)
+    os.replace(path + '.tmp.npz', path)
+
+
+def benchmark(index, num_queries=200, k=10, nprobes=(1, 2, 4, 8, 16, 32),
+              rerank=RERANK, seed=SEED):
+    """
+    以索引內的隨機向量為查詢，比較各 nprobe 的 recall@k 與單次查詢延遲
+    """
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(index), min(num_queries, len(index)),
+                              replace=False))
+    queries = index.vectors(rows)
+
+    start = time.perf_counter()
+    _, truth = index.exact_search(queries, k)
+    batched_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    latencies = []
+    for query in queries[:20]:
+        start = time.perf_counter()
+        index.exact_search(query, k)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    results = [{'method': 'exact', 'nprobe': None, 'recall': 1.0,
+                'mean_ms': float(np.mean(latencies)),
+                'p95_ms': float(np.percentile(latencies, 95)),
+                'batched_ms': batched_ms}]
+    for nprobe in nprobes if index.trained else ():
+        latencies, hits = [], 0
+        for query, expected in zip(queries, truth):
+            start = time.perf_counter()
+            _, found = index.search(query, k, nprobe, rerank)
+            latencies.append((time.perf_counter() - start) * 1000)
+            hits += len(np.intersect1d(found[0], expected))
+        results.append({'method': 'ivfpq', 'nprobe': nprobe,
+                        'recall': hits / truth.size,
+                        'mean_ms': float(np.mean(latencies)),
+                        'p95_ms': float(np.percentile(latencies, 95))})
+
+    print(f"{len(index)} 個向量，{len(queries)} 個查詢，recall@{k}")
+    print(f"{'方法':<8s} {'nprobe':>6s} {'recall':>7s} {'平均 ms':>8s} "
+          f"{'p95 ms':>7s}")
+    for r in results:
+        print(f"{r['method']:<8s} {r['nprobe'] or '-':>6} {r['recall']:>7.3f} "
+              f"{r['mean_ms']:>8.3f} {r['p95_ms']:>7.3f}")
+    print(f"精確搜尋批次查詢: 每個查詢 {batched_ms:.3f} ms")
+    return results
+
+
+def main():
+    from data_pipeline import create_dataframe, find_data_dir
+    from feature_cache import (
+        BACKBONES,
+        build_backbone,
+        default_cache_dir,
+        embed_images,
+        extract_features,
+        model_hash,
+    )
+
+    parser = argparse.ArgumentParser(description='相似葉片搜尋索引')
+    parser.add_argument('command', choices=['build', 'query', 'benchmark'])
+    parser.add_argument('images', nargs='*', help='query 的查詢圖片')
+    parser.add_argument('--backbone', choices=list(BACKBONES),
+                        default='xception')
+    parser.add_argument('--data-dir', default=find_data_dir())
+    parser.add_argument('--index-dir', default=None)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--nprobe', type=int, default=NPROBE)
+    parser.add_argument('--rerank', type=int, default=RERANK,
+                        help='以原始向量重新排序前 k * rerank 個候選')
+    parser.add_argument('--exact', action='store_true', help='使用精確搜尋')
+    parser.add_argument('--retrain', action='store_true',
+                        help='重新訓練 IVF-PQ 並重新編碼所有向量')
+    parser.add_argument('--queries', type=int, default=200,
+                        help='benchmark 的查詢數')
+    args = parser.parse_args()
+
+    backbone = build_backbone(args.backbone)
+    digest = model_hash(args.backbone, backbone)
+    index = SimilarityIndex.create(
+        args.index_dir or default_index_dir(args.data_dir, args.backbone,
+                                            digest),
+        backbone.output_shape[-1], args.backbone, digest)
+
+    if args.command == 'build':
+        df = create_dataframe(args.data_dir)
+        known = set(index.relpaths)
+        new = df[~df['Filepaths'].map(relpath).isin(known)]
+        if len(new):
+            cache = extract_features(args.backbone, new['Filepaths'],
+                                     default_cache_dir(args.data_dir),
+                                     backbone)
+            index.add(new['Filepaths'], cache.lookup(new['Filepaths']),
+                      new['Labels'])
+        print(f"索引共 {len(index)} 張圖片（新增 {len(new)} 張）")
+        if args.retrain or (not index.trained and len(index) >= KSUB * 4):
+            index.train()
+    elif args.command == 'query':
+        if not args.images:
+            parser.error('query 需要至少一張查詢圖片')
+        features = embed_images(args.backbone, backbone, args.images)
+        start = time.perf_counter()
+        search = index.exact_search if args.exact else \
+            lambda q, k: index.search(q, k, args.nprobe, args.rerank)
+        scores, rows = search(features, args.k)
+        elapsed = (time.perf_counter() - start) * 1000 / len(args.images)
+        for image, image_scores, image_rows in zip(args.images, scores,
+                                                   rows):
+            print(f"\n{image}")
+            for score, row in zip(image_scores.tolist(), image_rows.tolist()):
+                if row >= 0:
+                    path = os.path.join(args.data_dir, index.relpaths[row])
+                    print(f"  {score:.4f}  {index.labels[row]:<45s} {path}")
+        print(f"\n每個查詢 {elapsed:.2f} ms")
+    else:
+        benchmark(index, args.queries, k=args.k, rerank=args.rerank)
+
+
+if __name__ == '__main__':
+    main()
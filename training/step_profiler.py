@@ -0,0 +1,244 @@
+"""
+訓練步驟剖析：區分等待資料輸入與模型計算的時間，找出瓶頸所在的階段
+
+train.py --profile 使用本模組：
+- 每步以 DequeueClock 量測等待 tf.data 迭代器的時間與 train_step 的計算時間
+- 背景執行緒取樣行程 CPU 使用率與常駐記憶體
+- 可選擇在指定步數區間擷取 TF profiler trace（以 TensorBoard 檢視）
+- 訓練後分別量測 JPEG 解碼、資料增強兩個輸入階段單獨的吞吐量
+
+最後比較各階段每秒可處理的圖片數，指出限制訓練速度的階段。
+"""
+import os
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from data_pipeline import (
+    AUTOTUNE,
+    build_augmenter,
+    build_dataset,
+    measure_throughput,
+)
+
+# 等待輸入超過步驟時間的此比例即視為輸入管線瓶頸
+INPUT_BOUND_RATIO = 0.1
+SAMPLE_INTERVAL = 0.5
+
+ADVICE = {
+    'decode': '以 tensor_cache.py 預先解碼為記憶體映射檔，或使用 '
+              'tfrecord_shards.py 分片並平行讀取',
+    'augment': '減少每批次的資料增強運算，或將增強移至快取後的 uint8 批次上',
+    'compute': '嘗試 --precision mixed_bfloat16 / --jit-compile，或以 '
+               'feature_cache.py 凍結骨幹只訓練分類頭',
+}
+STAGE_NAMES = {'decode': 'JPEG 解碼與縮放', 'augment': '資料增強',
+               'compute': 'Xception 前向/反向傳播'}
+
+
+def _read_rss_mb():
+    """
+    目前行程的常駐記憶體（MB）；無法取得時回傳 None
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') \
+                / 1024 ** 2
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class ResourceSampler:
+    """
+    背景執行緒定期取樣行程 CPU 使用率（100% = 一個核心）與常駐記憶體
+
+    有 psutil 時使用 psutil，否則以 os.times 與 /proc 計算
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        try:
+            import psutil
+
+            self._process = psutil.Process()
+        except ImportError:
+            self._process = None
+
+    def _cpu_seconds(self):
+        if self._process is not None:
+            times = self._process.cpu_times()
+        else:
+            times = os.times()
+        return times.user + times.system
+
+    def _rss_mb(self):
+        if self._process is not None:
+            return self._process.memory_info().rss / 1024 ** 2
+        return _read_rss_mb()
+
+    def _run(self):
+        last_wall, last_cpu = time.perf_counter(), self._cpu_seconds()
+        while not self._stop.wait(self.interval):
+            wall, cpu = time.perf_counter(), self._cpu_seconds()
+            self.samples.append((wall, (cpu - last_cpu) / (wall - last_wall)
+                                 * 100, self._rss_mb()))
+            last_wall, last_cpu = wall, cpu
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def summary(self):
+        if not self.samples:
+            return {}
+        cpu = np.array([c for _, c, _ in self.samples])
+        rss = np.array([r for _, _, r in self.samples if r is not None])
+        summary = {
+            'cpu_count': os.cpu_count(),
+            'cpu_percent_mean': float(cpu.mean()),
+            'cpu_percent_peak': float(cpu.max()),
+        }
+        if len(rss):
+            summary['rss_mb_mean'] = float(rss.mean())
+            summary['rss_mb_peak'] = float(rss.max())
+        return summary
+
+
+class TraceWindow(tf.keras.callbacks.Callback):
+    """
+    在第 start 到 stop 步（含）之間擷取 TF profiler trace
+    """
+
+    def __init__(self, logdir, start, stop):
+        super().__init__()
+        self.logdir = logdir
+        self.start = start
+        self.stop = stop
+        self._step = 0
+        self._active = False
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self._step == self.start:
+            tf.profiler.experimental.start(self.logdir)
+            self._active = True
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self._active and self._step == self.stop:
+            tf.profiler.experimental.stop()
+            self._active = False
+        self._step += 1
+
+    def on_train_end(self, logs=None):
+        if self._active:
+            tf.profiler.experimental.stop()
+            self._active = False
+
+
+def measure_stages(train_df, class_names, batch_size, num_batches=20,
+                   seed=0):
+    """
+    分別量測輸入管線各階段單獨的吞吐量（images/sec）
+
+    - decode：讀檔、JPEG 解碼與縮放（不含資料增強）
+    - augment：只對快取在記憶體中的同一批次重複執行資料增強
+    - pipeline：訓練時實際使用的完整管線
+    """
+    decoded = build_dataset(train_df, class_names, training=False,
+                            batch_size=batch_size)
+    images, _ = next(iter(decoded))
+    augment = build_augmenter(seed)
+    augmented = tf.data.Dataset.from_tensors(images * 255.0).repeat() \
+        .enumerate().map(lambda step, batch: augment(batch, step),
+                         num_parallel_calls=AUTOTUNE).prefetch(AUTOTUNE)
+    pipeline = build_dataset(train_df, class_names, training=True,
+                             batch_size=batch_size, seed=seed)
+    # 批次數不超過資料集大小，避免迭代器提早結束
+    num_batches = min(num_batches, len(train_df) // batch_size - 1)
+    return {
+        'decode': measure_throughput(decoded, num_batches, batch_size),
+        'augment': measure_throughput(augmented, num_batches, batch_size),
+        'pipeline': measure_throughput(pipeline, num_batches, batch_size),
+    }
+
+
+def diagnose(step_times, input_waits, batch_size, stage_rates):
+    """
+    依等待輸入比例與各階段吞吐量判斷瓶頸，回傳摘要 dict
+    """
+    step_times = np.asarray(step_times)
+    input_waits = np.asarray(input_waits)
+    compute = step_times - input_waits
+    wait_ratio = float(input_waits.sum() / step_times.sum())
+    rates = dict(stage_rates, compute=float(batch_size / compute.mean()))
+    if wait_ratio >= INPUT_BOUND_RATIO:
+        bottleneck = min(('decode', 'augment'), key=lambda k: rates[k])
+    else:
+        bottleneck = 'compute'
+    return {
+        'steps': len(step_times),
+        'step_time_ms': {
+            'mean': float(step_times.mean() * 1000),
+            'p50': float(np.percentile(step_times, 50) * 1000),
+            'p95': float(np.percentile(step_times, 95) * 1000),
+        },
+        'input_wait_ms': {
+            'mean': float(input_waits.mean() * 1000),
+            'p50': float(np.percentile(input_waits, 50) * 1000),
+            'p95': float(np.percentile(input_waits, 95) * 1000),
+        },
+        'compute_ms_mean': float(compute.mean() * 1000),
+        'input_wait_ratio': wait_ratio,
+        'images_per_sec': float(batch_size / step_times.mean()),
+        'stage_images_per_sec': rates,
+        'bottleneck': bottleneck,
+        # 消除瓶頸後的加速上限：輸入瓶頸時只剩計算時間，計算瓶頸時受限於
+        # 輸入管線的速度
+        'max_speedup': float(step_times.mean() / (
+            batch_size / rates['pipeline'] if bottleneck == 'compute'
+            else compute.mean())),
+    }
+
+
+def print_profile(profile):
+    step, wait = profile['step_time_ms'], profile['input_wait_ms']
+    print(f"\n剖析 {profile['steps']} 步（不含第一步的追蹤/編譯）")
+    print(f"  步驟時間: 平均 {step['mean']:.1f} ms  p50 {step['p50']:.1f}  "
+          f"p95 {step['p95']:.1f}")
+    print(f"  等待輸入: 平均 {wait['mean']:.1f} ms  p50 {wait['p50']:.1f}  "
+          f"p95 {wait['p95']:.1f}  "
+          f"(佔步驟時間 {profile['input_wait_ratio'] * 100:.1f}%)")
+    print(f"  計算時間: 平均 {profile['compute_ms_mean']:.1f} ms")
+    print(f"  訓練吞吐量: {profile['images_per_sec']:.1f} images/sec")
+
+    resources = profile.get('resources', {})
+    if resources:
+        rss = resources.get('rss_mb_peak')
+        print(f"  CPU: 平均 {resources['cpu_percent_mean']:.0f}%  "
+              f"峰值 {resources['cpu_percent_peak']:.0f}% "
+              f"({resources['cpu_count']} 核心 = "
+              f"{resources['cpu_count'] * 100}%)"
+              + (f"  記憶體峰值: {rss:.0f} MB" if rss else ''))
+
+    print("\n各階段單獨的吞吐量 (images/sec):")
+    rates = profile['stage_images_per_sec']
+    for key in ('decode', 'augment', 'compute'):
+        marker = '  <- 瓶頸' if key == profile['bottleneck'] else ''
+        print(f"  {STAGE_NAMES[key]:<24s} {rates[key]:>9.1f}{marker}")
+    print(f"  {'完整輸入管線':<24s} {rates['pipeline']:>9.1f}")
+
+    bottleneck = profile['bottleneck']
+    print(f"\n瓶頸: {STAGE_NAMES[bottleneck]}"
+          f"（消除後最多約 {profile['max_speedup']:.2f}x）")
+    print(f"建議: {ADVICE[bottleneck]}")
+    if profile.get('trace_dir'):
+        print(f"TF profiler trace: {profile['trace_dir']} "
+              f"(tensorboard --logdir {profile['trace_dir']})")
@@ -0,0 +1,250 @@
+"""
+將 PlantVillage color 資料集預先解碼為 224x224 uint8 的記憶體映射快取
+
+只需執行一次 pack，之後訓練與評估都直接從同一個連續檔案讀取批次，
+不再每個 epoch 重新解碼 JPEG。資料夾內容變動時快取會自動失效。
+快取以「類別/檔名」對應列，從 training/ 或專案根目錄執行都能命中。
+
+用法：
+    python tensor_cache.py pack
+    python tensor_cache.py info
+    python train.py --tensor-cache        # 訓練與評估從快取讀取
+    python evaluation.py --model network.h5 --tensor-cache
+"""
+import argparse
+import functools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from dataset_index import load_index, relpath
+
+IMG_SIZE = (224, 224)
+CACHE_VERSION = 2
+
+
+def default_cache_dir(data_dir):
+    """
+    快取預設放在資料集旁的 cache 資料夾
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(data_dir)), 'cache')
+
+
+def _cache_paths(data_dir, cache_dir, image_size):
+    name = f"{os.path.basename(os.path.normpath(data_dir))}_{image_size[0]}"
+    base = os.path.join(cache_dir, name)
+    return base + '.npy', base + '.json'
+
+
+def _decode(path, image_size):
+    img = Image.open(path)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    # 與 tf.data 管線相同使用 nearest 插值
+    img = img.resize(image_size, Image.Resampling.NEAREST)
+    return np.asarray(img, dtype=np.uint8)
+
+
+def _decode_into(images, filepaths, image_size, i):
+    images[i] = _decode(filepaths[i], image_size)
+
+
+class TensorCache:
+    """
+    記憶體映射的圖片張量快取
+
+    images 為 (N, H, W, 3) uint8 的唯讀 memmap，labels / relpaths 來自 sidecar
+    """
+
+    def __init__(self, array_path, meta):
+        self.array_path = array_path
+        self.meta = meta
+        self.images = np.load(array_path, mmap_mode='r')
+        self.labels = np.asarray(meta['labels'], dtype=np.int32)
+        self.relpaths = meta['relpaths']
+        self.class_names = meta['class_names']
+        self._row_of = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def rows_for(self, filepaths):
+        """
+        將檔案路徑（例如 train_df['Filepaths']）對應到快取中的列索引
+        """
+        if self._row_of is None:
+            self._row_of = {p: i for i, p in enumerate(self.relpaths)}
+        return np.array([self._row_of[relpath(p)] for p in filepaths],
+                        dtype=np.int64)
+
+    def batch(self, start, stop):
+        """
+        讀取連續範圍的批次（memmap 的切片視圖，不複製資料）
+        """
+        return self.images[start:stop], self.labels[start:stop]
+
+    def iter_batches(self, batch_size=32, rows=None, shuffle=False, seed=42):
+        """
+        依序或打亂後逐批讀取
+
+        未指定 rows 且不打亂時回傳零複製的切片；指定 rows 時會先排序每個
+        批次的索引，讓讀取盡量循序。
+        """
+        if rows is None and not shuffle:
+            for start in range(0, len(self), batch_size):
+                yield self.batch(start, start + batch_size)
+            return
+
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows)
+        if shuffle:
+            rows = np.random.default_rng(seed).permutation(rows)
+        for start in range(0, len(rows), batch_size):
+            batch_rows = np.sort(rows[start:start + batch_size])
+            yield self.images[batch_rows], self.labels[batch_rows]
+
+
+def pack(data_dir, cache_dir=None, image_size=IMG_SIZE, workers=None):
+    """
+    解碼整個資料夾並寫入單一連續的記憶體映射檔與 sidecar
+    """
+    cache_dir = cache_dir or default_cache_dir(data_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    array_path, meta_path = _cache_paths(data_dir, cache_dir, image_size)
+
+    index = load_index(data_dir)
+    filepaths, labels, class_names = (index.filepaths, index.labels.tolist(),
+                                      index.class_names)
+    fingerprint = index.fingerprint()
+    shape = (len(filepaths), image_size[1], image_size[0], 3)
+    print(f"開始打包 {len(filepaths)} 張圖片 -> {array_path}")
+
+    start = time.perf_counter()
+    tmp_path = array_path + '.tmp.npy'
+    images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                       shape=shape)
+
+    decode_into = functools.partial(_decode_into, images, filepaths,
+                                    image_size)
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for done, _ in enumerate(pool.map(decode_into, range(len(filepaths))),
+                                 1):
+            if done % 5000 == 0:
+                print(f"  已解碼 {done}/{len(filepaths)}")
+    images.flush()
+    del images, decode_into
+    os.replace(tmp_path, array_path)
+
+    # sidecar 最後寫入，中斷的打包不會被視為有效快取
+    meta = {
+        'version': CACHE_VERSION,
+        'fingerprint': fingerprint,
+        'image_size': list(image_size),
+        'class_names': class_names,
+        'relpaths': index.relpaths,
+        'labels': labels,
+    }
+    with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(meta_path + '.tmp', meta_path)
+
+    elapsed = time.perf_counter() - start
+    size_mb = os.path.getsize(array_path) / 1024 ** 2
+    print(f"打包完成：{size_mb:.0f} MB，耗時 {elapsed:.1f} 秒")
+    return TensorCache(array_path, meta)
+
+
+def open_cache(data_dir, cache_dir=None, image_size=IMG_SIZE, verify=True):
+    """
+    開啟既有快取；不存在或資料夾內容已變動時回傳 None
+    """
+    cache_dir = cache_dir or default_cache_dir(data_dir)
+    array_path, meta_path = _cache_paths(data_dir, cache_dir, image_size)
+    if not (os.path.exists(array_path) and os.path.exists(meta_path)):
+        return None
+
+    with open(meta_path, encoding='utf-8') as f:
+        meta = json.load(f)
+    if meta.get('version') != CACHE_VERSION:
+        return None
+    if verify:
+        # 逐檔 stat：原地覆寫的圖片不會改變資料夾 mtime，manifest 不會自行更新
+        index = load_index(data_dir, verify_files=True)
+        if index.fingerprint() != meta['fingerprint']:
+            print("資料夾內容已變動，快取失效")
+            return None
+    return TensorCache(array_path, meta)
+
+
+def load_or_pack(data_dir, cache_dir=None, image_size=IMG_SIZE):
+    """
+    有效快取存在時直接開啟，否則重新打包
+    """
+    cache = open_cache(data_dir, cache_dir, image_size)
+    if cache is None:
+        cache = pack(data_dir, cache_dir, image_size)
+    return cache
+
+
+def build_cached_dataset(cache, df, class_names=None, training=False,
+                         batch_size=32, seed=42):
+    """
+    從快取建立 tf.data.Dataset（輸出格式與 data_pipeline.build_dataset 相同）
+    """
+    import tensorflow as tf
+
+    from data_pipeline import finalize_batches
+
+    class_names = class_names or cache.class_names
+    rows = cache.rows_for(df['Filepaths'])
+    num_classes = len(class_names)
+    images = cache.images
+    labels = cache.labels
+
+    def gather(batch_rows):
+        order = np.sort(batch_rows)
+        return images[order], labels[order]
+
+    ds = tf.data.Dataset.from_tensor_slices(rows)
+    if training:
+        ds = ds.shuffle(len(rows), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.batch(batch_size)
+    ds = ds.map(lambda r: tf.numpy_function(gather, [r], (tf.uint8, tf.int32)),
+                num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    ds = ds.map(lambda x, y: (tf.ensure_shape(
+        tf.cast(x, tf.float32), (None, *images.shape[1:])),
+        tf.ensure_shape(y, (None,))))
+    return finalize_batches(ds, num_classes, training, seed)
+
+
+def main():
+    from data_pipeline import find_data_dir
+
+    parser = argparse.ArgumentParser(description='記憶體映射圖片快取')
+    parser.add_argument('command', choices=['pack', 'info'])
+    parser.add_argument('--data-dir', default=find_data_dir())
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        cache = open_cache(args.data_dir, args.cache_dir)
+        if cache is not None:
+            print("快取已是最新，略過打包")
+        else:
+            pack(args.data_dir, args.cache_dir, workers=args.workers)
+    else:
+        cache = open_cache(args.data_dir, args.cache_dir)
+        if cache is None:
+            print("找不到有效的快取，請先執行 pack")
+            return
+        print(f"圖片數: {len(cache)}  形狀: {cache.images.shape}  "
+              f"類別數: {len(cache.class_names)}")
+        print(f"內容雜湊: {cache.meta['fingerprint']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""
+將資料集轉換為依大小平衡的 TFRecord 分片，並以 interleave 平行讀取
+
+網路儲存上開啟 5 萬多個小檔案是最大的 I/O 成本，改為少數幾百 MB 的分片後，
+每個 epoch 只需循序讀取少量大檔案。
+
+用法：
+    # 依 notebook 的 80/10/10 切分轉換
+    # （或以 --split 指定 dataset_splits 的切分）
+    python tfrecord_shards.py --output ../tfrecords
+    python tfrecord_shards.py --split stratified --output ../tfrecords
+    # 從 splitfolders.ratio 產生的資料夾（output/train、output/val）轉換
+    python tfrecord_shards.py --split-root output --output ../tfrecords
+"""
+import argparse
+import heapq
+import json
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import tensorflow as tf
+
+from data_pipeline import (
+    AUTOTUNE,
+    BATCH_SIZE,
+    IMG_SIZE,
+    SEED,
+    create_dataframe,
+    decode_image,
+    finalize_batches,
+    find_data_dir,
+    get_class_names,
+)
+from dataset_index import load_index
+from dataset_splits import split_frames
+
+SHARD_SIZE_MB = 200
+
+FEATURE_SPEC = {
+    'image/encoded': tf.io.FixedLenFeature([], tf.string),
+    'image/label': tf.io.FixedLenFeature([], tf.int64),
+    'image/path': tf.io.FixedLenFeature([], tf.string),
+}
+
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(value):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+
+def balance_shards(sizes, num_shards):
+    """
+    依檔案大小將樣本分配到 num_shards 個分片（大的先放進目前最小的分片）
+
+    回傳每個分片的索引列表
+    """
+    heap = [(0, shard) for shard in range(num_shards)]
+    shards = [[] for _ in range(num_shards)]
+    for i in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        total, shard = heapq.heappop(heap)
+        shards[shard].append(i)
+        heapq.heappush(heap, (total + sizes[i], shard))
+    return shards
+
+
+def write_shard(path, filepaths, labels):
+    """
+    寫入單一分片，保留原始 JPEG 位元組（不重新編碼）
+    """
+    with tf.io.TFRecordWriter(path) as writer:
+        for filepath, label in zip(filepaths, labels):
+            with open(filepath, 'rb') as f:
+                encoded = f.read()
+            example = tf.train.Example(features=tf.train.Features(feature={
+                'image/encoded': _bytes_feature(encoded),
+                'image/label': _int64_feature(int(label)),
+                'image/path': _bytes_feature(filepath.encode('utf-8')),
+            }))
+            writer.write(example.SerializeToString())
+    return path
+
+
+def export_split(df, class_names, output_dir, split, num_shards=None,
+                 shard_size_mb=SHARD_SIZE_MB, seed=SEED, workers=None):
+    """
+    將一個切分（DataFrame）寫成 num_shards 個大小平衡的分片
+
+    未指定 num_shards 時依 shard_size_mb 估算
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    class_index = {name: i for i, name in enumerate(class_names)}
+    filepaths = df['Filepaths'].astype(str).tolist()
+    labels = [class_index[label] for label in df['Labels']]
+    sizes = [os.path.getsize(path) for path in filepaths]
+
+    if num_shards is None:
+        num_shards = max(1, round(sum(sizes) / (shard_size_mb * 1024 ** 2)))
+    num_shards = min(num_shards, len(filepaths))
+
+    # 分片內打亂，避免同一分片依檔案大小排序
+    rng = random.Random(seed)
+    assignments = balance_shards(sizes, num_shards)
+    jobs = []
+    for shard, indices in enumerate(assignments):
+        rng.shuffle(indices)
+        path = os.path.join(
+            output_dir, f"{split}-{shard:05d}-of-{num_shards:05d}.tfrecord")
+        jobs.append((path, [filepaths[i] for i in indices],
+                     [labels[i] for i in indices]))
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        list(pool.map(lambda job: write_shard(*job), jobs))
+
+    total_mb = sum(sizes) / 1024 ** 2
+    print(f"{split}: {len(filepaths)} 張圖片 -> {num_shards} 個分片"
+          f"（平均每片 {total_mb / num_shards:.0f} MB）")
+    return len(filepaths)
+
+
+def export_dataframes(splits, output_dir, num_shards=None,
+                      shard_size_mb=SHARD_SIZE_MB, seed=SEED,
+                      class_names=None):
+    """
+    匯出多個切分，例如 {'train': train_df, 'valid': valid_df, 'test': test_df}
+
+    class_names 未指定時取所有切分的類別聯集，不會因某個切分缺少類別而
+    讓各切分的標籤編號不一致；類別名稱與各切分樣本數寫入
+    output_dir/classes.json
+    """
+    if class_names is None:
+        class_names = sorted({name for df in splits.values()
+                              for name in get_class_names(df)})
+    counts = {}
+    for split, df in splits.items():
+        counts[split] = export_split(df, class_names, output_dir, split,
+                                     num_shards, shard_size_mb, seed)
+
+    with open(os.path.join(output_dir, 'classes.json'), 'w',
+              encoding='utf-8') as f:
+        json.dump({'class_names': class_names, 'counts': counts}, f,
+                  ensure_ascii=False, indent=2)
+    return class_names
+
+
+def export_split_folders(split_root, output_dir, num_shards=None,
+                         shard_size_mb=SHARD_SIZE_MB, seed=SEED):
+    """
+    匯出 splitfolders.ratio 產生的資料夾結構（split_root/<split>/<class>/...）
+    """
+    splits = {}
+    for split in sorted(os.listdir(split_root)):
+        split_path = os.path.join(split_root, split)
+        if os.path.isdir(split_path):
+            splits[split] = create_dataframe(split_path)
+    return export_dataframes(splits, output_dir, num_shards, shard_size_mb,
+                             seed)
+
+
+def load_class_names(shard_dir):
+    """
+    讀取匯出時記錄的類別名稱
+    """
+    with open(os.path.join(shard_dir, 'classes.json'), encoding='utf-8') as f:
+        return json.load(f)['class_names']
+
+
+def parse_example(serialized, image_size=IMG_SIZE):
+    """
+    解析單筆 Example，回傳 (image, label_index)
+    """
+    features = tf.io.parse_single_example(serialized, FEATURE_SPEC)
+    image = decode_image(features['image/encoded'], image_size)
+    return image, tf.cast(features['image/label'], tf.int32)
+
+
+def read_shards(shard_dir, split, training=False, batch_size=BATCH_SIZE,
+                image_size=IMG_SIZE, seed=SEED, cycle_length=None):
+    """
+    以 interleave 同時循序讀取多個分片，
+    輸出格式與 data_pipeline.build_dataset 相同
+    """
+    class_names = load_class_names(shard_dir)
+    pattern = os.path.join(shard_dir, f"{split}-*.tfrecord")
+    files = tf.data.Dataset.list_files(pattern, shuffle=training, seed=seed)
+
+    ds = files.interleave(
+        lambda path: tf.data.TFRecordDataset(path, buffer_size=8 * 1024 ** 2),
+        cycle_length=cycle_length or AUTOTUNE,
+        num_parallel_calls=AUTOTUNE,
+        deterministic=True)
+    if training:
+        # 分片內已打亂，這裡只需小緩衝區打散跨分片的順序
+        ds = ds.shuffle(8 * batch_size, seed=seed,
+                        reshuffle_each_iteration=True)
+
+    ds = ds.map(lambda record: parse_example(record, image_size),
+                num_parallel_calls=AUTOTUNE, deterministic=True)
+    ds = ds.batch(batch_size)
+    return finalize_batches(ds, len(class_names), training, seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TFRecord 分片匯出')
+    parser.add_argument('--data-dir', default=find_data_dir())
+    parser.add_argument('--split', default=None,
+                        help='dataset_splits 的切分名稱（預設同 notebook）')
+    parser.add_argument('--split-root', default=None,
+                        help='splitfolders.ratio 的輸出資料夾')
+    parser.add_argument('--output', default='../tfrecords')
+    parser.add_argument('--num-shards', type=int, default=None,
+                        help='每個切分的分片數（預設依 --shard-size-mb 估算）')
+    parser.add_argument('--shard-size-mb', type=float, default=SHARD_SIZE_MB)
+    args = parser.parse_args()
+
+    if args.split_root:
+        export_split_folders(args.split_root, args.output, args.num_shards,
+                             args.shard_size_mb)
+    else:
+        frames = split_frames(args.data_dir, args.split)
+        export_dataframes({split: frame for split, frame
+                           in zip(('train', 'valid', 'test'), frames)
+                           if frame is not None},
+                          args.output, args.num_shards, args.shard_size_mb,
+                          class_names=load_index(args.data_dir).class_names)
+    print(f"已匯出至 {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""
+展示圖腳本使用的縮圖服務：JPEG draft 降尺寸解碼、行程池平行處理與 LRU 快取
+
+縮圖以 (路徑, mtime, 檔案大小, 目標尺寸) 的雜湊為檔名存入快取資料夾，
+來源圖片變動時鍵值自然改變。命中時更新檔案的存取時間，總大小超過上限時
+從最久未使用的縮圖開始刪除。重新產生 38 類別網格圖時幾乎全部命中快取。
+
+用法：
+    python thumbnails.py bench   # 比較首次與重複產生 38 類別縮圖的時間
+    python thumbnails.py info
+    python thumbnails.py clear
+"""
+import argparse
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+THUMBNAIL_VERSION = 1
+MAX_CACHE_MB = 256
+# 少於此數量的未命中直接在目前行程處理，避免啟動行程池的成本
+MIN_POOL_TASKS = 8
+
+
+def default_thumbnail_dir(data_dir):
+    """
+    縮圖快取預設放在資料集旁的 cache/thumbnails
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(data_dir)), 'cache',
+                        'thumbnails')
+
+
+def thumbnail_key(path, size):
+    """
+    以路徑、修改時間、檔案大小與目標尺寸計算快取鍵
+    """
+    stat = os.stat(path)
+    text = (f"{THUMBNAIL_VERSION}\0{os.path.abspath(path)}\0"
+            f"{stat.st_mtime_ns}\0{stat.st_size}\0{size[0]}x{size[1]}")
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def render_thumbnail(path, size, output_path):
+    """
+    產生單張縮圖並寫入 output_path（在子行程中執行）
+
+    draft() 讓 JPEG 解碼器直接以 1/2、1/4、1/8 尺寸解碼，只保留不小於
+    目標尺寸的最小縮放，之後再以 LANCZOS 縮放到精確尺寸。
+    """
+    with Image.open(path) as img:
+        img.draft('RGB', size)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img = img.resize(size, Image.Resampling.LANCZOS)
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    img.save(tmp_path, format='PNG')
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def _render_or_error(path, size, output_path):
+    try:
+        render_thumbnail(path, size, output_path)
+        return None
+    except Exception as e:
+        return str(e)
+
+
+class ThumbnailCache:
+    """
+    內容定址的縮圖快取；get_many 一次取得多張縮圖，未命中的以行程池產生
+    """
+
+    def __init__(self, cache_dir, max_mb=MAX_CACHE_MB, workers=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 ** 2)
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.png')
+
+    def _cache_path(self, path, size):
+        """
+        來源圖片的縮圖路徑；來源不存在或無法讀取時回傳 None，
+        單張圖片的錯誤不影響同一批的其他圖片
+        """
+        try:
+            return self._path(thumbnail_key(path, size))
+        except OSError as e:
+            print(f"無法載入圖片 {path}: {e}")
+            return None
+
+    def get_many(self, paths, size):
+        """
+        依序回傳每個路徑的縮圖（RGB PIL 圖片）；無法解碼的圖片為 None
+        """
+        size = tuple(size)
+        cache_paths = [self._cache_path(p, size) for p in paths]
+        missing = [(p, c) for p, c in zip(paths, cache_paths)
+                   if c is not None and not os.path.exists(c)]
+        self.hits += sum(c is not None for c in cache_paths) - len(missing)
+        self.misses += len(missing)
+
+        for _, cache_path in missing:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        if len(missing) >= MIN_POOL_TASKS:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                errors = list(pool.map(
+                    _render_or_error, [p for p, _ in missing],
+                    [size] * len(missing), [c for _, c in missing],
+                    chunksize=4))
+        else:
+            errors = [_render_or_error(p, size, c) for p, c in missing]
+        for (path, _), error in zip(missing, errors):
+            if error:
+                print(f"無法載入圖片 {path}: {error}")
+
+        images = []
+        for cache_path in cache_paths:
+            if cache_path is None or not os.path.exists(cache_path):
+                images.append(None)
+                continue
+            with Image.open(cache_path) as img:
+                images.append(img.convert('RGB'))
+            # 以存取時間作為 LRU 順序
+            os.utime(cache_path)
+        if missing:
+            self.evict()
+        return images
+
+    def get(self, path, size):
+        return self.get_many([path], size)[0]
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.png'):
+                    stat = os.stat(os.path.join(root, name))
+                    entries.append((stat.st_mtime, stat.st_size,
+                                    os.path.join(root, name)))
+        return entries
+
+    def evict(self):
+        """
+        總大小超過上限時刪除最久未使用的縮圖，回傳刪除數量
+        """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            removed += 1
+        return removed
+
+    def stats(self):
+        entries = self._entries()
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(entries),
+                'size_mb': sum(size for _, size, _ in entries) / 1024 ** 2}
+
+
+def open_thumbnails(data_dir, cache_dir=None, max_mb=MAX_CACHE_MB):
+    return ThumbnailCache(cache_dir or default_thumbnail_dir(data_dir), max_mb)
+
+
+def main():
+    from data_pipeline import find_data_dir
+
+    parser = argparse.ArgumentParser(description='縮圖快取')
+    parser.add_argument('command', choices=['info', 'clear', 'bench'])
+    parser.add_argument('--data-dir', default=find_data_dir())
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--size', type=int, default=200)
+    args = parser.parse_args()
+
+    thumbnails = open_thumbnails(args.data_dir, args.cache_dir)
+    if args.command == 'clear':
+        thumbnails.max_bytes = 0
+        print(f"已刪除 {thumbnails.evict()} 張縮圖")
+    elif args.command == 'bench':
+        from dataset_index import load_index
+
+        index = load_index(args.data_dir)
+        paths = [index.class_files(name)[0] for name in index.class_names]
+        size = (args.size, args.size)
+        for label in ('首次', '重複'):
+            start = time.perf_counter()
+            thumbnails.get_many(paths, size)
+            print(f"{label}產生 {len(paths)} 張縮圖: "
+                  f"{(time.perf_counter() - start) * 1000:.1f} ms")
+    stats = thumbnails.stats()
+    print(f"快取: {stats['entries']} 張縮圖，{stats['size_mb']:.1f} MB  "
+          f"(命中 {stats['hits']}，未命中 {stats['misses']})")
+
+
+if __name__ == '__main__':
+    main()
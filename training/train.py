@@ -0,0 +1,482 @@
+"""
+Xception 訓練入口，支援混合精度、XLA 編譯與梯度累積
+
+模型與 99-5 notebook 相同：Xception(pooling='max') + BatchNormalization +
+Dense(256) + Dropout(0.5) + Dense(38)，優化器為 Adamax(0.001)。
+不加任何參數執行即為原本的 float32 基準，可用來比較各模式的加速效果。
+
+每次執行會在 runs/<名稱>/ 寫出 summary.json（步驟時間、峰值記憶體、
+逐類別 F1）、model.h5，以及逐 epoch / 每 N 步的指標記錄
+metrics-*.arrow（吞吐量、步驟時間、等待輸入時間、學習率，見 metrics_log.py）。
+
+--profile 只訓練少量步數，比較等待資料輸入與計算的時間、取樣 CPU 與記憶體，
+並指出瓶頸在 JPEG 解碼、資料增強或模型計算（見 step_profiler.py）。
+
+用法：
+    python train.py --epochs 20
+    python train.py --precision mixed_bfloat16 --jit-compile
+    python train.py --batch-size 16 --accum-steps 4   # 等效批次 64
+    python train.py --profile --profile-steps 50 --trace-steps 20 25
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from data_pipeline import (
+    BATCH_SIZE,
+    IMG_SIZE,
+    SEED,
+    build_dataset,
+    build_datasets,
+    find_data_dir,
+    get_class_names,
+)
+from dataset_splits import split_frames
+from evaluation import evaluate_model, summarize
+from metrics_log import DEFAULT_RUNS, MetricsWriter
+from tensor_cache import build_cached_dataset, load_or_pack
+
+PRECISIONS = ('float32', 'mixed_float16', 'mixed_bfloat16')
+LOG_EVERY = 50
+
+
+def build_model(num_classes, image_size=IMG_SIZE, weights='imagenet'):
+    """
+    建立與 notebook 相同的 Xception 分類模型
+
+    輸出層固定為 float32，混合精度下 softmax 仍保持數值穩定
+    """
+    base_model = tf.keras.applications.xception.Xception(
+        weights=weights, include_top=False, input_shape=(*image_size, 3),
+        pooling='max')
+    return tf.keras.Sequential([
+        base_model,
+        tf.keras.layers.BatchNormalization(),
+        tf.keras.layers.Dense(256, activation='relu'),
+        tf.keras.layers.Dropout(.5),
+        tf.keras.layers.Dense(num_classes, activation='softmax',
+                              dtype='float32'),
+    ])
+
+
+class GradientAccumulationModel(tf.keras.Model):
+    """
+    包裝模型，累積 accum_steps 個小批次的梯度後才更新一次權重
+
+    讓記憶體只需容納 batch_size，等效批次大小為 batch_size * accum_steps。
+    混合精度（mixed_float16）時先以 LossScaleOptimizer 還原梯度再累積。
+    """
+
+    def __init__(self, model, accum_steps, **kwargs):
+        super().__init__(**kwargs)
+        self.model = model
+        self.accum_steps = accum_steps
+        self._step = tf.Variable(0, trainable=False, dtype=tf.int64)
+        self._accum = [tf.Variable(tf.zeros_like(v), trainable=False)
+                       for v in model.trainable_variables]
+
+    def call(self, inputs, training=False):
+        return self.model(inputs, training=training)
+
+    def _apply_accumulated(self):
+        self.optimizer.apply_gradients(
+            zip([g.value() for g in self._accum],
+                self.model.trainable_variables))
+        for g in self._accum:
+            g.assign(tf.zeros_like(g))
+        return tf.constant(True)
+
+    def train_step(self, data):
+        x, y = data
+        scaling = isinstance(self.optimizer,
+                             tf.keras.mixed_precision.LossScaleOptimizer)
+        with tf.GradientTape() as tape:
+            y_pred = self(x, training=True)
+            loss = self.compute_loss(x, y, y_pred)
+            scaled_loss = self.optimizer.get_scaled_loss(loss) if scaling \
+                else loss
+        grads = tape.gradient(scaled_loss, self.model.trainable_variables)
+        if scaling:
+            grads = self.optimizer.get_unscaled_gradients(grads)
+        for accum, grad in zip(self._accum, grads):
+            accum.assign_add(grad / self.accum_steps)
+
+        self._step.assign_add(1)
+        tf.cond(self._step % self.accum_steps == 0,
+                self._apply_accumulated, lambda: tf.constant(False))
+        return self.compute_metrics(x, y, y_pred, None)
+
+
+class DequeueClock:
+    """
+    在 tf.data 管線最後記錄每個批次被取出的時間
+
+    Keras 在編譯後的訓練函式內才呼叫 get_next，callback 無法直接量到等待
+    資料的時間。wrap() 在管線最後加上一個同步的 map 將取出時間寫入變數：
+    步驟開始到取出為等待輸入的時間，取出到步驟結束為計算時間。
+    """
+
+    def __init__(self):
+        self.dequeued = tf.Variable(0.0, dtype=tf.float64, trainable=False)
+
+    def wrap(self, dataset):
+        def stamp(*batch):
+            self.dequeued.assign(tf.timestamp())
+            return batch
+
+        # 自動插入的 prefetch 會讓 map 提前執行，需關閉
+        options = tf.data.Options()
+        options.experimental_optimization.inject_prefetch = False
+        return dataset.map(stamp).with_options(options)
+
+    def read(self):
+        return float(self.dequeued.numpy())
+
+
+class MetricsLogger(tf.keras.callbacks.Callback):
+    """
+    記錄每個訓練步驟的時間，並寫入 metrics_log 的 Arrow 串流檔
+
+    每 log_every 步寫出一列 'step' 指標、每個 epoch 結束寫出一列 'epoch'
+    指標。clock 為包裝訓練資料集的 DequeueClock，未提供時不記錄等待輸入的
+    時間。每次 fit 的第一步含追蹤/編譯時間，統計時排除。run_kind 為
+    metrics_log.RUN_KINDS 之一，latest_run 依此只取完整訓練的記錄。
+    """
+
+    def __init__(self, run_dir, batch_size, log_every=LOG_EVERY, clock=None,
+                 run_kind='train'):
+        super().__init__()
+        self.run_dir = run_dir
+        self.run_kind = run_kind
+        self.batch_size = batch_size
+        self.log_every = log_every
+        self.clock = clock
+        self.step = 0
+        self.step_times = []
+        self.input_waits = []
+        self._writer = None
+        self._window = []
+        self._epoch_steps = []
+
+    def _row(self, kind, steps, logs, **values):
+        times = np.array([t for t, _ in steps])
+        waits = np.array([w for _, w in steps if w is not None])
+        row = {
+            'kind': kind, 'epoch': self._epoch + 1, 'step': self.step,
+            'wall_time': time.time(),
+            'loss': logs.get('loss'), 'accuracy': logs.get('accuracy'),
+            'learning_rate': self._lr,
+            'step_time_ms': times.mean() * 1000 if len(times) else None,
+            'input_wait_ms': waits.mean() * 1000 if len(waits) else None,
+            'images_per_sec': self.batch_size / times.mean()
+            if len(times) else None,
+        }
+        row.update(values)
+        return {key: float(value) if isinstance(value, np.floating) else value
+                for key, value in row.items()}
+
+    def on_train_begin(self, logs=None):
+        self._writer = MetricsWriter(self.run_dir, self.run_kind)
+        self._traced = False
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch = epoch
+        # 本 epoch 使用的學習率（ReduceLROnPlateau 在 epoch 結束時才調整）
+        self._lr = float(np.asarray(self.model.optimizer.learning_rate))
+        self._epoch_steps = []
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._start = time.time()
+
+    def on_train_batch_end(self, batch, logs=None):
+        end = time.time()
+        self.step += 1
+        if not self._traced:
+            self._traced = True
+            return
+        wait = None
+        if self.clock is not None:
+            wait = max(self.clock.read() - self._start, 0.0)
+            self.input_waits.append(wait)
+        self.step_times.append(end - self._start)
+        self._window.append((end - self._start, wait))
+        self._epoch_steps.append((end - self._start, wait))
+        if len(self._window) >= self.log_every:
+            self._writer.write([self._row('step', self._window, logs or {})])
+            self._window = []
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        self._window = []
+        self._writer.write([self._row(
+            'epoch', self._epoch_steps, logs, val_loss=logs.get('val_loss'),
+            val_accuracy=logs.get('val_accuracy'))])
+
+    def on_train_end(self, logs=None):
+        self._writer.close()
+
+    def summary(self):
+        times = np.array(self.step_times)
+        if not len(times):
+            return {}
+        summary = {
+            'steps': self.step,
+            'step_time_ms_mean': float(times.mean() * 1000),
+            'step_time_ms_p50': float(np.percentile(times, 50) * 1000),
+            'images_per_sec': float(self.batch_size / times.mean()),
+        }
+        if self.input_waits:
+            summary['input_wait_ms_mean'] = float(
+                np.mean(self.input_waits) * 1000)
+        return summary
+
+
+def peak_memory_mb():
+    """
+    峰值記憶體：有 GPU 時回傳裝置記憶體，否則回傳行程的最大常駐記憶體
+    """
+    if tf.config.list_physical_devices('GPU'):
+        info = tf.config.experimental.get_memory_info('GPU:0')
+        return {'device': 'GPU:0', 'peak_mb': info['peak'] / 1024 ** 2}
+
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+    return {'device': 'host', 'peak_mb': peak_mb}
+
+
+def evaluate_f1(model, dataset, class_names):
+    """
+    在測試集上計算準確率與逐類別 F1（README 中的主要評估指標）
+    """
+    metrics, _ = evaluate_model(model, dataset, len(class_names))
+    return summarize(metrics, class_names)
+
+
+def build_callbacks(patience=3, lr_factor=0.5):
+    """
+    與 README 訓練配置相同：學習率衰減 0.5、早停 patience 3
+    """
+    return [
+        tf.keras.callbacks.ReduceLROnPlateau(monitor='val_loss',
+                                             factor=lr_factor, patience=1,
+                                             verbose=1),
+        tf.keras.callbacks.EarlyStopping(monitor='val_loss',
+                                         patience=patience,
+                                         restore_best_weights=True,
+                                         verbose=1),
+    ]
+
+
+def compile_model(model, args):
+    """
+    依參數編譯模型；accum_steps > 1 時回傳包裝後的梯度累積模型
+    """
+    if args.accum_steps > 1:
+        model = GradientAccumulationModel(model, args.accum_steps)
+    model.compile(tf.keras.optimizers.Adamax(learning_rate=args.lr),
+                  loss='categorical_crossentropy', metrics=['accuracy'],
+                  jit_compile=args.jit_compile)
+    return model
+
+
+def run_name(args):
+    parts = [args.precision]
+    if args.jit_compile:
+        parts.append('xla')
+    if args.accum_steps > 1:
+        parts.append(f"accum{args.accum_steps}")
+    return '_'.join(parts + [time.strftime('%Y%m%d-%H%M%S')])
+
+
+def train(args):
+    """
+    執行一次訓練，回傳摘要並寫出 summary.json 與 model.h5
+    """
+    tf.keras.utils.set_random_seed(args.seed)
+    tf.keras.mixed_precision.set_global_policy(args.precision)
+
+    train_df, valid_df, test_df = split_frames(args.data_dir, args.split,
+                                              args.seed)
+    if test_df is None:
+        # 只有 train/valid 兩段的切分以驗證集評估
+        test_df = valid_df
+    cache = load_or_pack(args.data_dir) if args.tensor_cache else None
+    train_ds, valid_ds, test_ds, class_names = build_datasets(
+        train_df, valid_df, test_df, batch_size=args.batch_size,
+        seed=args.seed, tensor_cache=cache)
+
+    model = build_model(len(class_names), weights=args.weights)
+    trainer = compile_model(model, args)
+    output_dir = os.path.join(args.output, args.name or run_name(args))
+    clock = DequeueClock()
+    logger = MetricsLogger(output_dir, args.batch_size, args.log_every, clock)
+
+    start = time.perf_counter()
+    history = trainer.fit(
+        clock.wrap(train_ds), validation_data=valid_ds, epochs=args.epochs,
+        steps_per_epoch=args.steps_per_epoch,
+        callbacks=build_callbacks() + [logger], verbose=1)
+    train_seconds = time.perf_counter() - start
+    summary = {
+        'config': vars(args),
+        'effective_batch_size': args.batch_size * args.accum_steps,
+        'epochs_run': len(history.history['loss']),
+        'train_seconds': train_seconds,
+        'timing': logger.summary(),
+        'memory': peak_memory_mb(),
+        'history': {k: [float(v) for v in values]
+                    for k, values in history.history.items()},
+        'test': evaluate_f1(model, test_ds, class_names),
+    }
+    with open(os.path.join(output_dir, 'summary.json'), 'w',
+              encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    model.save(os.path.join(output_dir, 'model.h5'))
+
+    timing = summary['timing']
+    print(f"\n訓練時間: {train_seconds:.1f} 秒  "
+          f"平均步驟時間: {timing.get('step_time_ms_mean', 0):.1f} ms  "
+          f"({timing.get('images_per_sec', 0):.1f} images/sec)  "
+          f"等待輸入: {timing.get('input_wait_ms_mean', 0):.1f} ms")
+    print(f"峰值記憶體 ({summary['memory']['device']}): "
+          f"{summary['memory']['peak_mb']:.0f} MB")
+    print(f"測試集準確率: {summary['test']['accuracy']:.4f}  "
+          f"macro F1: {summary['test']['macro_f1']:.4f}")
+    print(f"結果已寫入 {output_dir}")
+    return summary
+
+
+def profile(args):
+    """
+    剖析模式：訓練 profile_steps 步，量測每步等待輸入與計算的時間並指出瓶頸
+
+    結果寫入 runs/<名稱>/profile.json
+    """
+    from step_profiler import (
+        ResourceSampler,
+        TraceWindow,
+        diagnose,
+        measure_stages,
+        print_profile,
+    )
+
+    tf.keras.utils.set_random_seed(args.seed)
+    tf.keras.mixed_precision.set_global_policy(args.precision)
+
+    train_df, _, _ = split_frames(args.data_dir, args.split, args.seed)
+    class_names = get_class_names(train_df)
+    if args.tensor_cache:
+        train_ds = build_cached_dataset(
+            load_or_pack(args.data_dir), train_df, class_names,
+            training=True, batch_size=args.batch_size, seed=args.seed)
+    else:
+        train_ds = build_dataset(train_df, class_names, training=True,
+                                 batch_size=args.batch_size, seed=args.seed)
+    train_ds = train_ds.repeat()
+
+    model = build_model(len(class_names), weights=args.weights)
+    trainer = compile_model(model, args)
+    output_dir = os.path.join(args.output,
+                              args.name or f"profile_{run_name(args)}")
+    clock = DequeueClock()
+    logger = MetricsLogger(output_dir, args.batch_size, args.log_every, clock,
+                           run_kind='profile')
+    callbacks = [logger]
+    trace_dir = None
+    if args.trace_steps:
+        trace_dir = os.path.join(output_dir, 'trace')
+        callbacks.append(TraceWindow(trace_dir, *args.trace_steps))
+
+    print(f"剖析 {args.profile_steps} 個訓練步驟...")
+    with ResourceSampler() as sampler:
+        trainer.fit(clock.wrap(train_ds), epochs=1,
+                    steps_per_epoch=args.profile_steps, callbacks=callbacks,
+                    verbose=0)
+    print("量測輸入管線各階段吞吐量...")
+    stages = measure_stages(train_df, class_names, args.batch_size,
+                            seed=args.seed)
+
+    result = diagnose(logger.step_times, logger.input_waits, args.batch_size,
+                      stages)
+    result.update(resources=sampler.summary(), trace_dir=trace_dir,
+                  config=vars(args))
+    with open(os.path.join(output_dir, 'profile.json'), 'w',
+              encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print_profile(result)
+    print(f"結果已寫入 {output_dir}")
+    return result
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Xception 訓練')
+    parser.add_argument('--data-dir', default=find_data_dir())
+    parser.add_argument('--output', default=DEFAULT_RUNS)
+    parser.add_argument('--name', default=None,
+                        help='執行名稱（預設依設定產生）')
+    parser.add_argument('--split', default=None,
+                        help='dataset_splits 的切分名稱（預設同 notebook）')
+    parser.add_argument('--epochs', type=int, default=40)
+    parser.add_argument('--steps-per-epoch', type=int, default=None,
+                        help='限制每個 epoch 的步數（快速比較用）')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--lr', type=float, default=0.001)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--weights', default='imagenet',
+                        help="Xception 預訓練權重，'none' 表示隨機初始化")
+    parser.add_argument('--precision', choices=PRECISIONS, default='float32',
+                        help='混合精度策略')
+    parser.add_argument('--jit-compile', action='store_true',
+                        help='以 XLA 編譯訓練步驟')
+    parser.add_argument('--accum-steps', type=int, default=1,
+                        help='梯度累積步數')
+    parser.add_argument('--log-every', type=int, default=LOG_EVERY,
+                        help='每幾步寫出一列步驟指標')
+    parser.add_argument('--profile', action='store_true',
+                        help='剖析模式：比較等待輸入與計算時間並指出瓶頸')
+    parser.add_argument('--profile-steps', type=int, default=50,
+                        help='剖析模式訓練的步數')
+    parser.add_argument('--trace-steps', type=int, nargs=2, default=None,
+                        metavar=('START', 'STOP'),
+                        help='剖析模式中擷取 TF profiler trace 的步數區間')
+    parser.add_argument('--tensor-cache', action='store_true',
+                        help='從 tensor_cache.py 的記憶體映射快取讀取圖片'
+                             '（不存在或已失效時先打包）')
+    return parser
+
+
+PROFILE_OPTIONS = ('--profile', '--profile-steps', '--trace-steps')
+
+
+def reject_options(parser, args, options, mode):
+    """
+    衍生的訓練程式（distill.py 等）沿用 build_parser，指定了它們不支援的
+    選項時以 parser.error 結束，而不是默默忽略
+    """
+    given = [option for option in options
+             if getattr(args, option[2:].replace('-', '_'))
+             != parser.get_default(option[2:].replace('-', '_'))]
+    if given:
+        parser.error(f"{mode}不支援 {', '.join(given)}")
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+    if args.weights == 'none':
+        args.weights = None
+    if args.profile:
+        profile(args)
+    else:
+        train(args)
+
+
+if __name__ == '__main__':
+    main()